@@ -1,32 +1,46 @@
 
 
-from .models import ClaimsLog, Records, AuthorInfo, ChangeLog
-from adsputils import get_date, setup_logging, load_config, ADSCelery
+from .models import ClaimsLog, ClaimsState, Records, AuthorInfo, ChangeLog, PendingClaims, Lease, \
+    RecheckSchedule, authors_hash, decompress_authors, raw, stream_columns
+from adsputils import get_date, setup_logging, load_config, ADSCelery, ADSTask
 from ADSOrcid import names
 from ADSOrcid.exceptions import IgnorableException
+from ADSOrcid.cache import Cache, cached, configure_caches, make_key
+from ADSOrcid.client import HttpClient
+from ADSOrcid.metrics import Metrics
+from ADSOrcid.ratelimit import create_limiter
+from ADSOrcid import cache as cache_module
 from celery import Celery
 from contextlib import contextmanager
+from cStringIO import StringIO
 from dateutil.tz import tzutc
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, func, select
 from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
-import cachetools
+import csv
 import datetime
+import gzip
 import json
 import os
-import random
-import requests
+import sys
+import threading
 import time
 import traceback
+import uuid
 
 
 # global objects; we could make them belong to the app object but it doesn't seem necessary
 # unless two apps with a different endpint/config live along; TODO: move if necessary
-cache = cachetools.TTLCache(maxsize=1024, ttl=3600, timer=time.time, missing=None, getsizeof=None)
-orcid_cache = cachetools.TTLCache(maxsize=1024, ttl=3600, timer=time.time, missing=None, getsizeof=None)
-ads_cache = cachetools.TTLCache(maxsize=1024, ttl=3600, timer=time.time, missing=None, getsizeof=None)
-bibcode_cache = cachetools.TTLCache(maxsize=2048, ttl=3600, timer=time.time, missing=None, getsizeof=None)
+# their storage (and size/ttl) is set from the config when the app gets created
+cache = Cache('cache', maxsize=1024, ttl=3600)
+orcid_cache = Cache('orcid_cache', maxsize=1024, ttl=3600)
+ads_cache = Cache('ads_cache', maxsize=1024, ttl=3600)
+bibcode_cache = Cache('bibcode_cache', maxsize=2048, ttl=3600)
+# responses of conditional requests (orcid profiles)
+response_cache = Cache('response_cache', maxsize=2048, ttl=3600*24)
 
 ALLOWED_STATUS = set(['claimed', 'updated', 'removed', 'unchanged', 'forced', '#full-import'])
 
@@ -38,11 +52,144 @@ def clear_caches():
     orcid_cache.clear()
     ads_cache.clear()
     bibcode_cache.clear()
+    response_cache.clear()
+
+
+def _normalize_identifier(value):
+    """Makes identifiers comparable, e.g. 'arXiv:1406.4542' and '1406.4542' 
+    or 'DOI:10.1/X' and '10.1/x'"""
+    v = value.strip().lower()
+    for prefix in ('https://doi.org/', 'http://dx.doi.org/', 'doi:', 'arxiv:'):
+        if v.startswith(prefix):
+            return v[len(prefix):]
+    return v
+
+
+class InstrumentedTask(ADSTask):
+    """Records duration and outcome (success, failure, ignored) of 
+    every task into the app's metrics"""
+    
+    def __call__(self, *args, **kwargs):
+        start = time.time()
+        status = 'failure'
+        try:
+            out = ADSTask.__call__(self, *args, **kwargs)
+            status = 'success'
+            return out
+        except IgnorableException:
+            status = 'ignored'
+            raise
+        finally:
+            metrics = getattr(self.app, 'metrics', None)
+            if metrics is not None:
+                metrics.observe('task_duration_seconds', time.time() - start, task=self.name)
+                metrics.inc('tasks_total', task=self.name, status=status)
+                self.app.write_metrics()
+
 
 
 class ADSOrcidCelery(ADSCelery):
     
     
+    def __init__(self, app_name, *args, **kwargs):
+        ADSCelery.__init__(self, app_name, *args, **kwargs)
+        configure_caches(self._config)
+        # responses (of conditional requests) that were not processed yet
+        self._unacknowledged = {}
+        self.metrics = self._create_metrics()
+        self._client = None
+        self._client_lock = threading.Lock()
+    
+    
+    def task(self, *args, **opts):
+        """All our tasks are instrumented (see InstrumentedTask)"""
+        opts.setdefault('base', InstrumentedTask)
+        return ADSCelery.task(self, *args, **opts)
+    
+    
+    def _create_metrics(self):
+        m = Metrics(namespace=self._config.get('METRICS_NAMESPACE', 'adsorcid'))
+        m.describe('task_duration_seconds', 'histogram', 'Duration of celery tasks')
+        m.describe('tasks_total', 'counter', 'Finished celery tasks (by status: success, failure, ignored)')
+        m.describe('http_request_duration_seconds', 'histogram', 'Latency of calls to the external API\'s')
+        m.describe('http_requests_total', 'counter', 'Calls to the external API\'s (by http status)')
+        m.describe('http_retries_total', 'counter', 'Retried calls to the external API\'s')
+        m.describe('http_throttle_seconds', 'histogram', 'Time spent waiting for the rate limiter')
+        m.describe('db_session_seconds', 'histogram', 'Time spent inside db sessions')
+        m.describe('index_suppressed_total', 'counter', 'Duplicate orcid profiles that were not indexed '
+                   '(by reason: queued, running)')
+        
+        def collect_caches():
+            stats = cache_module.all_stats()
+            out = []
+            for k in ('hits', 'misses', 'evictions'):
+                out.append(('cache_{0}_total'.format(k), 'counter', 'Cache {0}'.format(k),
+                            [({'cache': name}, v[k]) for name, v in sorted(stats.items())]))
+            return out
+        m.register_collector(collect_caches)
+        return m
+    
+    
+    def write_metrics(self, force=False):
+        """Writes the metrics for the textfile collector (into 
+        METRICS_TEXTFILE_DIR, if set); the file is written at most
+        every METRICS_WRITE_INTERVAL seconds (unless forced)"""
+        directory = self._config.get('METRICS_TEXTFILE_DIR', None)
+        if not directory:
+            return None
+        try:
+            return self.metrics.write_textfile(directory, 
+                        interval=not force and self._config.get('METRICS_WRITE_INTERVAL', 15) or 0)
+        except Exception, e:
+            self.logger.warning('Failed writing metrics into {0}: {1}'.format(directory, e))
+    
+    
+    @contextmanager
+    def session_scope(self):
+        """Provides a transactional scope (see ADSCelery.session_scope);
+        the time spent inside is recorded in the metrics"""
+        start = time.time()
+        try:
+            with ADSCelery.session_scope(self) as session:
+                yield session
+        finally:
+            self.metrics.observe('db_session_seconds', time.time() - start)
+            self.write_metrics()
+    
+    
+    @property
+    def client(self):
+        """HTTP client (shared by all the components) that talks to
+        the external API's; it is created only once (even when threads 
+        ask for it at the same time)."""
+        if self._client is not None:
+            return self._client
+        with self._client_lock:
+            if self._client is None:
+                self._client = HttpClient(connect_timeout=self._config.get('HTTP_CONNECT_TIMEOUT', 5.0),
+                                          read_timeout=self._config.get('HTTP_READ_TIMEOUT', 30.0),
+                                          max_retries=self._config.get('HTTP_MAX_RETRIES', 3),
+                                          backoff_factor=self._config.get('HTTP_BACKOFF_FACTOR', 0.5),
+                                          max_backoff=self._config.get('HTTP_MAX_BACKOFF', 60.0),
+                                          pool_size=self._config.get('HTTP_POOL_SIZE', 10),
+                                          concurrency=self._config.get('HTTP_CONCURRENCY', None),
+                                          response_cache=response_cache,
+                                          logger=self.logger,
+                                          metrics=self.metrics,
+                                          rate_limiter=create_limiter(self._config, engine=getattr(self, '_engine', None)))
+        return self._client
+    
+    
+    def close_app(self):
+        """Closes the app (and open connections)"""
+        with self._client_lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+        self.write_metrics(force=True)
+        ADSCelery.close_app(self)
+    
+    
     def insert_claims(self, claims):
         """
         Build a batch of claims and saves them into a database
@@ -62,10 +209,70 @@ class ADSOrcidCelery(ADSCelery):
                 if claim:
                     session.add(claim)
                     res.append(claim)
+            self._update_claims_state(session, res)
             session.commit()
             res = [x.toJSON() for x in res]
         return res
     
+    
+    def _update_claims_state(self, session, claims):
+        """Updates the current state of the (orcidid, bibcode) pairs; it
+        has to be called inside the same transaction which inserts the
+        claims (ClaimsLog).
+        
+        :param: session - open session
+        :param: claims - list of ClaimsLog instances (or dicts with
+            orcidid, bibcode, status, provenance, created)
+        """
+        latest = {}
+        for c in claims:
+            if isinstance(c, ClaimsLog):
+                c = {'orcidid': c.orcidid, 'bibcode': c.bibcode, 'status': c.status,
+                     'provenance': c.provenance, 'created': c.created}
+            if not c.get('bibcode') or not c.get('orcidid'):
+                continue
+            latest[(c['orcidid'], c['bibcode'])] = c
+        
+        if not latest:
+            return
+        
+        now = get_date()
+        rows = [{'orcidid': k[0], 'bibcode': k[1], 'status': c['status'], 'provenance': c['provenance'],
+                 'created': c['created'] or now, 'updated': now} for k, c in latest.items()]
+        
+        # upsert: other workers may be inserting the same pairs right now
+        # (and a duplicate key would roll back the claims too)
+        table = ClaimsState.__table__
+        if self._engine.dialect.name == 'postgresql':
+            q = postgresql.insert(table)
+            q = q.on_conflict_do_update(index_elements=[table.c.orcidid, table.c.bibcode],
+                                        set_=dict([(x, q.excluded[x]) for x in 
+                                                   ('status', 'provenance', 'created', 'updated')]))
+        else:
+            q = table.insert().prefix_with('OR REPLACE')
+        for i in range(0, len(rows), 500):
+            session.execute(q, rows[i:i+500])
+    
+    
+    def backfill_claims_state(self):
+        """Rebuilds the current state of claims from the ClaimsLog (the
+        latest log entry of every orcidid/bibcode pair wins).
+        
+        :return: number of (orcidid, bibcode) pairs
+        """
+        with self.session_scope() as session:
+            session.query(ClaimsState).delete(synchronize_session=False)
+            latest = session.query(func.max(ClaimsLog.id)) \
+                .filter(and_(ClaimsLog.bibcode != None, ClaimsLog.bibcode != '')) \
+                .group_by(ClaimsLog.orcidid, ClaimsLog.bibcode)
+            cols = [ClaimsLog.orcidid, ClaimsLog.bibcode, ClaimsLog.status, 
+                    ClaimsLog.provenance, ClaimsLog.created, ClaimsLog.created.label('updated')]
+            sel = select(cols).where(ClaimsLog.id.in_(latest.subquery()))
+            session.execute(ClaimsState.__table__.insert().from_select(
+                ['orcidid', 'bibcode', 'status', 'provenance', 'created', 'updated'], sel))
+            session.commit()
+            return session.query(func.count('*')).select_from(ClaimsState).scalar()
+    
     def create_claim(self, 
                  bibcode=None, 
                  orcidid=None, 
@@ -109,7 +316,8 @@ class ADSOrcidCelery(ADSCelery):
 
 
     def import_recs(self, input_file, default_provenance=None, 
-                default_status='claimed', collector=None):
+                default_status='claimed', collector=None, batch_size=None,
+                callback=None):
         """
         Imports (creates log records) of claims from
         :param: input_file - String, path to the file with the following 
@@ -119,15 +327,22 @@ class ADSOrcidCelery(ADSCelery):
                     provenance - optional
                     status - optional
                     date - optional
+                the file can be gzipped (*.gz); '-' means standard input
         :param: default_provenance - String, this will be used if the records
                 don't provide provenance
         :param: default_status - String, used when status is not supplied
         :param: collector - if passed in, the results will be inserted
                 into it
         :type: array
+        :param: batch_size - int, number of claims inserted at once (default
+                IMPORT_BATCH_SIZE)
+        :param: callback - function, it will receive every batch of claims 
+                (list of json values) after they were saved
+        
+        :return: number of imported claims
         """
         
-        if not os.path.exists(input_file):
+        if input_file != '-' and not os.path.exists(input_file):
             raise Exception('{file} does not exist'.format(
                                file=input_file
                                ))
@@ -135,48 +350,131 @@ class ADSOrcidCelery(ADSCelery):
             assert(isinstance(collector, list))
             
         if default_provenance is None:
-            default_provenance = os.path.abspath(input_file)
-            
+            default_provenance = input_file == '-' and 'stdin' or os.path.abspath(input_file)
+        
+        batch_size = batch_size or self._config.get('IMPORT_BATCH_SIZE', 1000)
+        
         def rec_builder(bibcode=None, orcidid=None, provenance=None, status=None, date=None):
             assert(bibcode and orcidid)
-            return ClaimsLog(bibcode=bibcode, 
-                          orcidid=orcidid,
-                          provenance=provenance or default_provenance, 
-                          status=status or default_status,
-                          created=date and get_date(date) or get_date())
-            
-        i = 0
-        with open(input_file, 'r') as fi:
-            with self.session_scope() as session:
-                for line in fi:
-                    i += 1
-                    l = line.strip()
-                    if len(l) == 0 or l[0] == '#':
-                        continue
-                    parts = l.split('\t')
-                    try:
-                        rec = rec_builder(*parts)
-                        session.add(rec)
-                        if collector is not None:
-                            collector.append(rec.toJSON())
-                    except Exception, e:
-                        self.logger.error('Error importing line %s (%s) - %s' % (i, l, e))
-                    if i % 1000 == 0:
-                        session.commit()
-                session.commit()
+            status = status or default_status
+            if status not in ALLOWED_STATUS:
+                raise Exception('Unknown status %s' % status)
+            return {'bibcode': bibcode, 
+                    'orcidid': orcidid,
+                    'provenance': provenance or default_provenance, 
+                    'status': status,
+                    'created': date and get_date(date) or get_date()}
+        
+        def parse(fi):
+            i = 0
+            for line in fi:
+                i += 1
+                l = line.strip()
+                if len(l) == 0 or l[0] == '#':
+                    continue
+                parts = l.split('\t')
+                try:
+                    yield rec_builder(*parts)
+                except Exception, e:
+                    self.logger.error('Error importing line %s (%s) - %s' % (i, l, e))
+        
+        if input_file == '-':
+            fi = sys.stdin
+        elif input_file.endswith('.gz'):
+            fi = gzip.open(input_file, 'rb')
+        else:
+            fi = open(input_file, 'r')
+        
+        total = 0
+        start = time.time()
+        try:
+            batch = []
+            for rec in parse(fi):
+                batch.append(rec)
+                if len(batch) >= batch_size:
+                    total += self._import_batch(batch, collector, callback)
+                    batch = []
+                    self.logger.info('Imported {0} claims ({1:.1f} rows/sec)'.format(
+                        total, total / max(time.time() - start, 1e-6)))
+            if len(batch):
+                total += self._import_batch(batch, collector, callback)
+        finally:
+            if fi is not sys.stdin:
+                fi.close()
+        
+        self.logger.info('Done importing {0} claims from {1} in {2:.1f}s ({3:.1f} rows/sec)'.format(
+            total, input_file, time.time() - start, total / max(time.time() - start, 1e-6)))
+        return total
+    
+    
+    def _import_batch(self, batch, collector=None, callback=None):
+        """Inserts a batch of claims (using bulk insert, or COPY when
+        the database is PostgreSQL)
+        
+        :param: batch - list of dicts (with ClaimsLog columns)
+        :return: number of inserted claims
+        """
+        with self.session_scope() as session:
+            if self._engine.dialect.name == 'postgresql' and self._config.get('IMPORT_USE_COPY', True):
+                buf = StringIO()
+                w = csv.writer(buf)
+                for r in batch:
+                    w.writerow([x.encode('utf8') if isinstance(x, unicode) else x for x in 
+                                (r['orcidid'], r['bibcode'], r['status'], r['provenance'], r['created'].isoformat())])
+                buf.seek(0)
+                cursor = session.connection().connection.cursor()
+                cursor.copy_expert('COPY claims (orcidid, bibcode, status, provenance, created) FROM STDIN WITH CSV', buf)
+            else:
+                session.execute(ClaimsLog.__table__.insert(), batch)
+            self._update_claims_state(session, batch)
+            session.commit()
+        
+        if collector is not None or callback is not None:
+            out = [{'id': None, 'orcidid': r['orcidid'], 'bibcode': r['bibcode'], 'status': r['status'],
+                    'provenance': unicode(r['provenance']), 'created': r['created'].isoformat()} for r in batch]
+            if collector is not None:
+                collector.extend(out)
+            if callback is not None:
+                callback(out)
+        return len(batch)
 
 
     def _get_ads_orcid_profile(self, orcidid, api_token, api_url):
-        r = requests.get(api_url,
-                 params={'reload': True},
+        params = {}
+        if self._config.get('API_ORCID_EXPORT_RELOAD', True):
+            params['reload'] = True
+        r = self.client.get(api_url, endpoint='orcid-service', conditional=True,
+                 params=params,
                  headers={'Accept': 'application/json', 'Authorization': 'Bearer:%s' % api_token})
         if r.status_code == 200:
+            self._unacknowledged[('claims', orcidid)] = r
             return r.json()
         else:
+            self.discard_unacknowledged('claims', orcidid)
             self.logger.warning('Missing profile for: {0}'.format(orcidid))
             self.logger.warning(r.text)
             return {}
-
+    
+    
+    def acknowledge(self, consumer, orcidid):
+        """Marks the profile (as it was fetched the last time) processed by
+        the consumer; if the profile doesn't change, the consumer will 
+        skip it next time.
+        
+        :param: consumer - str, 'claims' (get_claims)
+        :param: orcidid - str
+        """
+        r = self._unacknowledged.pop((consumer, orcidid), None)
+        if r is not None:
+            self.client.acknowledge(r, consumer)
+    
+    
+    def discard_unacknowledged(self, consumer, orcidid):
+        """Forgets the profile fetched for the consumer (it will not be
+        acknowledged, i.e. it will be processed again next time)"""
+        self._unacknowledged.pop((consumer, orcidid), None)
+    
+    
     def get_claims(self, orcidid, api_token, api_url, force=False, 
                       orcid_identifiers_order=None):
         """
@@ -218,6 +516,15 @@ class ADSOrcidCelery(ADSCelery):
         if data is None:
             return {}, {}, {} #TODO: remove all existing claims?
         
+        # the very same profile (the same digest) was already imported
+        r = self._unacknowledged.get(('claims', orcidid), None)
+        if r is not None and not self.client.is_changed(r, 'claims'):
+            if force:
+                self.logger.info("Profile {0} unchanged, but forced update in effect.".format(orcidid))
+            else:
+                self.logger.info("Skipping {0} (profile content unchanged)".format(orcidid))
+                return {}, {}, {}
+        
         profile = data.get('profile', {})
         if not profile:
             return {}, {}, {} #TODO: remove all existing claims?
@@ -244,59 +551,83 @@ class ADSOrcidCelery(ADSCelery):
                 updt = get_date()
                                     
             # find the most recent #full-import record
-            last_update = session.query(ClaimsLog).filter(
+            last_update = session.query(raw(ClaimsLog.created)).filter(
                 and_(ClaimsLog.status == '#full-import', ClaimsLog.orcidid == orcidid)
                 ).order_by(ClaimsLog.id.desc()).first()
                 
-            if last_update is None:
-                q = session.query(ClaimsLog).filter_by(orcidid=orcidid).order_by(ClaimsLog.id.asc())
-            else:
-                if get_date(last_update.created) == updt:
-                    if force:
-                        self.logger.info("Profile {0} unchanged, but forced update in effect.".format(orcidid))
-                    else:
-                        self.logger.info("Skipping {0} (profile unchanged)".format(orcidid))
-                        return {}, {}, {}
-                q = session.query(ClaimsLog).filter(
-                    and_(ClaimsLog.orcidid == orcidid, ClaimsLog.id > last_update.id)) \
-                    .order_by(ClaimsLog.id.asc())
+            if last_update is not None and get_date(last_update.created) == updt:
+                if force:
+                    self.logger.info("Profile {0} unchanged, but forced update in effect.".format(orcidid))
+                else:
+                    self.logger.info("Skipping {0} (profile unchanged)".format(orcidid))
+                    return {}, {}, {}
+            
+            # the current state of claims (the latest claim of every bibcode)
+            q = stream_columns(session, [ClaimsState.bibcode, ClaimsState.status, ClaimsState.created],
+                               criterion=[ClaimsState.orcidid == orcidid],
+                               order_by=[ClaimsState.updated.asc()])
                         
             
-            # now get info about each record #TODO: enhance the matching (and refactor)
-            # we'll try to match identifiers against our own API; if a document is found
-            # it will be added to the `orcid_present` with corresponding timestamp (cdate)
-            orcid_present = {}
+            # now get info about each record; we'll try to match identifiers against our 
+            # own API; if a document is found it will be added to the `orcid_present` with 
+            # corresponding timestamp (cdate)
+            # first collect the identifiers of all works (so that we can resolve them
+            # in a few batched queries instead of one request per identifier)
+            fmap = orcid_identifiers_order
+            candidates = []
+            to_resolve = set()
             for w in works:
-                bibc = None
                 try:
                     ids =  w['work-external-identifiers']['work-external-identifier']
                     seek_ids = []
                     
                     # painstakingly check ids (start from a bibcode) if we can find it
                     # we'll send it through (but start from bibcodes, then dois, arxiv...)
-                    fmap = orcid_identifiers_order
                     for x in ids:
                         xtype = x.get('work-external-identifier-type', None)
                         if xtype:
-                            seek_ids.append((fmap.get(xtype.lower().strip(), fmap.get('*', -1)), 
-                                             x['work-external-identifier-id']['value']))
+                            priority = fmap.get(xtype.lower().strip(), fmap.get('*', -1))
+                            if priority < 0:
+                                continue
+                            seek_ids.append((priority, x['work-external-identifier-id']['value']))
                     
                     if len(seek_ids) == 0:
                         continue
                     
                     seek_ids = sorted(seek_ids, key=lambda x: x[0], reverse=True)
                     for _priority, fvalue in seek_ids:
-                        try:
-                            time.sleep(1.0/random.randint(1, 10)) # be nice to the api
-                            metadata = self.retrieve_metadata(fvalue, search_identifiers=True)
-                            if metadata and metadata.get('bibcode', None):
-                                bibc = metadata.get('bibcode')
-                                self.logger.info('Match found {0} -> {1}'.format(fvalue, bibc))
-                                break
-                        except Exception, e:
-                            self.logger.error('Exception while searching for matching bibcode for: {}'.format(fvalue))
-                            self.logger.warning(e.message)
-                            
+                        to_resolve.add(fvalue)
+                    candidates.append((w, ids, seek_ids))
+                except KeyError, e:
+                    self.logger.warning('Error processing a record: '
+                        '{0} ({1})'.format(w,
+                                           traceback.format_exc()))
+                    continue
+                except TypeError, e:
+                    self.logger.warning('Error processing a record: '
+                        '{0} ({1})'.format(w,
+                                           traceback.format_exc()))
+                    continue
+            
+            try:
+                resolved = self.resolve_identifiers(to_resolve)
+            except:
+                # the profile must not be skipped next time
+                self.discard_unacknowledged('claims', orcidid)
+                raise
+            
+            incomplete = False
+            
+            orcid_present = {}
+            for w, ids, seek_ids in candidates:
+                bibc = None
+                try:
+                    for _priority, fvalue in seek_ids:
+                        metadata = resolved.get(fvalue)
+                        if metadata and metadata.get('bibcode', None):
+                            bibc = metadata.get('bibcode')
+                            self.logger.info('Match found {0} -> {1}'.format(fvalue, bibc))
+                            break
                     
                     if bibc:
                         # would you believe that orcid doesn't return floats?
@@ -310,24 +641,33 @@ class ADSOrcidCelery(ADSCelery):
                         orcid_present[bibc.lower().strip()] = (bibc.strip(), get_date(ts.isoformat()), provenance)
                     else:
                         self.logger.warning('Found no bibcode for: {orcidid}. {ids}'.format(ids=json.dumps(ids), orcidid=orcidid))
+                        incomplete = True
                         
                 except KeyError, e:
                     self.logger.warning('Error processing a record: '
                         '{0} ({1})'.format(w,
                                            traceback.format_exc()))
+                    incomplete = True
                     continue
                 except TypeError, e:
                     self.logger.warning('Error processing a record: '
                         '{0} ({1})'.format(w,
                                            traceback.format_exc()))
+                    incomplete = True
                     continue
+            
+            if incomplete:
+                # some works were not resolved (yet); this profile must not be
+                # skipped next time (even if it doesn't change)
+                self.discard_unacknowledged('claims', orcidid)
     
             
-            # find all records we have processed at some point
+            # find all records we have processed at some point (bibcodes that
+            # differ only by case are collapsed; the last written wins)
             updated = {}
             removed = {}
             
-            for cl in q.all():
+            for cl in q:
                 if not cl.bibcode:
                     continue
                 bibc = cl.bibcode.lower()
@@ -344,13 +684,17 @@ class ADSOrcidCelery(ADSCelery):
         
     
         
-    @cachetools.cached(cache)  
+    @cached(cache)  
     def retrieve_orcid(self, orcid):
         """
         Finds (or creates and returns) model of ORCID
-        from the dbase. It will automatically update our
-        knowledge about the author every time it gets
-        called.
+        from the dbase. 
+        
+        Info that is older than AUTHOR_INFO_FRESHNESS (seconds) is 
+        returned as it is, but the author gets refreshed in the 
+        background (task_refresh_author). If AUTHOR_INFO_FRESHNESS 
+        is 0, our knowledge about the author is updated every time
+        this method gets called.
         
         :param orcid - String (orcid id)
         :return - OrcidModel datastructure
@@ -358,25 +702,240 @@ class ADSOrcidCelery(ADSCelery):
         with self.session_scope() as session:
             u = session.query(AuthorInfo).filter_by(orcidid=orcid).first()
             if u is not None:
-                return self.update_author(u)
+                freshness = self._config.get('AUTHOR_INFO_FRESHNESS', 0)
+                if not freshness:
+                    return self.update_author(u)
+                if u.updated is None or (get_date() - get_date(u.updated)).total_seconds() > freshness:
+                    self.request_author_refresh(orcid)
+                return u.toJSON()
             u = self.create_orcid(orcid)
             session.add(u)
             session.commit()
             
             return session.query(AuthorInfo).filter_by(orcidid=orcid).first().toJSON()
     
-    @cachetools.cached(orcid_cache)
+    def request_author_refresh(self, orcid):
+        """Schedules refresh of the author info (unless somebody already
+        did it, i.e. it holds the lease).
+        
+        :return: True if the refresh was scheduled
+        """
+        lease = 'refresh-author:{0}'.format(orcid)
+        if not self.acquire_lease(lease, self._config.get('AUTHOR_REFRESH_LEASE', 600)):
+            return False
+        try:
+            self.send_task('ADSOrcid.tasks.task_refresh_author', args=(orcid,), queue='refresh-author')
+        except Exception, e:
+            self.logger.warning('Failed to schedule refresh of {0}: {1}'.format(orcid, e))
+            self.release_lease(lease)
+            return False
+        return True
+    
+    
+    def refresh_author(self, orcid):
+        """Harvests fresh info about the author (and releases the lease
+        taken by request_author_refresh).
+        
+        :return: OrcidModel datastructure or None (unknown author)
+        """
+        try:
+            with self.session_scope() as session:
+                u = session.query(AuthorInfo).filter_by(orcidid=orcid).first()
+                if u is None:
+                    return None
+                out = self.update_author(u)
+            cache.delete(make_key(orcid))
+            return out
+        finally:
+            self.release_lease('refresh-author:{0}'.format(orcid))
+    
+    
+    def acquire_lease(self, name, ttl, owner=None):
+        """Takes the named lease (if it is free or expired); the lease
+        expires after ttl seconds (unless it is released sooner).
+        
+        :param: name - str
+        :param: ttl - int, seconds
+        :param: owner - str, the current owner can renew the lease (if not
+                given, nobody can)
+        :return: True if we got the lease
+        """
+        owner = owner or uuid.uuid4().hex
+        now = get_date()
+        expires = now + datetime.timedelta(seconds=ttl)
+        table = Lease.__table__
+        with self._engine.begin() as conn:
+            r = conn.execute(table.update()
+                             .where(and_(table.c.name == name, or_(table.c.expires < now, table.c.owner == owner)))
+                             .values(owner=owner, expires=expires))
+            if r.rowcount > 0:
+                return True
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(table.insert().values(name=name, owner=owner, expires=expires))
+            return True
+        except IntegrityError:
+            return False
+    
+    
+    @contextmanager
+    def keep_lease(self, name, ttl, owner):
+        """Renews the lease (every ttl/3 seconds) for as long as the
+        block runs; the lease must have been acquired by the owner."""
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(ttl / 3.0):
+                try:
+                    if not self.acquire_lease(name, ttl, owner=owner):
+                        self.logger.warning('Lost the lease: {0}'.format(name))
+                        return
+                except Exception as e:
+                    self.logger.warning('Failed renewing the lease {0}: {1}'.format(name, e))
+        t = threading.Thread(target=renew, name='lease-{0}'.format(name))
+        t.daemon = True
+        t.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            t.join()
+    
+    
+    def release_lease(self, name, owner=None):
+        """Releases the lease (if owner is None, it is released 
+        no matter who holds it)
+        
+        :return: True if there was a lease to release
+        """
+        table = Lease.__table__
+        q = table.delete().where(table.c.name == name)
+        if owner:
+            q = q.where(table.c.owner == owner)
+        with self._engine.begin() as conn:
+            return conn.execute(q).rowcount > 0
+    
+    
+    def schedule_recheck(self, orcidid, delay, interval=None):
+        """Sets the time of the next check of the orcid profile (now + 
+        delay seconds); it replaces whatever was scheduled before.
+        
+        :param: orcidid - str
+        :param: delay - int, seconds
+        :param: interval - int, seconds; if present, it is saved as the
+                current check interval of the profile
+        """
+        now = get_date()
+        values = {'next_check_at': now + datetime.timedelta(seconds=delay), 'updated': now}
+        if interval is not None:
+            values['check_interval'] = int(interval)
+        table = RecheckSchedule.__table__
+        for i in range(2):
+            with self._engine.begin() as conn:
+                r = conn.execute(table.update().where(table.c.orcidid == orcidid).values(**values))
+                if r.rowcount > 0:
+                    return
+            try:
+                with self._engine.begin() as conn:
+                    conn.execute(table.insert().values(orcidid=orcidid, **values))
+                return
+            except IntegrityError:
+                pass # somebody inserted it meanwhile, update it
+    
+    
+    def get_recheck_interval(self, orcidid, changed):
+        """Computes how long we wait till the next check of the orcid
+        profile: the interval gets shorter (ORCID_RECHECK_SHRINK) every 
+        time the profile changed and longer (ORCID_RECHECK_GROW) every
+        time it didn't; it stays between ORCID_RECHECK_MIN_INTERVAL and
+        ORCID_RECHECK_MAX_INTERVAL. Profiles that don't have an interval
+        yet get one estimated from their history.
+        
+        :param: orcidid - str
+        :param: changed - bool, the profile changed since the last check
+        :return: int, seconds
+        """
+        with self.session_scope() as session:
+            r = session.query(RecheckSchedule.check_interval).filter_by(orcidid=orcidid).first()
+        if r is None or not r.check_interval:
+            # (the history includes the check we have just done)
+            interval = self.estimate_recheck_interval(orcidid)
+        elif changed:
+            interval = r.check_interval * self._config.get('ORCID_RECHECK_SHRINK', 0.5)
+        else:
+            interval = r.check_interval * self._config.get('ORCID_RECHECK_GROW', 1.5)
+        return int(min(self._config.get('ORCID_RECHECK_MAX_INTERVAL', 3600*24*30),
+                       max(self._config.get('ORCID_RECHECK_MIN_INTERVAL', 3600*6), interval)))
+    
+    
+    def estimate_recheck_interval(self, orcidid):
+        """Estimates how often the orcid profile changes from its history
+        (of the last ORCID_RECHECK_HISTORY seconds): every import of the
+        profile (#full-import) is followed by the claims that changed
+        (claimed, updated, removed); the time covered by the history 
+        (but at least ORCID_PROFILE_RECHECK_WINDOW) is divided by the
+        number of imports that found changes + 1.
+        
+        :param: orcidid - str
+        :return: float, seconds
+        """
+        now = get_date()
+        since = now - datetime.timedelta(seconds=self._config.get('ORCID_RECHECK_HISTORY', 3600*24*365))
+        first = last_import = None
+        changed = set()
+        with self.session_scope() as session:
+            for id, status, created in stream_columns(session, [ClaimsLog.id, ClaimsLog.status, ClaimsLog.created],
+                        criterion=[ClaimsLog.orcidid == orcidid, ClaimsLog.created >= since,
+                                   ClaimsLog.status.in_(('#full-import', 'claimed', 'updated', 'removed'))],
+                        order_by=[ClaimsLog.id.asc()]):
+                if status == '#full-import':
+                    last_import = id
+                    if first is None:
+                        first = created
+                elif last_import is not None:
+                    changed.add(last_import)
+        
+        window = self._config.get('ORCID_PROFILE_RECHECK_WINDOW', 3600*24)
+        span = first and (now - get_date(first)).total_seconds() or 0
+        return max(span, window) / (len(changed) + 1)
+    
+    
+    def pop_due_rechecks(self, limit, postpone):
+        """Finds orcid profiles that are due for a check (the most overdue
+        first) and moves their next check `postpone` seconds into the
+        future; so that they are not found again (and if the check fails,
+        they will be retried then).
+        
+        :param: limit - int, max number of profiles
+        :param: postpone - int, seconds
+        :return: list of orcidids
+        """
+        now = get_date()
+        table = RecheckSchedule.__table__
+        with self._engine.begin() as conn:
+            orcidids = [x[0] for x in conn.execute(select([table.c.orcidid])
+                                                   .where(table.c.next_check_at <= now)
+                                                   .order_by(table.c.next_check_at)
+                                                   .limit(limit))]
+            if orcidids:
+                conn.execute(table.update()
+                             .where(and_(table.c.orcidid.in_(orcidids), table.c.next_check_at <= now))
+                             .values(next_check_at=now + datetime.timedelta(seconds=postpone), updated=now))
+        return orcidids
+    
+    
+    @cached(orcid_cache)
     def get_public_orcid_profile(self, orcidid):
-        r = requests.get(self._config.get('API_ORCID_PROFILE_ENDPOINT') % orcidid,
-                     headers={'Accept': 'application/json'})
+        r = self.client.get(self._config.get('API_ORCID_PROFILE_ENDPOINT') % orcidid, endpoint='orcid-public',
+                     conditional=True, headers={'Accept': 'application/json'})
         if r.status_code != 200:
             return None
         else:
             return r.json()
     
-    @cachetools.cached(ads_cache)
+    @cached(ads_cache)
     def get_ads_orcid_profile(self, orcidid):
-        r = requests.get(self._config.get('API_ORCID_EXPORT_PROFILE') % orcidid,
+        r = self.client.get(self._config.get('API_ORCID_EXPORT_PROFILE') % orcidid, endpoint='orcid-service',
+                     conditional=True,
                      headers={'Accept': 'application/json', 'Authorization': 'Bearer:%s' % self._config.get('API_TOKEN')})
         if r.status_code != 200:
             return None
@@ -397,36 +956,130 @@ class ADSOrcidCelery(ADSCelery):
         :sideeffect: Will insert new records (ChangeLog) and also update
          the author instance
         """
+        # when neither of the profiles changed (since we harvested them
+        # the last time), there is nothing new to learn
         try:
-            new_facts = self.harvest_author_info(author.orcidid)
+            responses = self._get_author_profiles(author.orcidid)
+        except Exception, e:
+            self.logger.warning('Failed checking profiles of {0}: {1}'.format(author.orcidid, e))
+            responses = []
+        
+        if responses and not any([self.client.is_changed(r, 'author') for r in responses]):
+            with self.session_scope() as session:
+                author.updated = get_date()
+                aid=author.id
+                session.commit()
+                return session.query(AuthorInfo).filter_by(id=aid).first().toJSON()
+        
+        try:
+            # the facts are built from the very responses we are going to 
+            # acknowledge (the cached profiles could be older)
+            new_facts = self.harvest_author_info(author.orcidid, 
+                            profiles=responses and [r.json() for r in responses] or None)
         except:
             return author.toJSON()
         
-        info = author.toJSON()
         with self.session_scope() as session:
-            old_facts = info['facts']
-            attrs = set(new_facts.keys())
-            attrs = attrs.union(old_facts.keys())
-            is_dirty = False
-            
-            for attname in attrs:
-                if old_facts.get(attname, None) != new_facts.get(attname, None):
-                    session.add(ChangeLog(key=u'{0}:update:{1}'.format(author.orcidid, attname), 
-                               oldvalue=json.dumps(old_facts.get(attname, None)),
-                               newvalue=json.dumps(new_facts.get(attname, None))))
-                    is_dirty = True
-            
-            if bool(author.account_id) != bool(new_facts.get('authorized', False)):
-                author.account_id = new_facts.get('authorized', False) and 1 or None 
-            
-            if is_dirty:
-                author.facts = json.dumps(new_facts)
-                author.name = new_facts.get('name', author.name)
-                aid=author.id
+            self._update_author_facts(session, author, new_facts)
+            # the date of the last harvest (it tells us if the info is fresh)
+            author.updated = get_date()
+            aid=author.id
+            session.commit()
+            for r in responses:
+                self.client.acknowledge(r, 'author')
+            return session.query(AuthorInfo).filter_by(id=aid).first().toJSON()
+    
+    
+    def _get_author_profiles(self, orcidid):
+        """Conditionally fetches the public ORCID profile and the ADS
+        orcid profile (the sources of author info).
+        
+        :return: list of responses (empty if any of them failed)
+        """
+        out = []
+        for url, endpoint, headers in ((self._config.get('API_ORCID_PROFILE_ENDPOINT') % orcidid, 'orcid-public', 
+                                        {'Accept': 'application/json'}),
+                                       (self._config.get('API_ORCID_EXPORT_PROFILE') % orcidid, 'orcid-service',
+                                        {'Accept': 'application/json', 'Authorization': 'Bearer:%s' % self._config.get('API_TOKEN')})):
+            r = self.client.get(url, endpoint=endpoint, conditional=True, headers=headers)
+            if r.status_code != 200:
+                return []
+            out.append(r)
+        return out
+
+
+    def _update_author_facts(self, session, author, new_facts):
+        """Compares the facts we have about the author against the new ones;
+        records the changes (ChangeLog) and updates the author instance.
+        
+        :return: True if the facts changed
+        """
+        old_facts = author.facts and json.loads(author.facts) or {}
+        attrs = set(new_facts.keys())
+        attrs = attrs.union(old_facts.keys())
+        is_dirty = False
+        
+        for attname in attrs:
+            if old_facts.get(attname, None) != new_facts.get(attname, None):
+                session.add(ChangeLog(key=u'{0}:update:{1}'.format(author.orcidid, attname), 
+                           oldvalue=json.dumps(old_facts.get(attname, None)),
+                           newvalue=json.dumps(new_facts.get(attname, None))))
+                is_dirty = True
+        
+        if bool(author.account_id) != bool(new_facts.get('authorized', False)):
+            author.account_id = new_facts.get('authorized', False) and 1 or None 
+        
+        if is_dirty:
+            author.facts = json.dumps(new_facts)
+            author.name = new_facts.get('name', author.name)
+        return is_dirty
+    
+    
+    def save_author_infos(self, infos, batch_size=None):
+        """Writes harvested information about many authors at once
+        (new authors are created, existing ones updated).
+        
+        :param: infos - dict, keys are orcidids, values are dicts
+                returned by harvest_author_info
+        :param: batch_size - int, how many authors are loaded/saved
+                in one transaction (default: HARVEST_BATCH_SIZE)
+        :return: dict with counts of 'created', 'updated', 'unchanged'
+                and 'failed' (no name found for a new author)
+        """
+        batch_size = batch_size or self._config.get('HARVEST_BATCH_SIZE', 500)
+        out = {'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+        orcidids = sorted(infos.keys())
+        
+        with self.session_scope() as session:
+            for i in range(0, len(orcidids), batch_size):
+                chunk = orcidids[i:i+batch_size]
+                existing = {}
+                for author in session.query(AuthorInfo).filter(AuthorInfo.orcidid.in_(chunk)).all():
+                    existing[author.orcidid] = author
+                
+                for orcidid in chunk:
+                    facts = infos[orcidid]
+                    author = existing.get(orcidid, None)
+                    if author is None:
+                        name = names.cleanup_name(facts.get('name', None))
+                        if not name:
+                            self.logger.warning('Cant find an author name for orcid-id: {}'.format(orcidid))
+                            out['failed'] += 1
+                            continue
+                        session.add(AuthorInfo(orcidid=orcidid, name=name, facts=json.dumps(facts), 
+                                               account_id=facts.get('authorized', None) and 1 or None))
+                        out['created'] += 1
+                    else:
+                        if self._update_author_facts(session, author, facts):
+                            out['updated'] += 1
+                        else:
+                            out['unchanged'] += 1
+                        author.updated = get_date()
+                    
+                    # the cached info is stale now
+                    cache.delete(make_key(orcidid))
                 session.commit()
-                return session.query(AuthorInfo).filter_by(id=aid).first().toJSON()
-            else:
-                return info
+        return out
 
 
     def create_orcid(self, orcid, name=None, facts=None):
@@ -456,7 +1109,7 @@ class ADSOrcidCelery(ADSCelery):
         return AuthorInfo(orcidid=orcid, name=name, facts=json.dumps(facts), account_id=facts.get('authorized', None) and 1 or None)
     
     
-    def harvest_author_info(self, orcidid, name=None, facts=None):
+    def harvest_author_info(self, orcidid, name=None, facts=None, profiles=None):
         """
         Does the hard job of querying public and private 
         API's for whatever information we want to collect
@@ -468,6 +1121,9 @@ class ADSOrcidCelery(ADSCelery):
         :param: orcidid - String
         :param: name - String, name of the author (optional)
         :param: facts - dict, info about the author
+        :param: profiles - tuple (public ORCID profile, ADS orcid profile), 
+                if the caller has just fetched them; otherwise they are
+                fetched (or taken from the cache)
         
         :return: dict with various keys: name, author, author_norm, orcid_name
                 (if available)
@@ -476,7 +1132,10 @@ class ADSOrcidCelery(ADSCelery):
         author_data = {}
         
         # first verify the public ORCID profile
-        j = self.get_public_orcid_profile(orcidid)
+        if profiles is not None:
+            j = profiles[0]
+        else:
+            j = self.get_public_orcid_profile(orcidid)
         if j is None:
             self.logger.error('We cant verify public profile of: http://orcid.org/%s' % orcidid)
         else:
@@ -497,12 +1156,13 @@ class ADSOrcidCelery(ADSCelery):
                     
         # search for the orcidid in our database (but only the publisher populated fiels)
         # we can't trust other fiels to bootstrap our database
-        r = requests.get(
+        r = self.client.get(
                     '%(endpoint)s?q=%(query)s&fl=author,author_norm,orcid_pub&rows=100&sort=pubdate+desc' % \
                     {
                      'endpoint': self._config.get('API_SOLR_QUERY_ENDPOINT'),
                      'query' : 'orcid_pub:%s' % names.cleanup_orcidid(orcidid),
                     },
+                    endpoint='solr',
                     headers={'Authorization': 'Bearer %s' % self._config.get('API_TOKEN')})
         
         if r.status_code != 200:
@@ -524,7 +1184,10 @@ class ADSOrcidCelery(ADSCelery):
         # get ADS data about the user
         # 0000-0003-3052-0819 | {"authorizedUser": true, "currentAffiliation": "Australian Astronomical Observatory", "nameVariations": ["Green, Andrew W.", "Green, Andy", "Green, Andy W."]}
     
-        r = self.get_ads_orcid_profile(orcidid)
+        if profiles is not None:
+            r = profiles[1]
+        else:
+            r = self.get_ads_orcid_profile(orcidid)
         if r:
             _author = r
             _info = _author.get('info', {}) or {}
@@ -566,7 +1229,7 @@ class ADSOrcidCelery(ADSCelery):
         return author_data
     
     
-    @cachetools.cached(bibcode_cache) 
+    @cached(bibcode_cache) 
     def retrieve_metadata(self, bibcode, search_identifiers=False):
         """
         From the API retrieve the set of metadata we want to know about the record.
@@ -575,7 +1238,7 @@ class ADSOrcidCelery(ADSCelery):
                 'q': search_identifiers and 'identifier:"{0}"'.format(bibcode) or 'bibcode:"{0}"'.format(bibcode),
                 'fl': 'author,bibcode,identifier'
                 }
-        r = requests.get(self._config.get('API_SOLR_QUERY_ENDPOINT'),
+        r = self.client.get(self._config.get('API_SOLR_QUERY_ENDPOINT'), endpoint='solr',
              params=params,
              headers={'Accept': 'application/json', 'Authorization': 'Bearer:%s' % self._config.get('API_TOKEN')})
         if r.status_code != 200:
@@ -587,7 +1250,6 @@ class ADSOrcidCelery(ADSCelery):
                 return docs[0]
             elif data.get('numFound') == 0:
                 if search_identifiers:
-                    bibcode_cache.setdefault(bibcode, {}) # insert to prevent failed retrievals
                     raise IgnorableException(u'No metadata found for identifier:{0}'.format(bibcode))
                 else:
                     return self.retrieve_metadata(bibcode, search_identifiers=True)
@@ -600,6 +1262,91 @@ class ADSOrcidCelery(ADSCelery):
                         if ir.lower().strip() == bibcode.lower().strip():
                             return d
                 raise IgnorableException(u'More than one document found for {0}'.format(bibcode))
+    
+    
+    def resolve_identifiers(self, identifiers, batch_size=None, rows=None):
+        """
+        Translates many identifiers (bibcodes, dois, arxiv ids...) into
+        ADS records; instead of sending one query per identifier, we'll 
+        search for a batch of them at once, i.e. identifier:("x" OR "y" ...)
+        and map the returned docs back onto the identifiers.
+        
+        :param: identifiers - iterable of strings
+        :param: batch_size - int, how many identifiers go into one query
+                (default: ORCID_IDENTIFIERS_BATCH_SIZE)
+        :param: rows - int, how many docs to ask for (per query); it should be
+                comfortably bigger than the batch size (default: 
+                ORCID_IDENTIFIERS_BATCH_ROWS)
+        
+        :return: dict, keys are the identifiers (as they were passed in) and
+                values are docs (with the same fields as retrieve_metadata);
+                identifiers that could not be resolved (nothing found or the
+                result is ambiguous - the same rules as in retrieve_metadata)
+                are not present
+        :raise: Exception when the API fails (we never return partial results,
+                the missing identifiers would look like removed claims)
+        """
+        batch_size = batch_size or self._config.get('ORCID_IDENTIFIERS_BATCH_SIZE', 100)
+        rows = rows or self._config.get('ORCID_IDENTIFIERS_BATCH_ROWS', 2000)
+        
+        identifiers = sorted(set([x for x in identifiers if x and x.strip()]))
+        out = {}
+        batches = [identifiers[i:i+batch_size] for i in range(0, len(identifiers), batch_size)]
+        
+        while batches:
+            batch = batches.pop(0)
+            
+            # normalized form -> list of original values
+            wanted = {}
+            for x in batch:
+                wanted.setdefault(_normalize_identifier(x), []).append(x)
+            
+            params = {
+                'q': 'identifier:({0})'.format(' OR '.join(['"{0}"'.format(x.strip().replace('"', '\\"')) for x in batch])),
+                'fl': 'author,bibcode,identifier',
+                'rows': rows
+                }
+            r = self.client.get(self._config.get('API_SOLR_QUERY_ENDPOINT'), endpoint='solr',
+                 params=params,
+                 headers={'Accept': 'application/json', 'Authorization': 'Bearer:%s' % self._config.get('API_TOKEN')})
+            if r.status_code != 200:
+                raise Exception('{}\n{}\n{}'.format(r.status_code, params, r.text))
+            
+            data = r.json().get('response', {})
+            docs = data.get('docs', [])
+            if data.get('numFound', 0) > len(docs) and len(batch) > 1:
+                # we didn't get all of them; split the batch
+                self.logger.warning('Batch of {0} identifiers found {1} docs, but we got only {2}; splitting it'.format(
+                    len(batch), data.get('numFound'), len(docs)))
+                half = len(batch) / 2
+                batches[0:0] = [batch[:half], batch[half:]]
+                continue
+            
+            # all docs found for the identifier
+            found = {}
+            for d in docs:
+                keys = set([_normalize_identifier(x) for x in d.get('identifier', []) or []])
+                if d.get('bibcode'):
+                    keys.add(_normalize_identifier(d['bibcode']))
+                for k in keys:
+                    for x in wanted.get(k, []):
+                        found.setdefault(x, []).append(d)
+            
+            for x, candidates in found.items():
+                if len(candidates) == 1:
+                    out[x] = candidates[0]
+                elif len(candidates) > 10:
+                    self.logger.warning(u'Insane num of results for {0} ({1})'.format(x, len(candidates)))
+                else:
+                    # several documents: only the one with exactly the same identifier
+                    for d in candidates:
+                        if x.lower().strip() in [ir.lower().strip() for ir in (d.get('identifier', []) or []) + [d.get('bibcode') or '']]:
+                            out[x] = d
+                            break
+                    else:
+                        self.logger.warning(u'More than one document found for {0}'.format(x))
+        
+        return out
         
     
     
@@ -612,14 +1359,15 @@ class ADSOrcidCelery(ADSCelery):
             if r is None:
                 r = Records(bibcode=bibcode)
                 session.add(r)
-            out = r.toJSON()
             
             metadata = self.retrieve_metadata(bibcode)
             authors = metadata.get('author', [])
             
-            if out.get('authors') != authors:
-                r.authors = json.dumps(authors)
-                out['authors'] = authors
+            # compare hashes; the stored authors don't need to be decoded
+            if r.authors_hash != authors_hash(authors):
+                r.authors = authors
+            out = r.toJSON(exclude=('authors',))
+            out['authors'] = authors
             
             session.commit()
             return out
@@ -653,17 +1401,72 @@ class ADSOrcidCelery(ADSCelery):
                             authors=authors
                             )
                 session.add(r)
-                self.logger.debug('Inserting record %s', r.toJSON())
+                self.logger.debug('Inserting record %s: %s', bibcode, claims)
             else:
                 r.updated = get_date()
                 r.claims = claims
                 if authors:
                     r.authors = authors
                 session.merge(r)
-                self.logger.debug('Updating record %s', r.toJSON())
+                self.logger.debug('Updating record %s: %s', bibcode, claims)
             session.commit()
 
 
+    def buffer_claim(self, claim):
+        """Saves the claim into the buffer (of claims that wait to be
+        applied to their record).
+        
+        :param: claim - dict, has to contain bibcode
+        :return: tuple (number of claims waiting for the bibcode,
+                bool - True if this claim is the oldest one)
+        """
+        with self.session_scope() as session:
+            c = PendingClaims(bibcode=claim['bibcode'], payload=json.dumps(claim))
+            session.add(c)
+            session.commit()
+            cid = c.id
+            num, oldest = session.query(func.count(PendingClaims.id), func.min(PendingClaims.id)) \
+                .filter(PendingClaims.bibcode == claim['bibcode']).first()
+            return num, oldest == cid
+    
+    
+    def get_pending_claims(self, bibcode):
+        """Returns claims waiting for the bibcode (oldest first).
+        
+        :return: tuple (list of ids, list of claims)
+        """
+        with self.session_scope() as session:
+            rows = session.query(PendingClaims).filter(PendingClaims.bibcode == bibcode) \
+                .order_by(PendingClaims.id.asc()).all()
+            return [r.id for r in rows], [r.toJSON() for r in rows]
+    
+    
+    def count_pending_claims(self, bibcode):
+        """:return: number of claims waiting for the bibcode"""
+        with self.session_scope() as session:
+            return session.query(func.count(PendingClaims.id)) \
+                .filter(PendingClaims.bibcode == bibcode).scalar()
+    
+    
+    def remove_pending_claims(self, ids):
+        """Removes (processed) claims from the buffer.
+        
+        :return: number of claims still waiting for the same bibcode(s)
+        """
+        if not ids:
+            return 0
+        with self.session_scope() as session:
+            bibcodes = [x[0] for x in session.query(PendingClaims.bibcode.distinct()) \
+                        .filter(PendingClaims.id.in_(ids)).all()]
+            session.query(PendingClaims).filter(PendingClaims.id.in_(ids)) \
+                .delete(synchronize_session=False)
+            session.commit()
+            if not bibcodes:
+                return 0
+            return session.query(func.count(PendingClaims.id)) \
+                .filter(PendingClaims.bibcode.in_(bibcodes)).scalar()
+    
+    
     def mark_processed(self, bibcode):
         """Updates the date on which the record has been processed (i.e.
         something has consumed it
@@ -680,4 +1483,44 @@ class ADSOrcidCelery(ADSCelery):
                 raise IgnorableException('Nonexistant record for {0}'.format(bibcode))
             r.processed = get_date()
             session.commit()
-            return True   
\ No newline at end of file
+            return True   
+    
+    
+    def iter_records(self, since, batch_size=None, last_id=None):
+        """Reads records updated since the given date; the records
+        are read in batches (ordered by date of update and id), so the
+        memory footprint doesn't depend on the number of records.
+        
+        :param: since - RFC3339 formatted string/datetime
+        :param: batch_size - int, number of records per batch (default:
+                REPUSH_BATCH_SIZE)
+        :param: last_id - int, if present, records updated exactly
+                at `since` are returned only if their id is higher
+                (i.e. we continue after the record last_id)
+        :return: generator of lists of dicts with 'id', 'bibcode',
+                'authors', 'claims' and 'updated'
+        """
+        batch_size = batch_size or self._config.get('REPUSH_BATCH_SIZE', 1000)
+        last_updated = get_date(since)
+        
+        while True:
+            with self.session_scope() as session:
+                q = session.query(Records.id, Records.bibcode, Records.authors_z, Records.claims, Records.updated)
+                if last_id is None:
+                    q = q.filter(Records.updated >= last_updated)
+                else:
+                    q = q.filter(or_(Records.updated > last_updated,
+                                     and_(Records.updated == last_updated, Records.id > last_id)))
+                rows = q.order_by(Records.updated.asc(), Records.id.asc()).limit(batch_size).all()
+            
+            if not rows:
+                break
+            
+            yield [{'id': r.id, 'bibcode': r.bibcode,
+                    'authors': decompress_authors(r.authors_z),
+                    'claims': r.claims and json.loads(r.claims) or {},
+                    'updated': get_date(r.updated).isoformat()} for r in rows]
+            
+            last_updated, last_id = rows[-1].updated, rows[-1].id
+            if len(rows) < batch_size:
+                break
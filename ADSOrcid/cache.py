@@ -0,0 +1,360 @@
+"""
+Caches used by the application.
+
+The caches are module-level objects (so that they can be used in
+decorators) but their storage is pluggable:
+
+    memory - in-process LRU cache with TTL (every worker has its own copy)
+    sqlite - file-backed store, shared by all workers on the same host
+    redis  - networked key-value store, shared by all workers everywhere
+
+The backend is selected with CACHE_BACKEND and can be overriden (together
+with 'maxsize' and 'ttl') for every cache in CACHE_SETTINGS.
+"""
+
+import cachetools
+import cPickle as pickle
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+_missing = object()
+
+# all caches that were created (and which will be configured by
+# configure_caches)
+_registry = {}
+
+
+
+class Cache(object):
+    """Cache with swappable storage; before it gets configured, it
+    keeps values in memory. Unless register=False, the cache gets 
+    configured by configure_caches (and reported by all_stats) until
+    it is unregistered."""
+
+    def __init__(self, name, maxsize=1024, ttl=3600, register=True):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = MemoryBackend(maxsize=maxsize, ttl=ttl)
+        self.hits = self.misses = 0
+        if register:
+            _registry[name] = self
+
+
+    def unregister(self):
+        if _registry.get(self.name, None) is self:
+            del _registry[self.name]
+
+
+    def configure(self, backend='memory', maxsize=None, ttl=None, **kwargs):
+        """Replaces the storage of the cache.
+
+        :param: backend - str, one of: memory, sqlite, redis
+        :param: maxsize - int, max number of entries
+        :param: ttl - int, number of seconds the entries are valid
+        :param: kwargs - passed to the backend (e.g. path, url)
+        """
+        self.maxsize = maxsize or self.maxsize
+        self.ttl = ttl or self.ttl
+        if backend not in BACKENDS:
+            raise Exception('Unknown cache backend: {0}'.format(backend))
+        self.backend = BACKENDS[backend](namespace=self.name, maxsize=self.maxsize,
+                                         ttl=self.ttl, **kwargs)
+
+
+    def get(self, key, default=None):
+        v = self.backend.get(key, _missing)
+        if v is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return v
+
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+
+    def stats(self):
+        """:return: dict with hits, misses and evictions (number of entries 
+        removed to make space; not tracked by redis backend)"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': getattr(self.backend, 'evictions', 0)}
+
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+
+    def clear(self):
+        self.backend.clear()
+
+
+    def __contains__(self, key):
+        return self.backend.get(key, _missing) is not _missing
+
+
+
+def make_key(*args, **kwargs):
+    """Serializes arguments into a string that can be used as a key
+    by all the backends (str/unicode of the same value give the same key)"""
+    return json.dumps([args, kwargs], sort_keys=True, default=repr)
+
+
+
+def cached(cache):
+    """Decorator for methods; the results will be stored in the cache
+    (the first argument - i.e. self - is not part of the key)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            k = make_key(*args, **kwargs)
+            v = cache.get(k, _missing)
+            if v is not _missing:
+                return v
+            v = func(self, *args, **kwargs)
+            cache.set(k, v)
+            return v
+        return wrapper
+    return decorator
+
+
+
+def configure_caches(config):
+    """Sets up all the caches according to the configuration
+
+    :param: config - dict, we'll read:
+        CACHE_BACKEND - str, default backend
+        CACHE_SETTINGS - dict, keyed by the cache name; values are
+            dicts with 'backend', 'maxsize', 'ttl'
+        CACHE_SQLITE_PATH - str, location of the sqlite database
+        CACHE_REDIS_URL - str, e.g. redis://localhost:6379/0
+    """
+    default = config.get('CACHE_BACKEND', 'memory')
+    settings = config.get('CACHE_SETTINGS', {}) or {}
+    for name, c in _registry.items():
+        opts = dict(settings.get(name, {}))
+        backend = opts.pop('backend', default)
+        if backend == 'sqlite':
+            opts.setdefault('path', get_sqlite_path(config))
+        elif backend == 'redis':
+            opts.setdefault('url', config.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+        c.configure(backend=backend, **opts)
+
+
+
+def get_sqlite_path(config):
+    """:return: location of the sqlite database (CACHE_SQLITE_PATH, 
+    by default PROJ_HOME/cache.sqlite)"""
+    return config.get('CACHE_SQLITE_PATH', None) or \
+        os.path.join(config.get('PROJ_HOME', '.'), 'cache.sqlite')
+
+
+
+def redis_client(url):
+    """:return: redis client connected to the url"""
+    try:
+        import redis
+    except ImportError:
+        raise Exception('The redis backend needs the redis package (pip install redis)')
+    return redis.StrictRedis.from_url(url)
+
+
+
+class SqliteConnection(object):
+    """Connection to the sqlite database (opened on demand, every
+    process gets its own); the schema statements are executed when
+    the connection is opened."""
+
+    def __init__(self, path, *schema):
+        self.path = path
+        self.schema = schema
+        self._pid = None
+        self._conn = None
+
+
+    def get(self):
+        # sqlite connections must not cross the fork boundary
+        if self._conn is None or self._pid != os.getpid():
+            d = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(d):
+                os.makedirs(d)
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            for stmt in self.schema:
+                self._conn.execute(stmt)
+            self._pid = os.getpid()
+        return self._conn
+
+
+
+def clear_all():
+    for c in _registry.values():
+        c.clear()
+
+
+
+def all_stats():
+    """:return: dict of stats, keyed by name of the cache"""
+    return dict([(name, c.stats()) for name, c in _registry.items()])
+
+
+
+class _TTLCache(cachetools.TTLCache):
+    """Counts entries evicted for lack of space"""
+
+    evictions = 0
+
+    def popitem(self):
+        self.evictions += 1
+        return cachetools.TTLCache.popitem(self)
+
+
+
+class MemoryBackend(object):
+    """In-process LRU cache with TTL (thread-safe)."""
+
+    def __init__(self, namespace=None, maxsize=1024, ttl=3600):
+        self._cache = _TTLCache(maxsize=maxsize, ttl=ttl, timer=time.time)
+        self._lock = threading.RLock()
+
+    @property
+    def evictions(self):
+        return self._cache.evictions
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                return self._cache[key]
+            except KeyError:
+                return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def delete(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+
+class SqliteBackend(object):
+    """Cache stored in a sqlite database; all processes (on the same
+    machine) that use the same file will see the same values. When
+    the number of entries grows over the limit, we'll remove the oldest
+    ones."""
+
+    def __init__(self, namespace='cache', maxsize=1024, ttl=3600, path=None,
+                 purge_every=100):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.purge_every = purge_every
+        self._conn = SqliteConnection(path, 
+            'CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, '
+            'value BLOB, expires REAL, PRIMARY KEY (namespace, key))',
+            'CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (namespace, expires)')
+        self._writes = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+
+    def _get_conn(self):
+        return self._conn.get()
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._get_conn().execute('SELECT value FROM cache WHERE namespace=? AND key=? AND expires>?',
+                                           (self.namespace, key, time.time())).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(str(row[0]))
+
+
+    def set(self, key, value):
+        v = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute('INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)',
+                         (self.namespace, key, v, time.time() + self.ttl))
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self.purge()
+
+
+    def purge(self):
+        """Removes expired entries and trims the cache to its maxsize."""
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute('DELETE FROM cache WHERE namespace=? AND expires<=?', (self.namespace, time.time()))
+            c = conn.execute('DELETE FROM cache WHERE namespace=? AND key IN (SELECT key FROM cache WHERE namespace=? '
+                             'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.namespace, self.namespace, self.maxsize))
+            self.evictions += max(c.rowcount, 0)
+
+
+    def delete(self, key):
+        with self._lock:
+            self._get_conn().execute('DELETE FROM cache WHERE namespace=? AND key=?', (self.namespace, key))
+
+
+    def clear(self):
+        with self._lock:
+            self._get_conn().execute('DELETE FROM cache WHERE namespace=?', (self.namespace,))
+
+
+
+class RedisBackend(object):
+    """Cache stored in redis (shared by all workers, on all machines);
+    the size of the cache is governed by the redis server (maxmemory
+    policy), we only set the TTL."""
+
+    def __init__(self, namespace='cache', maxsize=1024, ttl=3600, url=None, client=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.client = client or redis_client(url)
+
+
+    def _key(self, key):
+        return '{0}:{1}'.format(self.namespace, key)
+
+
+    def get(self, key, default=None):
+        v = self.client.get(self._key(key))
+        if v is None:
+            return default
+        return pickle.loads(v)
+
+
+    def set(self, key, value):
+        self.client.setex(self._key(key), int(self.ttl), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match='{0}:*'.format(self.namespace)))
+        if keys:
+            self.client.delete(*keys)
+
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'sqlite': SqliteBackend,
+    'redis': RedisBackend
+}
@@ -0,0 +1,353 @@
+"""
+HTTP client used for all the outbound calls (ADS API, orcid-service,
+public ORCID API).
+
+It keeps one pool of (keep-alive) connections per endpoint, applies
+timeouts, retries failed requests (with exponential backoff and honouring
+'Retry-After'), limits number of parallel requests sent to an endpoint
+(when used from many threads), limits the rate of requests (shared by
+all workers, see ADSOrcid.ratelimit) and collects simple statistics
+about every endpoint.
+
+GET requests can be made conditional: responses are kept in a (persistent)
+cache together with their ETag, Last-Modified and digest of the content;
+next time we ask the server only for a newer version (If-None-Match,
+If-Modified-Since) and when it answers '304 Not Modified', the response
+is rebuilt from the cache. Consumers of the response can 'acknowledge'
+that they have processed it, and later find out whether the content
+changed since then (is_changed).
+"""
+
+from email.utils import parsedate_tz, mktime_tz
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import hashlib
+import os
+import requests
+import threading
+import time
+import urlparse
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HttpClient(object):
+
+    def __init__(self, connect_timeout=5.0, read_timeout=30.0, max_retries=3,
+                 backoff_factor=0.5, max_backoff=60.0, pool_size=10,
+                 retry_statuses=RETRY_STATUSES, concurrency=None, response_cache=None,
+                 logger=None, metrics=None, rate_limiter=None):
+        """
+        :param: connect_timeout - float, seconds to wait for a connection
+        :param: read_timeout - float, seconds to wait for the response
+        :param: max_retries - int, how many times a failed request is repeated
+        :param: backoff_factor - float, the n-th retry waits backoff_factor * 2**n
+                seconds (unless the server tells us, via 'Retry-After', how long to wait)
+        :param: max_backoff - float, we'll never sleep longer than this
+        :param: pool_size - int, max number of connections kept open per endpoint
+        :param: retry_statuses - list of http codes that will be retried
+        :param: concurrency - dict, max number of requests that can be in flight
+                (for the given endpoint) at the same time; the key '*' applies to
+                endpoints that are not listed; None means no limit
+        :param: response_cache - ADSOrcid.cache.Cache instance, used by conditional
+                requests
+        :param: metrics - ADSOrcid.metrics.Metrics instance; latency of every
+                request is recorded there (per endpoint)
+        :param: rate_limiter - ADSOrcid.ratelimit.RateLimiter instance; every
+                request (including the retries) has to get a token from it
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.retry_statuses = set(retry_statuses or [])
+        self.concurrency = dict(concurrency or {})
+        self.response_cache = response_cache
+        self.logger = logger
+        self.metrics = metrics
+        self.rate_limiter = rate_limiter
+
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._sessions = {}
+        self._semaphores = {}
+        self._stats = {}
+
+
+    def get(self, url, endpoint=None, conditional=False, **kwargs):
+        """Issues GET request; accepts the same arguments as requests.get
+
+        :param: endpoint - str, name under which the statistics are
+            collected (and connections pooled); default is the host name
+        :param: conditional - bool, if True (and there is a response cache)
+            we'll only download the content if it changed
+        :return: requests.Response
+        """
+        if conditional and self.response_cache is not None:
+            return self._conditional_get(url, endpoint=endpoint, **kwargs)
+        return self.request('GET', url, endpoint=endpoint, **kwargs)
+
+
+    def is_changed(self, response, consumer='default'):
+        """Tells whether the content of the response (of a conditional 
+        request) changed since the consumer acknowledged it.
+
+        :return: bool (True also for responses that weren't cached)
+        """
+        digest = getattr(response, 'digest', None)
+        if digest is None:
+            return True
+        return response.acknowledged.get(consumer, None) != digest
+
+
+    def acknowledge(self, response, consumer='default'):
+        """Records that the consumer has processed the response (of
+        a conditional request); until the content changes, is_changed 
+        will return False for this consumer."""
+        key = getattr(response, 'cache_key', None)
+        if key is None or self.response_cache is None:
+            return
+        entry = self.response_cache.get(key, None)
+        if entry is not None and entry['digest'] == response.digest:
+            entry['acknowledged'][consumer] = response.digest
+            self.response_cache.set(key, entry)
+        response.acknowledged[consumer] = response.digest
+
+
+    def _conditional_get(self, url, endpoint=None, **kwargs):
+        key = requests.Request('GET', url, params=kwargs.get('params', None)).prepare().url
+        entry = self.response_cache.get(key, None)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        r = self.request('GET', url, endpoint=endpoint, headers=headers, **kwargs)
+
+        if r.status_code == 304 and entry is not None:
+            r.close()
+            r = self._from_cache(url, entry)
+        elif r.status_code == 200:
+            digest = hashlib.sha1(r.content).hexdigest()
+            # acknowledgements are valid only for the same content
+            acknowledged = {}
+            if entry is not None and entry['digest'] == digest:
+                acknowledged = entry.get('acknowledged', {})
+            entry = {'etag': r.headers.get('ETag', None),
+                     'last_modified': r.headers.get('Last-Modified', None),
+                     'digest': digest,
+                     'content': r.content,
+                     'encoding': r.encoding,
+                     'content_type': r.headers.get('Content-Type', None),
+                     'acknowledged': acknowledged}
+            self.response_cache.set(key, entry)
+            r.from_cache = False
+        else:
+            return r
+
+        r.cache_key = key
+        r.digest = entry['digest']
+        r.acknowledged = dict(entry['acknowledged'])
+        return r
+
+
+    def _from_cache(self, url, entry):
+        r = requests.models.Response()
+        r.status_code = 200
+        r.url = url
+        r._content = entry['content']
+        r.encoding = entry['encoding']
+        r.headers = CaseInsensitiveDict()
+        if entry.get('content_type'):
+            r.headers['Content-Type'] = entry['content_type']
+        r.from_cache = True
+        return r
+
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        """Issues a request (retrying it when necessary).
+
+        Connection errors are re-raised after the last attempt; responses
+        with an error code are returned to the caller (who is expected
+        to check the status code).
+        """
+        endpoint = endpoint or urlparse.urlparse(url).netloc
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        session = self._get_session(endpoint)
+        semaphore = self._get_semaphore(endpoint)
+
+        attempt = 0
+        while True:
+            self._throttle(endpoint)
+            start = time.time()
+            try:
+                if semaphore is None:
+                    r = session.request(method, url, **kwargs)
+                else:
+                    with semaphore:
+                        r = session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                self._record(endpoint, None, time.time() - start)
+                if attempt >= self.max_retries:
+                    raise
+                wait = self._get_backoff(attempt)
+                if self.logger:
+                    self.logger.warning('Error talking to {0} ({1}), retry in {2}s'.format(endpoint, e, wait))
+            else:
+                self._record(endpoint, r.status_code, time.time() - start)
+                if self.rate_limiter is not None:
+                    retry_after = r.headers.get('Retry-After')
+                    self.rate_limiter.feedback(endpoint, r.status_code,
+                                               retry_after and parse_retry_after(retry_after) or None)
+                if r.status_code not in self.retry_statuses or attempt >= self.max_retries:
+                    return r
+                wait = self._get_backoff(attempt, r.headers.get('Retry-After'))
+                if self.logger:
+                    self.logger.warning('{0} returned {1}, retry in {2}s'.format(endpoint, r.status_code, wait))
+                r.close()
+
+            attempt += 1
+            self._record_retry(endpoint)
+            time.sleep(wait)
+
+
+    def stats(self):
+        """Returns statistics collected for every endpoint
+
+        :return: dict, keyed by endpoint name; values are dicts with:
+            calls - number of requests (including the retried ones)
+            errors - number of requests that failed to get any response
+            retries - number of retried requests
+            throttled - time spent waiting for the rate limiter (secs)
+            time - total time spent waiting for responses (secs)
+            max_time - the slowest request (secs)
+            status - dict of http codes and their counts
+        """
+        with self._lock:
+            out = {}
+            for k, v in self._stats.items():
+                out[k] = dict(v)
+                out[k]['status'] = dict(v['status'])
+            return out
+
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+
+    def close(self):
+        """Closes all the open connections."""
+        with self._lock:
+            for s in self._sessions.values():
+                s.close()
+            self._sessions = {}
+
+
+    def _get_session(self, endpoint):
+        with self._lock:
+            # celery forks its workers; connections must not be shared
+            # between processes
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._stats = {}
+                self._pid = os.getpid()
+            s = self._sessions.get(endpoint, None)
+            if s is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=max(self.pool_size, self._get_limit(endpoint) or 0))
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                self._sessions[endpoint] = s
+            return s
+
+
+    def _get_limit(self, endpoint):
+        return self.concurrency.get(endpoint, self.concurrency.get('*', None))
+
+
+    def _get_semaphore(self, endpoint):
+        limit = self._get_limit(endpoint)
+        if not limit:
+            return None
+        with self._lock:
+            s = self._semaphores.get(endpoint, None)
+            if s is None:
+                s = threading.BoundedSemaphore(limit)
+                self._semaphores[endpoint] = s
+            return s
+
+
+    def _get_backoff(self, attempt, retry_after=None):
+        if retry_after:
+            wait = parse_retry_after(retry_after)
+            if wait is not None:
+                return min(wait, self.max_backoff)
+        return min(self.backoff_factor * (2 ** attempt), self.max_backoff)
+
+
+    def _stats_for(self, endpoint):
+        s = self._stats.get(endpoint, None)
+        if s is None:
+            s = {'calls': 0, 'errors': 0, 'retries': 0, 'time': 0.0, 'max_time': 0.0, 'throttled': 0.0,
+                 'status': {}}
+            self._stats[endpoint] = s
+        return s
+
+
+    def _record(self, endpoint, status_code, elapsed):
+        with self._lock:
+            s = self._stats_for(endpoint)
+            s['calls'] += 1
+            s['time'] += elapsed
+            s['max_time'] = max(s['max_time'], elapsed)
+            if status_code is None:
+                s['errors'] += 1
+            else:
+                s['status'][status_code] = s['status'].get(status_code, 0) + 1
+        if self.metrics is not None:
+            self.metrics.observe('http_request_duration_seconds', elapsed, endpoint=endpoint)
+            self.metrics.inc('http_requests_total', endpoint=endpoint, status=status_code or 'error')
+
+
+    def _throttle(self, endpoint):
+        if self.rate_limiter is None:
+            return
+        waited = self.rate_limiter.acquire(endpoint)
+        if waited:
+            with self._lock:
+                self._stats_for(endpoint)['throttled'] += waited
+        if self.metrics is not None:
+            self.metrics.observe('http_throttle_seconds', waited, endpoint=endpoint)
+
+
+    def _record_retry(self, endpoint):
+        with self._lock:
+            self._stats_for(endpoint)['retries'] += 1
+        if self.metrics is not None:
+            self.metrics.inc('http_retries_total', endpoint=endpoint)
+
+
+
+def parse_retry_after(value):
+    """Parses value of the 'Retry-After' header (which is either number
+    of seconds, or http date).
+
+    :return: float (seconds to wait) or None
+    """
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    d = parsedate_tz(value)
+    if d is None:
+        return None
+    return max(0.0, mktime_tz(d) - time.time())
@@ -0,0 +1,84 @@
+"""
+Bulk harvesting of information about authors.
+
+The information about every author comes from three API calls (public
+ORCID bio, ADS orcid profile and SOLR search for orcid_pub), see
+app.harvest_author_info. Doing that serially for hundreds of thousands
+of authors takes days; the harvester runs it from a pool of threads
+(the number of requests in flight per endpoint is limited by the http
+client, HTTP_CONCURRENCY) and writes the results into the database
+in batches.
+"""
+
+from multiprocessing.pool import ThreadPool
+import time
+
+
+class Harvester(object):
+
+    def __init__(self, app, threads=None, batch_size=None):
+        """
+        :param: app - ADSOrcidCelery instance
+        :param: threads - int, number of parallel workers (default: HARVEST_THREADS)
+        :param: batch_size - int, number of authors saved at once (default: HARVEST_BATCH_SIZE)
+        """
+        self.app = app
+        self.threads = threads or app.conf.get('HARVEST_THREADS', 16)
+        self.batch_size = batch_size or app.conf.get('HARVEST_BATCH_SIZE', 500)
+        self.logger = app.logger
+
+
+    def _fetch_one(self, orcidid):
+        try:
+            return orcidid, self.app.harvest_author_info(orcidid), None
+        except Exception, e:
+            return orcidid, None, e
+
+
+    def fetch(self, orcidids):
+        """Harvests info about the authors (in parallel); it is a generator.
+
+        :param: orcidids - iterable of orcid ids (can be a generator)
+        :return: yields tuples (orcidid, info, error); info is a dict
+            (the same as returned by harvest_author_info) or None if the
+            harvest failed (error is the exception)
+        """
+        pool = ThreadPool(self.threads)
+        try:
+            for x in pool.imap_unordered(self._fetch_one, orcidids, chunksize=1):
+                yield x
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def harvest(self, orcidids):
+        """Harvests info about the authors and saves it into the database.
+
+        :param: orcidids - iterable of orcid ids
+        :return: dict with counts: harvested, errors, created, updated,
+            unchanged, failed
+        """
+        stats = {'harvested': 0, 'errors': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+        batch = {}
+        start = time.time()
+
+        def save():
+            for k, v in self.app.save_author_infos(batch, batch_size=self.batch_size).items():
+                stats[k] += v
+            batch.clear()
+            self.logger.info('Harvested {0} authors ({1:.1f}/sec), errors: {2}'.format(
+                stats['harvested'], stats['harvested'] / max(time.time() - start, 0.001), stats['errors']))
+
+        for orcidid, info, error in self.fetch(orcidids):
+            if error is not None:
+                stats['errors'] += 1
+                self.logger.warning('Failed harvesting {0}: {1}'.format(orcidid, error))
+                continue
+            stats['harvested'] += 1
+            batch[orcidid] = info
+            if len(batch) >= self.batch_size:
+                save()
+        if batch:
+            save()
+        return stats
@@ -0,0 +1,230 @@
+"""
+Counters and histograms (durations of tasks, http calls, db sessions,
+statistics of caches) exposed in the Prometheus text format.
+
+Every process keeps its own numbers; they can be rendered (render) or
+written into a directory read by the textfile collector of the node
+exporter (write_textfile). Since celery runs several processes, every
+process writes its own file and marks its samples with the label
+'process' (pid; so that the series don't clash). Files of processes
+that are gone are removed when a process writes its file for the
+first time.
+"""
+
+from contextlib import contextmanager
+import errno
+import os
+import re
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(['{0}="{1}"'.format(k, _escape(v)) for k, v in labels]) + '}'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM # it exists, but it isn't ours
+    return True
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+
+class Metrics(object):
+
+    def __init__(self, namespace='adsorcid', const_labels=None):
+        """
+        :param: namespace - str, prefix of all the metric names
+        :param: const_labels - dict, labels added to every sample
+        """
+        self.namespace = namespace
+        self.const_labels = dict(const_labels or {})
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._collectors = []
+        self._last_write = 0
+        self._cleaned_pid = None
+
+
+    def describe(self, name, kind, help='', buckets=DEFAULT_BUCKETS):
+        """Declares a metric (kind is 'counter', 'gauge' or 'histogram');
+        metrics that weren't declared are created as counters (inc),
+        gauges (set) or histograms (observe) when first used."""
+        with self._lock:
+            self._meta[name] = {'kind': kind, 'help': help, 'buckets': tuple(sorted(buckets))}
+
+
+    def inc(self, name, value=1, **labels):
+        """Increments a counter"""
+        with self._lock:
+            series = self._series(name, 'counter', labels)
+            series[0] = series[0] + value
+
+
+    def set(self, name, value, **labels):
+        """Sets value of a gauge"""
+        with self._lock:
+            self._series(name, 'gauge', labels)[0] = value
+
+
+    def observe(self, name, value, **labels):
+        """Records an observation (e.g. duration in seconds) in a histogram"""
+        with self._lock:
+            series = self._series(name, 'histogram', labels)
+            buckets = self._meta[name]['buckets']
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Measures duration of the block (into a histogram)"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+
+    def register_collector(self, collector):
+        """Adds function that is called when the metrics are rendered; it
+        returns list of tuples (name, kind, help, [(labels dict, value), ...])
+        (used for numbers that are kept elsewhere, e.g. stats of caches)"""
+        with self._lock:
+            self._collectors.append(collector)
+
+
+    def get(self, name, **labels):
+        """Returns the current value of a counter/gauge (or the list of
+        [bucket counts..., sum, count] of a histogram); None if missing"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.get(name, {}).get(key, None)
+            if series is None:
+                return None
+            if self._meta[name]['kind'] == 'histogram':
+                return list(series)
+            return series[0]
+
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+    def render(self, extra_labels=None):
+        """:param: extra_labels - dict, labels added to every sample
+        :return: str, all metrics in the Prometheus text format"""
+        const_labels = sorted(dict(self.const_labels, **(extra_labels or {})).items())
+        lines = []
+        with self._lock:
+            for name in sorted(self._values.keys()):
+                meta = self._meta[name]
+                full = '{0}_{1}'.format(self.namespace, name)
+                lines.append('# HELP {0} {1}'.format(full, meta['help'] or name))
+                lines.append('# TYPE {0} {1}'.format(full, meta['kind']))
+                for key in sorted(self._values[name].keys()):
+                    series = self._values[name][key]
+                    labels = const_labels + list(key)
+                    if meta['kind'] != 'histogram':
+                        lines.append('{0}{1} {2}'.format(full, _format_labels(labels), _format_value(series[0])))
+                        continue
+                    for le, count in zip(meta['buckets'] + (float('inf'),), series[:-2] + [series[-1]]):
+                        lines.append('{0}_bucket{1} {2}'.format(
+                            full, _format_labels(labels + [('le', _format_value(le))]), _format_value(count)))
+                    lines.append('{0}_sum{1} {2}'.format(full, _format_labels(labels), _format_value(series[-2])))
+                    lines.append('{0}_count{1} {2}'.format(full, _format_labels(labels), _format_value(series[-1])))
+            collectors = list(self._collectors)
+
+        for collector in collectors:
+            for name, kind, help, samples in collector():
+                full = '{0}_{1}'.format(self.namespace, name)
+                lines.append('# HELP {0} {1}'.format(full, help or name))
+                lines.append('# TYPE {0} {1}'.format(full, kind))
+                for labels, value in samples:
+                    labels = const_labels + sorted(labels.items())
+                    lines.append('{0}{1} {2}'.format(full, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+    def write_textfile(self, directory, interval=0):
+        """Writes the metrics into <directory>/<namespace>_<pid>.prom (for
+        the textfile collector of the node exporter)
+
+        :param: interval - int, seconds; the file is not written more
+            often than this (the call is then a no-op)
+        :return: path of the file (None if nothing was written)
+        """
+        now = time.time()
+        if interval and now - self._last_write < interval:
+            return None
+        self._last_write = now
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if self._cleaned_pid != os.getpid():
+            self.remove_stale_textfiles(directory)
+            self._cleaned_pid = os.getpid()
+        path = os.path.join(directory, '{0}_{1}.prom'.format(self.namespace, os.getpid()))
+        # the collector must never see a half-written file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render({'process': os.getpid()}).encode('utf8'))
+        os.rename(tmp, path)
+        return path
+
+
+    def remove_stale_textfiles(self, directory):
+        """Removes the files (see write_textfile) of the processes that
+        are gone; otherwise their series would be exported for ever
+
+        :return: list of removed paths
+        """
+        removed = []
+        pattern = re.compile(r'^{0}_(\d+)\.prom(\.tmp)?$'.format(re.escape(self.namespace)))
+        for fname in os.listdir(directory):
+            m = pattern.match(fname)
+            if m is None or _pid_alive(int(m.group(1))):
+                continue
+            path = os.path.join(directory, fname)
+            try:
+                os.remove(path)
+                removed.append(path)
+            except OSError:
+                pass # somebody else removed it
+        return removed
+
+
+    def _series(self, name, kind, labels):
+        meta = self._meta.get(name, None)
+        if meta is None:
+            meta = self._meta[name] = {'kind': kind, 'help': '', 'buckets': DEFAULT_BUCKETS}
+        series = self._values.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            if meta['kind'] == 'histogram':
+                # counts per bucket, sum, count
+                series[key] = [0] * len(meta['buckets']) + [0.0, 0]
+            else:
+                series[key] = [0]
+        return series[key]
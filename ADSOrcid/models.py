@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, TIMESTAMP
+from sqlalchemy import Column, Integer, String, Text, TIMESTAMP, LargeBinary, Index, type_coerce
 from sqlalchemy.types import Enum
 import json
+import zlib
+import hashlib
 from adsputils import get_date
 
 Base = declarative_base()
@@ -28,6 +30,36 @@ class UTCDateTime(types.TypeDecorator):
                             value.hour, value.minute, value.second,
                             value.microsecond, tzinfo=tzutc())
 
+def raw(column):
+    """The column without the python-side conversion of its type; the
+    UTCDateTime columns are read as naive datetimes (which are in UTC,
+    get_date() understands them) - that saves one datetime per row"""
+    if isinstance(column.type, UTCDateTime):
+        return type_coerce(column, TIMESTAMP).label(column.key)
+    return column
+
+
+def stream_columns(session, columns, criterion=(), order_by=(), batch_size=1000):
+    """Reads only the given columns of the model(s); use it when scanning
+    many rows. The rows are tuples (the values are accessible also by
+    column names, e.g. row.bibcode); they are not tracked by the session
+    and are fetched from the database in batches.
+    
+    :param: session - db session
+    :param: columns - list of columns (e.g. [ClaimsLog.bibcode, ClaimsLog.status])
+    :param: criterion - list of filter conditions
+    :param: order_by - list of columns/expressions
+    :param: batch_size - int, number of rows fetched at once
+    :return: query (iterable of rows)
+    """
+    q = session.query(*[raw(c) for c in columns])
+    if criterion:
+        q = q.filter(*criterion)
+    if order_by:
+        q = q.order_by(*order_by)
+    return q.yield_per(batch_size)
+
+
 class KeyValue(Base):
     __tablename__ = 'storage'
     key = Column(String(255), primary_key=True)
@@ -44,6 +76,8 @@ class AuthorInfo(Base):
     created = Column(UTCDateTime, default=get_date)
     updated = Column(UTCDateTime, default=get_date)
     
+    __table_args__ = (Index('ix_updated', 'updated'),)
+    
     def toJSON(self):
         return {'id': self.id, 'orcidid': self.orcidid,
                 'name': self.name, 'facts': self.facts and json.loads(self.facts) or {},
@@ -61,6 +95,13 @@ class ClaimsLog(Base):
     provenance = Column(String(255))
     created = Column(UTCDateTime, default=get_date)
     
+    # the access paths are checked by tests/test_query_plans.py
+    __table_args__ = (Index('ix_created', 'created'),
+                      Index('ix_bibcode', 'bibcode'),
+                      Index('ix_claims_orcidid_id', 'orcidid', 'id'),
+                      Index('ix_claims_orcidid_status_id', 'orcidid', 'status', 'id'),
+                      Index('ix_claims_orcidid_created', 'orcidid', 'created'))
+    
     def toJSON(self):
         return {'id': self.id, 'orcidid': self.orcidid,
                 'bibcode': self.bibcode, 'status': self.status,
@@ -68,28 +109,158 @@ class ClaimsLog(Base):
                 }
     
     
+def compress_authors(authors):
+    """Serializes the list of authors (it can also be a json string)
+    into the storage format.
+    
+    :return: tuple (zlib compressed json, sha1 of the json)
+    """
+    if authors is None:
+        return None, None
+    if not isinstance(authors, basestring):
+        authors = json.dumps(authors)
+    if isinstance(authors, unicode):
+        authors = authors.encode('utf8')
+    return zlib.compress(authors), hashlib.sha1(authors).hexdigest()
+
+
+def authors_hash(authors):
+    """Hash of the list of authors (as stored in Records.authors_hash)"""
+    return compress_authors(authors)[1]
+
+
+def decompress_authors(blob):
+    """:return: list of authors (from the compressed json)"""
+    if not blob:
+        return []
+    return json.loads(zlib.decompress(blob))
+
+
 class Records(Base):
+    """The authors are stored compressed (the author lists of collaboration
+    papers are huge) together with their hash, so that they can be compared
+    without decompressing; they are decoded only when accessed."""
     __tablename__ = 'records'
     id = Column(Integer, primary_key=True)
-    bibcode = Column(String(19))
+    bibcode = Column(String(19), unique=True)
     claims = Column(Text)
-    authors = Column(Text)
+    authors_z = Column(LargeBinary)
+    authors_hash = Column(String(40))
     created = Column(UTCDateTime, default=get_date)
     updated = Column(UTCDateTime, default=get_date)
     processed = Column(UTCDateTime)
     
-    def toJSON(self):
-        return {'id': self.id, 'bibcode': self.bibcode,
-                'authors': self.authors and json.loads(self.authors) or [],
-                'claims': self.claims and json.loads(self.claims) or {},
+    __table_args__ = (Index('ix_recs_updated_id', 'updated', 'id'),
+                      Index('ix_recs_created', 'created'),
+                      Index('ix_processed', 'processed'))
+    
+    def _get_authors(self):
+        """The list of authors (decoded only once)"""
+        cached = self.__dict__.get('_authors')
+        if cached is None or cached[0] != self.authors_hash:
+            cached = (self.authors_hash, decompress_authors(self.authors_z))
+            self.__dict__['_authors'] = cached
+        return cached[1]
+    
+    def _set_authors(self, authors):
+        """Accepts list of authors or their json"""
+        self.authors_z, self.authors_hash = compress_authors(authors)
+        if isinstance(authors, list):
+            self.__dict__['_authors'] = (self.authors_hash, authors)
+        else:
+            self.__dict__.pop('_authors', None)
+    
+    authors = property(_get_authors, _set_authors)
+    
+    def toJSON(self, exclude=()):
+        """:param: exclude - names of fields that should not be decoded (and returned)"""
+        out = {'id': self.id, 'bibcode': self.bibcode,
                 'created': self.created and get_date(self.created).isoformat() or None, 'updated': self.updated and get_date(self.updated).isoformat() or None, 
                 'processed': self.processed and get_date(self.processed).isoformat() or None
                 }
+        if 'authors' not in exclude:
+            out['authors'] = self.authors
+        if 'claims' not in exclude:
+            out['claims'] = self.claims and json.loads(self.claims) or {}
+        return out
     
     def __str__(self):
         return json.dumps(self.toJSON())
 
 
+class ClaimsState(Base):
+    """The latest claim of every (orcidid, bibcode) pair; it is
+    maintained together with the ClaimsLog (so that we don't have
+    to replay the log to know the current state)"""
+    __tablename__ = 'claims_state'
+    orcidid = Column(String(19), primary_key=True)
+    bibcode = Column(String(19), primary_key=True)
+    status = Column(String(255))
+    provenance = Column(String(255))
+    created = Column(UTCDateTime)
+    updated = Column(UTCDateTime, default=get_date)
+    
+    def toJSON(self):
+        return {'orcidid': self.orcidid, 'bibcode': self.bibcode, 'status': self.status,
+                'provenance': self.provenance and unicode(self.provenance) or None,
+                'created': self.created and get_date(self.created).isoformat() or None,
+                'updated': self.updated and get_date(self.updated).isoformat() or None
+                }
+
+
+class PendingClaims(Base):
+    """Claims waiting to be applied to their record (when claims are
+    processed in batches)"""
+    __tablename__ = 'pending_claims'
+    id = Column(Integer, primary_key=True)
+    bibcode = Column(String(19), index=True)
+    payload = Column(Text)
+    created = Column(UTCDateTime, default=get_date)
+    
+    def toJSON(self):
+        return self.payload and json.loads(self.payload) or {}
+
+
+class RateLimit(Base):
+    """State of the rate limiter bucket (of one endpoint), see 
+    ADSOrcid.ratelimit.DatabaseBackend"""
+    __tablename__ = 'ratelimit'
+    key = Column(String(255), primary_key=True)
+    value = Column(Text)
+
+
+
+class Lease(Base):
+    """Named lock with expiration; used to make sure that only one
+    worker does the given job (e.g. refreshes an author)"""
+    __tablename__ = 'leases'
+    name = Column(String(255), primary_key=True)
+    owner = Column(String(255))
+    expires = Column(UTCDateTime)
+    
+    def toJSON(self):
+        return {'name': self.name, 'owner': self.owner,
+                'expires': self.expires and get_date(self.expires).isoformat() or None}
+
+
+class RecheckSchedule(Base):
+    """Time of the next check of the orcid profile (the profiles that
+    are due are sent to the queue by task_sweep_rechecks)"""
+    __tablename__ = 'recheck_schedule'
+    orcidid = Column(String(19), primary_key=True)
+    next_check_at = Column(UTCDateTime)
+    check_interval = Column(Integer) # seconds, adapts to how often the profile changes
+    updated = Column(UTCDateTime, default=get_date)
+    
+    __table_args__ = (Index('ix_next_check_at', 'next_check_at'),)
+    
+    def toJSON(self):
+        return {'orcidid': self.orcidid,
+                'next_check_at': self.next_check_at and get_date(self.next_check_at).isoformat() or None,
+                'check_interval': self.check_interval,
+                'updated': self.updated and get_date(self.updated).isoformat() or None}
+
+
 class ChangeLog(Base):
     __tablename__ = 'change_log'
     id = Column(Integer, primary_key=True)
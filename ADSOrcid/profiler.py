@@ -0,0 +1,249 @@
+"""
+Profiler of the pipeline (run.py --diagnose --profile).
+
+One orcid profile at a time is pushed through the whole pipeline
+(task_index_orcid_profile -> get_claims, task_ingest_claim,
+task_match_claim, task_output_results) inside the current process; the
+messages that would go to rabbitmq are processed immediately (the
+periodic re-check of the profile is dropped and nothing is forwarded
+to the master pipeline).
+
+The wall time is split into: http (per endpoint), db queries,
+Levenshtein matching, json encoding/decoding and sleeping (backoff).
+The categories are measured inclusively (e.g. time spent in json
+called from a db query is in both), 'other' is what remains. Besides
+that, the top cProfile hotspots are collected and the stack of the
+main thread is sampled; the samples can be written out as 'folded
+stacks' (input of flamegraph.pl, speedscope and similar tools).
+"""
+
+from sqlalchemy import event
+import Levenshtein
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+# captured before time.sleep gets replaced
+_sleep = time.sleep
+
+STAGES = ('check-orcidid', 'record-claim', 'match-claim', 'output-results')
+CATEGORIES = ('http', 'db', 'levenshtein', 'json', 'sleep')
+
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of a thread (wall-clock, i.e. also when the
+    thread waits for io) and counts the identical stacks."""
+
+    def __init__(self, thread_id, interval=0.005, root=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.stacks = {}
+        self._stop_event = threading.Event()
+
+
+    def run(self):
+        while not self._stop_event.is_set():
+            frame = sys._current_frames().get(self.thread_id, None)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    co = frame.f_code
+                    stack.append('{0}@{1}:{2}'.format(co.co_name, os.path.basename(co.co_filename),
+                                                      co.co_firstlineno))
+                    frame = frame.f_back
+                if self.root:
+                    stack.append(self.root)
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            _sleep(self.interval)
+
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+
+class Profiler(object):
+
+    def __init__(self, app, tasks_module=None, sample_interval=0.005, top=25):
+        """
+        :param: app - ADSOrcidCelery instance
+        :param: tasks_module - module with the tasks (default: ADSOrcid.tasks);
+            its app is replaced by `app` while profiling
+        :param: sample_interval - float, seconds between stack samples (0 disables
+            sampling)
+        :param: top - int, number of cProfile hotspots to report
+        """
+        if tasks_module is None:
+            from ADSOrcid import tasks as tasks_module
+        self.app = app
+        self.tasks = tasks_module
+        self.sample_interval = sample_interval
+        self.top = top
+        # folded stacks of all the runs
+        self.stacks = {}
+
+
+    def profile(self, orcidid, force=True, profile_output=None):
+        """Pushes the orcid profile through the pipeline.
+
+        :param: orcidid - str
+        :param: force - bool, process the profile even if it didn't change
+        :param: profile_output - str, if present the raw cProfile stats are
+            saved there (e.g. for snakeviz or gprof2dot)
+        :return: dict with 'orcidid', 'wall', 'messages' (per stage), 'errors',
+            'http' (per endpoint, calls and time), 'db' (queries, time),
+            'levenshtein', 'json', 'sleep' (calls, time), 'other' (time)
+            and 'hotspots' (list of dicts)
+        """
+        t = self.tasks
+        timings = dict([(c, {'calls': 0, 'time': 0.0}) for c in CATEGORIES if c != 'http'])
+        queues = dict([(s, []) for s in STAGES])
+        stages = [('check-orcidid', t.task_index_orcid_profile),
+                  ('record-claim', t.task_ingest_claim),
+                  ('match-claim', t.task_match_claim),
+                  ('match-claim', t.task_flush_claims),
+                  ('output-results', t.task_output_results)]
+        report = {'orcidid': orcidid, 'messages': dict([(s, 0) for s in STAGES]), 'errors': 0}
+
+        patches = []
+        def patch(obj, name, value):
+            patches.append((obj, name, getattr(obj, name)))
+            setattr(obj, name, value)
+
+        def timed(category, func):
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    timings[category]['calls'] += 1
+                    timings[category]['time'] += time.time() - start
+            return wrapper
+
+        def make_publisher(stage, task):
+            def apply_async(args=None, kwargs=None, countdown=None, **options):
+                queues[stage].append((task, args or (), kwargs or {}))
+            return apply_async
+
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('profiler_start', []).append(time.time())
+
+        def after_execute(conn, cursor, statement, parameters, context, executemany):
+            timings['db']['calls'] += 1
+            timings['db']['time'] += time.time() - conn.info['profiler_start'].pop()
+
+        old_app = t.app
+        t.app = self.app
+        for stage, task in stages:
+            patch(task, 'apply_async', make_publisher(stage, task))
+        patch(self.app, 'forward_message', lambda *args, **kwargs: None)
+        patch(self.app, 'schedule_recheck', lambda *args, **kwargs: None)
+        patch(self.app, 'send_task', lambda *args, **kwargs: None)
+        patch(json, 'loads', timed('json', json.loads))
+        patch(json, 'dumps', timed('json', json.dumps))
+        patch(Levenshtein, 'ratio', timed('levenshtein', Levenshtein.ratio))
+        patch(time, 'sleep', timed('sleep', time.sleep))
+        event.listen(self.app._engine, 'before_cursor_execute', before_execute)
+        event.listen(self.app._engine, 'after_cursor_execute', after_execute)
+
+        http_before = self.app.client.stats()
+        sampler = None
+        if self.sample_interval:
+            sampler = Sampler(threading.current_thread().ident, interval=self.sample_interval, root=orcidid)
+            sampler.start()
+        prof = cProfile.Profile()
+        start = time.time()
+        try:
+            queues['check-orcidid'].append((t.task_index_orcid_profile, ({'orcidid': orcidid, 'force': force},), {}))
+            prof.enable()
+            while any(queues.values()):
+                for stage in STAGES:
+                    while queues[stage]:
+                        task, args, kwargs = queues[stage].pop(0)
+                        report['messages'][stage] += 1
+                        try:
+                            task(*args, **kwargs)
+                        except Exception, e:
+                            report['errors'] += 1
+                            self.app.logger.error('{0} failed: {1}'.format(task.name, e))
+        finally:
+            prof.disable()
+            report['wall'] = time.time() - start
+            if sampler is not None:
+                sampler.stop()
+            event.remove(self.app._engine, 'before_cursor_execute', before_execute)
+            event.remove(self.app._engine, 'after_cursor_execute', after_execute)
+            for obj, name, value in reversed(patches):
+                setattr(obj, name, value)
+            t.app = old_app
+
+        report['http'] = {}
+        for endpoint, s in self.app.client.stats().items():
+            b = http_before.get(endpoint, {'calls': 0, 'time': 0.0})
+            if s['calls'] > b['calls']:
+                report['http'][endpoint] = {'calls': s['calls'] - b['calls'], 'time': s['time'] - b['time']}
+        report.update(timings)
+        measured = sum([x['time'] for x in report['http'].values()]) + \
+                   sum([timings[c]['time'] for c in timings])
+        report['other'] = {'time': max(report['wall'] - measured, 0.0)}
+
+        if sampler is not None:
+            for k, v in sampler.stacks.items():
+                self.stacks[k] = self.stacks.get(k, 0) + v
+        if profile_output:
+            prof.dump_stats(profile_output)
+        report['hotspots'] = self._hotspots(prof)
+        return report
+
+
+    def _hotspots(self, prof):
+        out = []
+        for (filename, line, func), (cc, nc, tt, ct, callers) in pstats.Stats(prof).stats.items():
+            out.append({'function': '{0} ({1}:{2})'.format(func, os.path.basename(filename), line),
+                        'calls': nc, 'own_time': tt, 'cumulative_time': ct})
+        out.sort(key=lambda x: x['own_time'], reverse=True)
+        return out[:self.top]
+
+
+    def write_folded(self, path):
+        """Writes the sampled stacks (of all the profiled orcids; the
+        orcid is the root frame) in the folded format:
+
+            frame;frame;frame count
+        """
+        with open(path, 'w') as f:
+            for k in sorted(self.stacks.keys()):
+                f.write('{0} {1}\n'.format(k, self.stacks[k]))
+
+
+
+def format_report(report):
+    """:return: str, human readable version of the report"""
+    wall = max(report['wall'], 0.000001)
+    lines = ['Profile of {0}: {1:.3f}s wall time, errors: {2}'.format(report['orcidid'], report['wall'], report['errors']),
+             'Messages: ' + ', '.join(['{0}={1}'.format(s, report['messages'][s]) for s in STAGES]),
+             '',
+             '{0:<40} {1:>8} {2:>10} {3:>7}'.format('where', 'calls', 'time (s)', '%')]
+    rows = [('http ' + k, v) for k, v in sorted(report['http'].items())]
+    rows += [(c, report[c]) for c in CATEGORIES if c != 'http']
+    rows.append(('other', report['other']))
+    for name, v in rows:
+        lines.append('{0:<40} {1:>8} {2:>10.3f} {3:>6.1f}%'.format(
+            name, v.get('calls', ''), v['time'], 100.0 * v['time'] / wall))
+    lines += ['', 'Top functions (by own time):',
+              '{0:>8} {1:>10} {2:>10}  {3}'.format('calls', 'own (s)', 'cum (s)', 'function')]
+    for h in report['hotspots']:
+        lines.append('{0:>8} {1:>10.3f} {2:>10.3f}  {3}'.format(h['calls'], h['own_time'],
+                                                             h['cumulative_time'], h['function']))
+    return '\n'.join(lines)
@@ -0,0 +1,289 @@
+"""
+Rate limiter (token bucket) for the calls to the external API's.
+
+Every endpoint has its bucket: it is refilled with `rate` tokens per
+second (up to `burst`), every request takes one token; when the bucket
+is empty, the caller waits. The buckets are kept in a storage shared by
+all the workers:
+
+    db     - the application database, shared by all workers everywhere
+    memory - in-process (every worker has its own buckets)
+    sqlite - file-backed, shared by all workers on the same host
+    redis  - shared by all workers everywhere
+
+The limiter adapts to the responses: when the API answers 429 (or 5xx)
+the rate is cut in half (down to `min_factor` of the configured rate)
+and it grows back slowly with every successful response; 'Retry-After'
+blocks the endpoint for the given number of seconds.
+"""
+
+import cPickle as pickle
+import json
+import sqlite3
+import threading
+import time
+from sqlalchemy.exc import IntegrityError
+from ADSOrcid.cache import SqliteConnection, get_sqlite_path, redis_client
+from ADSOrcid.models import RateLimit
+
+
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+
+class RateLimiter(object):
+
+    def __init__(self, limits, backend=None, min_factor=0.05, decrease=0.5, increase=0.05,
+                 max_wait=60.0):
+        """
+        :param: limits - dict keyed by endpoint name, values are dicts with
+            'rate' (requests per second) and 'burst' (max number of requests
+            sent at once); the key '*' is for endpoints that are not listed,
+            endpoints without limit are not throttled
+        :param: backend - storage of the buckets (default: MemoryBackend)
+        :param: min_factor - float, the rate never drops under min_factor * rate
+        :param: decrease - float, the rate gets multiplied by this on 429/5xx
+        :param: increase - float, fraction of the rate added back after every
+            successful response
+        :param: max_wait - float, max number of seconds we sleep at once
+        """
+        self.limits = dict(limits or {})
+        self.backend = backend or MemoryBackend()
+        self.min_factor = min_factor
+        self.decrease = decrease
+        self.increase = increase
+        self.max_wait = max_wait
+        # the last factor we saw (per endpoint); while it is 1.0 the
+        # successful responses don't need to touch the storage
+        self._factors = {}
+
+
+    def get_limit(self, endpoint):
+        limit = self.limits.get(endpoint, self.limits.get('*', None))
+        if not limit or not limit.get('rate'):
+            return None
+        return limit
+
+
+    def acquire(self, endpoint):
+        """Takes one token from the bucket of the endpoint (waits until
+        there is one).
+
+        :return: float, number of seconds we waited
+        """
+        limit = self.get_limit(endpoint)
+        if limit is None:
+            return 0.0
+        rate = float(limit['rate'])
+        burst = float(limit.get('burst', None) or max(rate, 1))
+
+        def take(state):
+            now = time.time()
+            state = self._refill(state, now, rate, burst)
+            self._factors[endpoint] = state['factor']
+            if state['blocked_until'] > now:
+                return state, state['blocked_until'] - now
+            # (tolerance for the rounding errors of the refill)
+            if state['tokens'] >= 1 - 1e-9:
+                state['tokens'] = max(state['tokens'] - 1, 0.0)
+                return state, 0.0
+            return state, (1 - state['tokens']) / (rate * state['factor'])
+
+        waited = 0.0
+        while True:
+            wait = self.backend.update(endpoint, take)
+            if wait <= 0:
+                return waited
+            wait = min(wait, self.max_wait)
+            time.sleep(wait)
+            waited += wait
+
+
+    def feedback(self, endpoint, status_code, retry_after=None):
+        """Adjusts the rate according to the response.
+
+        :param: status_code - int (or None if there was no response)
+        :param: retry_after - float, seconds (value of 'Retry-After')
+        """
+        limit = self.get_limit(endpoint)
+        if limit is None or status_code is None:
+            return
+        if status_code not in THROTTLE_STATUSES and self._factors.get(endpoint, 1.0) >= 1.0:
+            return # nothing to recover from
+        rate = float(limit['rate'])
+        burst = float(limit.get('burst', None) or max(rate, 1))
+
+        def adjust(state):
+            now = time.time()
+            if status_code in THROTTLE_STATUSES:
+                state = self._refill(state, now, rate, burst)
+                state['factor'] = max(self.min_factor, state['factor'] * self.decrease)
+                self._factors[endpoint] = state['factor']
+                state['tokens'] = min(state['tokens'], 0.0)
+                if retry_after:
+                    state['blocked_until'] = max(state['blocked_until'], now + retry_after)
+                return state, None
+            if state is None or state['factor'] >= 1.0:
+                self._factors[endpoint] = 1.0
+                return None, None # nothing to change
+            state = self._refill(state, now, rate, burst)
+            state['factor'] = min(1.0, state['factor'] + self.increase)
+            self._factors[endpoint] = state['factor']
+            return state, None
+
+        self.backend.update(endpoint, adjust)
+
+
+    def get_state(self, endpoint):
+        """:return: dict with 'tokens', 'ts', 'factor', 'blocked_until' (or None)"""
+        return self.backend.update(endpoint, lambda state: (None, state))
+
+
+    def _refill(self, state, now, rate, burst):
+        if state is None:
+            return {'tokens': burst, 'ts': now, 'factor': 1.0, 'blocked_until': 0.0}
+        elapsed = max(now - state['ts'], 0.0)
+        state['tokens'] = min(burst, state['tokens'] + elapsed * rate * state['factor'])
+        state['ts'] = now
+        return state
+
+
+
+def create_limiter(config, engine=None):
+    """Creates the limiter from the configuration; we'll read:
+        HTTP_RATE_LIMITS - dict, see RateLimiter
+        HTTP_RATE_LIMIT_BACKEND - str, db, memory, sqlite or redis
+        CACHE_SQLITE_PATH, CACHE_REDIS_URL - location of the storage
+            (shared with the caches)
+    
+    :param: engine - sqlalchemy engine (of the db backend)
+    """
+    backend = config.get('HTTP_RATE_LIMIT_BACKEND', 'memory')
+    if backend == 'db':
+        if engine is None:
+            raise Exception('The db rate limiter backend needs a database (SQLALCHEMY_URL)')
+        if engine.dialect.name == 'sqlite':
+            # (sqlite ignores SELECT ... FOR UPDATE)
+            raise Exception('The db rate limiter backend needs a database that can lock rows '
+                            '(e.g. PostgreSQL); use the sqlite backend instead')
+        storage = DatabaseBackend(engine)
+    elif backend == 'sqlite':
+        storage = SqliteBackend(get_sqlite_path(config))
+    elif backend == 'redis':
+        storage = RedisBackend(url=config.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+    elif backend == 'memory':
+        storage = MemoryBackend()
+    else:
+        raise Exception('Unknown rate limiter backend: {0}'.format(backend))
+    return RateLimiter(config.get('HTTP_RATE_LIMITS', None), backend=storage)
+
+
+
+class MemoryBackend(object):
+    """Buckets kept in the process."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+
+    def update(self, key, func):
+        """Atomically reads the state, calls func(state) which returns
+        (new state, result) and saves the new state (unless it is None).
+
+        :return: result
+        """
+        with self._lock:
+            state, result = func(self._data.get(key, None))
+            if state is not None:
+                self._data[key] = state
+            return result
+
+
+
+class SqliteBackend(object):
+    """Buckets stored in a sqlite database; all processes (on the same
+    machine) that use the same file share them."""
+
+    def __init__(self, path, namespace='ratelimit'):
+        self.path = path
+        self.namespace = namespace
+        self._conn = SqliteConnection(path, 'CREATE TABLE IF NOT EXISTS ratelimit (namespace TEXT, key TEXT, '
+                                             'value BLOB, PRIMARY KEY (namespace, key))')
+        self._lock = threading.RLock()
+
+
+    def update(self, key, func):
+        with self._lock:
+            conn = self._conn.get()
+            # the write lock is taken immediately, other processes wait
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT value FROM ratelimit WHERE namespace=? AND key=?',
+                                   (self.namespace, key)).fetchone()
+                state, result = func(row and pickle.loads(str(row[0])) or None)
+                if state is not None:
+                    conn.execute('INSERT OR REPLACE INTO ratelimit (namespace, key, value) VALUES (?, ?, ?)',
+                                 (self.namespace, key, sqlite3.Binary(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            return result
+
+
+
+class DatabaseBackend(object):
+    """Buckets stored in the database of the application (shared by all
+    workers, on all machines); the row of the bucket stays locked 
+    (SELECT ... FOR UPDATE) while it is being updated."""
+
+    def __init__(self, engine, namespace='ratelimit'):
+        self.engine = engine
+        self.namespace = namespace
+
+
+    def update(self, key, func):
+        key = '{0}:{1}'.format(self.namespace, key)
+        table = RateLimit.__table__
+        while True:
+            try:
+                with self.engine.begin() as conn:
+                    row = conn.execute(table.select().where(table.c.key == key).with_for_update()).fetchone()
+                    state, result = func(row and json.loads(row['value']) or None)
+                    if state is not None:
+                        if row is None:
+                            conn.execute(table.insert().values(key=key, value=json.dumps(state)))
+                        else:
+                            conn.execute(table.update().where(table.c.key == key).values(value=json.dumps(state)))
+                    return result
+            except IntegrityError:
+                continue # somebody created the bucket meanwhile
+
+
+
+class RedisBackend(object):
+    """Buckets stored in redis (shared by all workers, on all machines);
+    the updates use optimistic locking (WATCH/MULTI)."""
+
+    def __init__(self, url=None, client=None, namespace='ratelimit'):
+        self.namespace = namespace
+        self.client = client or redis_client(url)
+
+
+    def update(self, key, func):
+        import redis
+        key = '{0}:{1}'.format(self.namespace, key)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    v = pipe.get(key)
+                    state, result = func(v and pickle.loads(v) or None)
+                    pipe.multi()
+                    if state is not None:
+                        pipe.set(key, pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+                    pipe.execute()
+                    return result
+                except redis.WatchError:
+                    continue
@@ -0,0 +1,169 @@
+"""
+Re-plays claims of all authors (see updater.reindex_all_claims).
+
+The authors are split into shards (by AuthorInfo.id modulo number of
+shards) and every shard is processed by its own process; inside a shard
+the authors are read in batches (ordered by id). After every batch, the
+progress of the shard is saved into the KeyValue storage, so that an
+interrupted run continues where it stopped.
+"""
+
+from adsputils import get_date
+from ADSOrcid import updater
+from ADSOrcid.models import AuthorInfo, KeyValue
+from multiprocessing import Pool
+import json
+import time
+
+
+CHECKPOINT_PREFIX = 'reindex.shard.'
+
+# the reindexer used by the worker processes
+_worker = None
+
+
+def _init_worker(reindexer):
+    global _worker
+    # db connections must not be shared with the parent process
+    reindexer.app._engine.dispose()
+    _worker = reindexer
+
+
+def _run_shard(args):
+    return _worker.run_shard(*args)
+
+
+
+class Reindexer(object):
+
+    def __init__(self, app, processes=None, batch_size=None, callback=None):
+        """
+        :param: app - ADSOrcidCelery instance
+        :param: processes - int, number of shards/processes (default: REINDEX_PROCESSES);
+            when an interrupted run is resumed, the number of shards stays
+            the same as in the first run
+        :param: batch_size - int, number of authors read at once (default: REINDEX_BATCH_SIZE)
+        :param: callback - function called (in the worker process) for every author
+            as callback(orcidid, modified_bibcodes)
+        """
+        self.app = app
+        self.processes = processes or app.conf.get('REINDEX_PROCESSES', 4)
+        self.batch_size = batch_size or app.conf.get('REINDEX_BATCH_SIZE', 1000)
+        self.callback = callback
+        self.logger = app.logger
+
+
+    def run(self, since, started=None):
+        """Re-plays claims (made since the given date) of all authors.
+
+        :param: since - RFC3339 formatted string; ignored when an interrupted
+            run is resumed
+        :param: started - RFC3339 formatted string, the moment the run
+            started (it is saved with the checkpoints)
+        :return: dict with 'authors', 'errors', 'since', 'started' and 'changed'
+            (set of orcidids whose records were modified)
+        """
+        started = started or get_date().isoformat()
+        checkpoints = self.load_checkpoints()
+        if checkpoints:
+            first = checkpoints.values()[0]
+            num_shards, since, started = first['shards'], first['since'], first['started']
+            self.logger.info('Resuming interrupted reindex (started: {0}, shards: {1})'.format(started, num_shards))
+        else:
+            num_shards = self.processes
+            since = get_date(since).isoformat()
+
+        jobs = []
+        for shard in range(num_shards):
+            last_id = checkpoints.get(shard, {}).get('last_id', 0)
+            jobs.append((shard, num_shards, since, started, last_id))
+
+        out = {'authors': 0, 'errors': 0, 'changed': set(), 'since': since, 'started': started}
+        start = time.time()
+        if num_shards == 1:
+            results = [self.run_shard(*jobs[0])]
+        else:
+            pool = Pool(num_shards, initializer=_init_worker, initargs=(self,))
+            try:
+                results = pool.imap_unordered(_run_shard, jobs)
+                results = list(results)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        for r in results:
+            out['authors'] += r['authors']
+            out['errors'] += r['errors']
+            out['changed'].update(r['changed'])
+        self.logger.info('Reindexed {0} authors in {1} shards ({2:.1f} authors/sec)'.format(
+            out['authors'], num_shards, out['authors'] / max(time.time() - start, 0.001)))
+        return out
+
+
+    def run_shard(self, shard, num_shards, since, started, last_id=0):
+        """Re-plays claims of authors that belong to the shard.
+
+        :return: dict with 'shard', 'authors', 'errors' and 'changed'
+        """
+        out = {'shard': shard, 'authors': 0, 'errors': 0, 'changed': set()}
+        start = time.time()
+
+        while True:
+            with self.app.session_scope() as session:
+                rows = session.query(AuthorInfo.id, AuthorInfo.orcidid) \
+                    .filter(AuthorInfo.id % num_shards == shard, AuthorInfo.id > last_id) \
+                    .order_by(AuthorInfo.id.asc()).limit(self.batch_size).all()
+            if not rows:
+                break
+
+            for author in rows:
+                orcidid = author.orcidid
+                if not orcidid or orcidid.strip() == "":
+                    continue
+                try:
+                    changed = updater.reindex_all_claims(self.app, orcidid, since=since, ignore_errors=True)
+                    if len(changed):
+                        out['changed'].add(orcidid)
+                    if self.callback:
+                        self.callback(orcidid, changed)
+                except Exception, e:
+                    out['errors'] += 1
+                    self.logger.error('Error processing: {0} ({1})'.format(orcidid, e))
+                out['authors'] += 1
+
+            last_id = rows[-1].id
+            self.save_checkpoint(shard, {'shards': num_shards, 'since': since, 'started': started,
+                                         'last_id': last_id})
+            self.logger.info('Shard {0}/{1}: {2} authors ({3:.1f}/sec), last id: {4}'.format(
+                shard, num_shards, out['authors'], out['authors'] / max(time.time() - start, 0.001), last_id))
+
+            if len(rows) < self.batch_size:
+                break
+        return out
+
+
+    def load_checkpoints(self):
+        """:return: dict keyed by shard number"""
+        out = {}
+        with self.app.session_scope() as session:
+            for kv in session.query(KeyValue).filter(KeyValue.key.like(CHECKPOINT_PREFIX + '%')).all():
+                out[int(kv.key[len(CHECKPOINT_PREFIX):])] = json.loads(kv.value)
+        return out
+
+
+    def save_checkpoint(self, shard, value):
+        with self.app.session_scope() as session:
+            key = CHECKPOINT_PREFIX + str(shard)
+            kv = session.query(KeyValue).filter_by(key=key).first()
+            if kv is None:
+                session.add(KeyValue(key=key, value=json.dumps(value)))
+            else:
+                kv.value = json.dumps(value)
+            session.commit()
+
+
+    def clear_checkpoints(self):
+        """Removes the checkpoints (call it when the whole run is finished)"""
+        with self.app.session_scope() as session:
+            session.query(KeyValue).filter(KeyValue.key.like(CHECKPOINT_PREFIX + '%')).delete(synchronize_session=False)
+            session.commit()
@@ -6,9 +6,11 @@ from ADSOrcid import app as app_module
 from ADSOrcid import updater
 from ADSOrcid.exceptions import ProcessingException, IgnorableException
 from ADSOrcid.models import KeyValue
+from ADSOrcid.ratelimit import RateLimiter
 from kombu import Queue
 import datetime
-import requests
+import random
+import uuid
 
 
 app = app_module.ADSOrcidCelery('orcid-pipeline')
@@ -18,9 +20,45 @@ app.conf.CELERY_QUEUES = (
     Queue('match-claim', app.exchange, routing_key='match-claim'),
     Queue('check-updates', app.exchange, routing_key='check-updates'),
     Queue('output-results', app.exchange, routing_key='output-results'),
+    Queue('refresh-author', app.exchange, routing_key='refresh-author'),
+    Queue('sweep-rechecks', app.exchange, routing_key='sweep-rechecks'),
 )
 logger = app.logger
 
+# name of the lease held by the (only) active poller of the orcid updates
+POLLER_LEASE = 'orcid-updates-poller'
+SWEEPER_LEASE = 'recheck-sweeper'
+# leases of the orcid profiles that wait in the queue / are being indexed
+QUEUED_LEASE = 'queued-orcid:{0}'
+RUNNING_LEASE = 'index-orcid:{0}'
+# the profile changed while it was being indexed (it will be indexed again)
+DIRTY_LEASE = 'dirty-orcid:{0}'
+# lease of the bibcode whose (buffered) claims are being applied
+FLUSH_LEASE = 'flush-claims:{0}'
+
+
+
+
+def enqueue_orcid_profile(message):
+    """Sends the orcid profile to the queue (check-orcidid), unless it
+    is already waiting there; duplicates are dropped (and counted in the
+    metric 'index_suppressed_total'). Forced messages are always sent 
+    (the one in the queue may not be forced).
+    
+    :param message: see task_index_orcid_profile
+    :return: AsyncResult (None if the message was dropped)
+    """
+    lease = QUEUED_LEASE.format(message['orcidid'])
+    if not app.acquire_lease(lease, app.conf.get('ORCID_INDEX_QUEUED_LEASE', 3600)) \
+        and not message.get('force', False):
+        logger.debug('{0} is already queued, skipping'.format(message['orcidid']))
+        app.metrics.inc('index_suppressed_total', reason='queued')
+        return None
+    try:
+        return task_index_orcid_profile.delay(message)
+    except:
+        app.release_lease(lease)
+        raise
 
 
 
@@ -31,6 +69,11 @@ def task_index_orcid_profile(message):
     it against the state of the storage (diff). And re-index/update
     them.
     
+    Only one worker at a time indexes the profile; the duplicate 
+    messages (that come while the profile is being indexed) mark the
+    profile dirty and the worker sends it to the queue again when it
+    is done (the profile may have changed after it was fetched); 
+    forced messages are tried again later.
 
     :param message: contains the message inside the packet
         {
@@ -46,6 +89,38 @@ def task_index_orcid_profile(message):
     if 'orcidid' not in message:
         raise IgnorableException('Received garbage: {}'.format(message))
     
+    orcidid = message['orcidid']
+    
+    # the message left the queue (a new one can be sent)
+    app.release_lease(QUEUED_LEASE.format(orcidid))
+    
+    lease = RUNNING_LEASE.format(orcidid)
+    ttl = app.conf.get('ORCID_INDEX_RUNNING_LEASE', 600)
+    owner = uuid.uuid4().hex
+    if not app.acquire_lease(lease, ttl, owner=owner):
+        if message.get('force', False):
+            logger.info('{0} is being indexed by another worker, trying again later'.format(orcidid))
+            task_index_orcid_profile.apply_async(args=(message,), 
+                                                 countdown=app.conf.get('ORCID_INDEX_FORCED_RETRY', 60))
+            return
+        logger.info('{0} is being indexed by another worker, it will be indexed again'.format(orcidid))
+        app.acquire_lease(DIRTY_LEASE.format(orcidid), ttl)
+        app.metrics.inc('index_suppressed_total', reason='running')
+        return
+    try:
+        with app.keep_lease(lease, ttl, owner):
+            _index_orcid_profile(message)
+    finally:
+        # the profile is acknowledged only when it was imported
+        app.discard_unacknowledged('claims', orcidid)
+        app.release_lease(lease, owner=owner)
+        # updates that came while we were working
+        if app.release_lease(DIRTY_LEASE.format(orcidid)):
+            enqueue_orcid_profile({'orcidid': orcidid})
+
+
+
+def _index_orcid_profile(message):
     message['start'] = adsputils.get_date()
     orcidid = message['orcidid']
 
@@ -118,6 +193,7 @@ def task_index_orcid_profile(message):
                                               status='unchanged',
                                               date=orcid_claim[1]))
 
+    statuses = [c.status for c in to_claim]
     if len(to_claim):
         # create record in the database
         json_claims = app.insert_claims(to_claim)
@@ -126,9 +202,19 @@ def task_index_orcid_profile(message):
             if claim.get('bibcode'):
                 claim['bibcode_verified'] = True
                 task_ingest_claim.delay(claim)
-            
-    # reschedule future check
-    task_index_orcid_profile.apply_async(args=(message,), countdown = app.conf.get('ORCID_PROFILE_RECHECK_WINDOW', 3600*24))
+    
+    # this version of the profile was imported (we'll skip it next time,
+    # unless it changes); get_claims doesn't let us acknowledge profiles
+    # that were not resolved completely
+    app.acknowledge('claims', orcidid)
+    
+
+    # schedule future check (task_sweep_rechecks will send it); profiles
+    # that change often are checked more often
+    changed = any([s in ('claimed', 'updated', 'removed') for s in statuses])
+    interval = app.get_recheck_interval(orcidid, changed)
+    jitter = app.conf.get('ORCID_RECHECK_JITTER', 0.1)
+    app.schedule_recheck(orcidid, interval * random.uniform(1 - jitter, 1 + jitter), interval=interval)
 
 
 
@@ -200,6 +286,20 @@ def task_ingest_claim(msg, **kwargs):
 
 
 
+@app.task(queue='refresh-author')
+def task_refresh_author(orcidid):
+    """
+    Harvests fresh info about the author (public ORCID profile,
+    ADS orcid profile, SOLR) and updates our database; it is 
+    scheduled by app.retrieve_orcid when the info is stale.
+    
+    :param orcidid: string
+    :return: no return
+    """
+    app.refresh_author(orcidid)
+
+
+
 @app.task(queue='match-claim')
 def task_match_claim(claim, **kwargs):
     """
@@ -207,6 +307,11 @@ def task_match_claim(claim, **kwargs):
     entry for the record, if not existing yet) and updates 
     the metadata.
     
+    If MATCH_CLAIM_BATCH_WINDOW is set, the claim is only saved
+    and it will be applied (together with other claims for the
+    same bibcode) when the window closes or when there is 
+    MATCH_CLAIM_BATCH_SIZE claims waiting.
+    
     :param claim: contains the message inside the packet
         {'bibcode': '....',
         'orcidid': '.....',
@@ -223,20 +328,94 @@ def task_match_claim(claim, **kwargs):
         raise ProcessingException('Unusable payload, missing orcidid {0}'.format(claim))
 
     bibcode = claim['bibcode']
+    window = app.conf.get('MATCH_CLAIM_BATCH_WINDOW', 0)
+    
+    if not window or window <= 0:
+        _apply_claims(bibcode, [claim])
+        return
+    
+    num, is_first = app.buffer_claim(claim)
+    if num >= app.conf.get('MATCH_CLAIM_BATCH_SIZE', 50):
+        task_flush_claims(bibcode)
+    elif is_first:
+        task_flush_claims.apply_async(args=(bibcode,), countdown=window)
+
+
+
+@app.task(queue='match-claim')
+def task_flush_claims(bibcode, attempt=0):
+    """
+    Applies all claims that are waiting for the bibcode; the record is
+    loaded and saved only once and one message is sent to the output.
+    
+    Only one flush of the bibcode runs at a time (the others leave the 
+    work to it). When applying the claims fails, they stay in the buffer
+    and the flush is tried again later (at most MATCH_CLAIM_MAX_ATTEMPTS
+    times); claims that can never be applied (IgnorableException) or 
+    that failed too many times are removed.
+    
+    :param bibcode: string
+    :param attempt: int, number of the previous failed attempts
+    :return: no return
+    """
+    lease = FLUSH_LEASE.format(bibcode)
+    owner = uuid.uuid4().hex
+    if not app.acquire_lease(lease, app.conf.get('MATCH_CLAIM_FLUSH_LEASE', 600), owner=owner):
+        logger.debug('Claims of {0} are being applied by another worker'.format(bibcode))
+        return
+    
+    done = []
+    retry = False
+    try:
+        ids, claims = app.get_pending_claims(bibcode)
+        try:
+            if len(claims):
+                _apply_claims(bibcode, claims)
+            done = ids
+        except IgnorableException:
+            logger.error('Failed applying {0} claims of {1}, discarding them: {2}'.format(
+                len(claims), bibcode, [(c.get('orcidid'), c.get('status')) for c in claims]))
+            done = ids
+            raise
+        except Exception:
+            if attempt + 1 >= app.conf.get('MATCH_CLAIM_MAX_ATTEMPTS', 3):
+                logger.error('Failed applying {0} claims of {1} ({2} times), discarding them: {3}'.format(
+                    len(claims), bibcode, attempt + 1, claims))
+                done = ids
+            else:
+                retry = True
+            raise
+    finally:
+        app.remove_pending_claims(done)
+        app.release_lease(lease, owner=owner)
+        # claims that arrived while we were working (or that failed)
+        if app.count_pending_claims(bibcode):
+            task_flush_claims.apply_async(args=retry and (bibcode, attempt + 1) or (bibcode,), 
+                                          countdown=app.conf.get('MATCH_CLAIM_BATCH_WINDOW', 0))
+
+
+
+def _apply_claims(bibcode, claims):
+    """Updates the record with all the claims; if the record was modified,
+    it is saved and sent out."""
     rec = app.retrieve_record(bibcode)
     
+    modified = False
+    for claim in claims:
+        cl = updater.update_record(rec, claim, app.conf.get('MIN_LEVENSHTEIN_RATIO', 0.9))
+        if cl:
+            modified = True
+        else:
+            logger.warning('Claim refused for bibcode:{0} and orcidid:{1}'
+                            .format(claim['bibcode'], claim['orcidid']))
     
-    cl = updater.update_record(rec, claim, app.conf.get('MIN_LEVENSHTEIN_RATIO', 0.9))
-    if cl:
+    if modified:
         app.record_claims(bibcode, rec['claims'], rec['authors'])
         msg = OrcidClaims(authors=rec.get('authors'), bibcode=rec['bibcode'], 
                           verified=rec.get('claims', {}).get('verified', []),
                           unverified=rec.get('claims', {}).get('unverified', [])
                           )
         task_output_results.delay(msg)
-    else:
-        logger.warning('Claim refused for bibcode:{0} and orcidid:{1}'
-                        .format(claim['bibcode'], claim['orcidid']))
 
 
 @app.task(queue='output-results')
@@ -268,23 +447,47 @@ def task_output_results(msg):
 def task_check_orcid_updates(msg):
     """Check the orcid microservice for updated orcid profiles.
     
-    This function is somewhat complex
-    we are trying to defend against multiple executions (assuming 
-    that there is many workers and each of them can receive its own
-    signal to start processing). 
-    
-    Basically, we'll only want to check for updated profiles once.
-    The synchronization is done via a database. So the worker
-    updates the 'last.check' timestamp immediately (and we
-    'optimistically' hope that it will be enough to prevent clashes;
-    well - even if that is not a strong guarantee, it wouldn't be 
-    a tragedy if a profile is checked twice...)
-    
-    Additional difficulty is time synchronization: the worker can 
-    be executed as often as you like, but it will refuse to do any
-    work unless the time window between the checks is large enough.
+    The task re-schedules itself, i.e. there is a chain of messages
+    that keeps polling the orcid-service. Only one chain is allowed
+    to do the work: its leader holds the lease 'orcid-updates-poller'
+    (the id of the chain travels inside the message). Every link of
+    the chain renews the lease (until the time of the next execution
+    + ORCID_CHECK_LEASE_GRACE), messages of other chains (e.g. triggered
+    manually or left behind after a restart) find the lease taken and
+    die out. When the leader crashes and its chain is lost, the lease 
+    expires soon and the next message that comes in becomes the leader
+    (celery beat sends one every ORCID_CHECK_FOR_CHANGES seconds, see
+    CELERYBEAT_SCHEDULE).
+    
+    The time of the last update we have seen is kept in the database
+    ('last.check'); the worker can be executed as often as you like, 
+    but it will refuse to do any work unless the time window between 
+    the checks is large enough.
+    
+    Every check reads all the pages of updates the orcid-service has
+    (after an outage there can be many), the checkpoint moves after
+    every page. At most ORCID_CHECK_MAX_PAGES are read at once, then
+    the check continues immediately (in the next message); the updated
+    profiles are queued at most at ORCID_CHECK_ENQUEUE_RATE per second.
     """
     
+    total_wait = app.conf.get('ORCID_CHECK_FOR_CHANGES', 60*5) #default is 5min
+    grace = app.conf.get('ORCID_CHECK_LEASE_GRACE', 60)
+    poller = msg.get('poller', None) or uuid.uuid4().hex
+    
+    if not app.acquire_lease(POLLER_LEASE, total_wait + grace, owner=poller):
+        logger.info('Another poller is active, stopping the chain {0}'.format(poller))
+        return
+    msg['poller'] = poller
+    
+    def recheck(countdown):
+        # keep the lease until our next execution (if we lost it, the
+        # chain stops here)
+        if not app.acquire_lease(POLLER_LEASE, countdown + grace, owner=poller):
+            logger.warning('The poller {0} lost its lease, stopping'.format(poller))
+            return
+        task_check_orcid_updates.apply_async(args=(msg,), countdown=countdown)
+    
     with app.session_scope() as session:
         kv = session.query(KeyValue).filter_by(key='last.check').first()
         if kv is None:
@@ -293,18 +496,28 @@ def task_check_orcid_updates(msg):
         latest_point = adsputils.get_date(kv.value) # RFC 3339 format
         now = adsputils.get_date()
         
-        total_wait = app.conf.get('ORCID_CHECK_FOR_CHANGES', 60*5) #default is 5min
         delta = now - latest_point
         
-        if delta.total_seconds() < total_wait:
+        if delta.total_seconds() < total_wait and not msg.get('catchup', False):
             # register our own execution in the future
-            task_check_orcid_updates.apply_async(args=(msg,), countdown=(total_wait - delta.total_seconds()) + 1)
-        else:
-            logger.info("Checking for orcid updates")
-            
+            recheck((total_wait - delta.total_seconds()) + 1)
+            return
+        
+        logger.info("Checking for orcid updates")
+        
+        # profiles that are due for their periodic check
+        task_sweep_rechecks.delay({})
+        
+        # we read page after page (until there are no more updates or we
+        # hit the limit); the checkpoint moves forward after every page
+        max_pages = app.conf.get('ORCID_CHECK_MAX_PAGES', 50)
+        limiter = RateLimiter({'*': {'rate': app.conf.get('ORCID_CHECK_ENQUEUE_RATE', 100)}})
+        pages = 0
+        while True:
             # increase the timestamp by one microsec and get new updates
-            latest_point = latest_point + datetime.timedelta(microseconds=1)
-            r = requests.get(app.conf.get('API_ORCID_UPDATES_ENDPOINT') % latest_point.isoformat(),
+            start = latest_point + datetime.timedelta(microseconds=1)
+            r = app.client.get(app.conf.get('API_ORCID_UPDATES_ENDPOINT') % start.isoformat(),
+                        endpoint='orcid-updates',
                         params={'fields': ['orcid_id', 'updated', 'created']},
                         headers = {'Authorization': 'Bearer {0}'.format(app.conf.get('API_TOKEN'))})
             
@@ -313,39 +526,89 @@ def task_check_orcid_updates(msg):
                             app.conf.get('API_ORCID_UPDATES_ENDPOINT') % kv.value,
                             r.text))
                 msg['errcount'] = msg.get('errcount', 0) + 1
+                msg.pop('catchup', None)
                 
                 # schedule future execution offset by number of errors (rca: do exponential?)
-                task_check_orcid_updates.apply_async(args=(msg,), countdown = total_wait + total_wait * msg['errcount'])
+                recheck(total_wait + total_wait * msg['errcount'])
                 return
             
-            
-            if r.text.strip() == "":
-                return task_check_orcid_updates.apply_async(args=(msg,), countdown = total_wait)
-            
-            data = r.json()
-            
+            data = r.text.strip() and r.json() or []
             if len(data) == 0:
-                return task_check_orcid_updates.apply_async(args=(msg,), countdown = total_wait)
+                break
             
             msg['errcount'] = 0 # success, we got data from the api, reset the counter
-
-            # we received the data, immediately update the databaes (so that other processes don't 
-            # ask for the same starting date)            
+            
             # data should be ordered by date updated (but to be sure, let's check it); we'll save it
             # as latest 'check point'
             dates = [adsputils.get_date(x['updated']) for x in data]
             dates = sorted(dates, reverse=True)
+            if dates[0] <= latest_point:
+                break # nothing new (the api ignored our start date)
             
-            kv.value = dates[0].isoformat()
-            session.merge(kv)
+            latest_point = dates[0]
+            kv.value = latest_point.isoformat()
+            kv = session.merge(kv)
             session.commit()
             
             for rec in data:
-                payload = {'orcidid': rec['orcid_id'], 'start': latest_point.isoformat()}
-                task_index_orcid_profile.delay(payload)
+                limiter.acquire('index-orcid-profile')
+                payload = {'orcidid': rec['orcid_id'], 'start': start.isoformat()}
+                enqueue_orcid_profile(payload)
+            
+            pages += 1
+            if max_pages and pages >= max_pages:
+                logger.info('Got {0} pages of updates, the rest comes in the next cycle'.format(pages))
+                msg['catchup'] = True
+                recheck(1)
+                return
             
-            # recheck again
-            task_check_orcid_updates.apply_async(args=(msg,), countdown = total_wait)
+            # catching up can take a while, keep the lease
+            if not app.acquire_lease(POLLER_LEASE, total_wait + grace, owner=poller):
+                logger.warning('The poller {0} lost its lease, stopping'.format(poller))
+                return
+        
+        # recheck again
+        msg.pop('catchup', None)
+        recheck(total_wait)
+
+
+@app.task(queue='sweep-rechecks')
+def task_sweep_rechecks(msg):
+    """Sends the orcid profiles that are due for their periodic check
+    to the queue (the time of the next check is kept in the database, 
+    see app.schedule_recheck). It is triggered by the poller of the 
+    orcid updates; only one sweep runs at a time.
+    
+    The profiles are read in batches of ORCID_RECHECK_BATCH_SIZE (at 
+    most ORCID_RECHECK_MAX_BATCHES per sweep) and sent at most at 
+    ORCID_CHECK_ENQUEUE_RATE per second; a profile that was sent but
+    never checked is sent again after ORCID_RECHECK_RETRY seconds.
+    """
+    batch_size = app.conf.get('ORCID_RECHECK_BATCH_SIZE', 1000)
+    max_batches = app.conf.get('ORCID_RECHECK_MAX_BATCHES', 10)
+    rate = app.conf.get('ORCID_CHECK_ENQUEUE_RATE', 100)
+    sweeper = uuid.uuid4().hex
+    
+    # long enough for the whole sweep
+    ttl = rate and (batch_size * max_batches) / float(rate) + 60 or 600
+    if not app.acquire_lease(SWEEPER_LEASE, ttl, owner=sweeper):
+        logger.info('Another sweep is running')
+        return
+    try:
+        limiter = RateLimiter({'*': {'rate': rate}})
+        total = 0
+        for i in range(max_batches):
+            orcidids = app.pop_due_rechecks(batch_size, app.conf.get('ORCID_RECHECK_RETRY', 3600*6))
+            for orcidid in orcidids:
+                limiter.acquire('index-orcid-profile')
+                enqueue_orcid_profile({'orcidid': orcidid})
+            total += len(orcidids)
+            if len(orcidids) < batch_size:
+                break
+        if total:
+            logger.info('Sent {0} profiles to be re-checked'.format(total))
+    finally:
+        app.release_lease(SWEEPER_LEASE, owner=sweeper)
 
 
 if __name__ == '__main__':
@@ -16,13 +16,17 @@ import re
 import os
 import math
 import httpretty
+import gzip
+import shutil
+import tempfile
+import time
 import mock
 from mock import patch
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timedelta
 import adsputils as utils
 from ADSOrcid import app
-from ADSOrcid.models import ClaimsLog, Records, AuthorInfo, Base, ChangeLog
+from ADSOrcid.models import ClaimsLog, ClaimsState, Records, AuthorInfo, Base, ChangeLog
 
 class TestAdsOrcidCelery(unittest.TestCase):
     """
@@ -37,6 +41,8 @@ class TestAdsOrcidCelery(unittest.TestCase):
             'SQLALCHEMY_ECHO': False,
             'PROJ_HOME' : proj_home,
             'TEST_DIR' : os.path.join(proj_home, 'ADSOrcid/tests'),
+            'CACHE_SETTINGS': {}, # all caches in memory
+            'HTTP_RATE_LIMIT_BACKEND': 'memory',
             })
         Base.metadata.bind = self.app._session.get_bind()
         Base.metadata.create_all()
@@ -125,6 +131,76 @@ class TestAdsOrcidCelery(unittest.TestCase):
             self.assertTrue(len(c) == 2)
     
     
+    def test_claims_state(self):
+        """The current state of claims is updated together with the log"""
+        self.app.insert_claims([
+                    {'bibcode': 'b123456789123456789', 'orcidid': '0000-0000-0000-0001', 'status': 'claimed'},
+                    {'bibcode': 'b123456789123456780', 'orcidid': '0000-0000-0000-0001', 'status': 'claimed'},
+                    {'bibcode': 'b123456789123456789', 'orcidid': '0000-0000-0000-0002', 'status': 'claimed'},
+                    {'bibcode': '', 'orcidid': '0000-0000-0000-0001', 'status': '#full-import'},
+                ])
+        self.app.insert_claims([
+                    {'bibcode': 'b123456789123456789', 'orcidid': '0000-0000-0000-0001', 'status': 'removed'},
+                    {'bibcode': 'b123456789123456780', 'orcidid': '0000-0000-0000-0001', 'status': 'updated'},
+                ])
+        
+        def get_state():
+            with self.app.session_scope() as session:
+                return sorted([(x.orcidid, x.bibcode, x.status) for x in session.query(ClaimsState).all()])
+        
+        expected = [('0000-0000-0000-0001', 'b123456789123456780', 'updated'),
+                    ('0000-0000-0000-0001', 'b123456789123456789', 'removed'),
+                    ('0000-0000-0000-0002', 'b123456789123456789', 'claimed')]
+        self.assertEqual(get_state(), expected)
+        
+        # rebuilding the state from the log gives the same result
+        with self.app.session_scope() as session:
+            session.query(ClaimsState).delete()
+            session.commit()
+        self.assertEqual(get_state(), [])
+        self.assertEqual(self.app.backfill_claims_state(), 3)
+        self.assertEqual(get_state(), expected)
+        
+        # import also updates the state
+        fake_file = BytesIO("b123456789123456789\t0000-0000-0000-0002\tarxiv\tremoved")
+        with mock.patch('ADSOrcid.app.open', return_value=fake_file, create=True):
+            self.app.import_recs(__file__)
+        self.assertEqual(get_state()[2], ('0000-0000-0000-0002', 'b123456789123456789', 'removed'))
+        
+        # another worker inserted the same pair meanwhile; the claims are kept
+        with self.app.session_scope() as session:
+            session.execute(ClaimsState.__table__.insert().values(
+                orcidid='0000-0000-0000-0003', bibcode='b123456789123456789', status='claimed'))
+            session.commit()
+        self.app.insert_claims([
+                    {'bibcode': 'b123456789123456789', 'orcidid': '0000-0000-0000-0003', 'status': 'removed'}])
+        self.assertEqual(get_state()[3], ('0000-0000-0000-0003', 'b123456789123456789', 'removed'))
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(ClaimsLog).filter_by(orcidid='0000-0000-0000-0003').count(), 1)
+
+
+    def test_import_recs_batches(self):
+        """Claims are inserted (and reported) in batches; gzipped files are ok"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'claims.gz')
+            fo = gzip.open(fname, 'wb')
+            fo.write("\n".join(["b123456789123456789\t0000-0000-0000-%04d" % i for i in range(25)] + 
+                               ["b123456789123456789\t0000-0000-0000-0001\tarxiv\tfoo", "# comment"]))
+            fo.close()
+            
+            batches = []
+            num = self.app.import_recs(fname, batch_size=10, callback=batches.append)
+            self.assertEqual(num, 25)
+            self.assertEqual([len(x) for x in batches], [10, 10, 5])
+            self.assertDictContainsSubset({'bibcode': 'b123456789123456789', 'orcidid': '0000-0000-0000-0000', 
+                                           'status': 'claimed', 'provenance': fname, 'id': None},
+                                          batches[0][0])
+            self.assertEqual(self.app._session.query(ClaimsLog).count(), 25)
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    
     @httpretty.activate
     def test_harvest_author_info(self):
         """
@@ -166,6 +242,12 @@ class TestAdsOrcidCelery(unittest.TestCase):
     def test_update_author(self):
         """Has to update AuthorInfo and also create a log of events about the changes."""
         
+        # the info is harvested every time (instead of refreshing it in the background)
+        self.app._config['AUTHOR_INFO_FRESHNESS'] = 0
+        p = patch.object(self.app, '_get_author_profiles', return_value=[])
+        p.start()
+        self.addCleanup(p.stop)
+        
         # bootstrap the db with already existing author info
         with self.app.session_scope() as session:
             ainfo = AuthorInfo(orcidid='0000-0003-2686-9241',
@@ -232,6 +314,279 @@ class TestAdsOrcidCelery(unittest.TestCase):
                                               session.query(ChangeLog).filter_by(key='0000-0003-2686-9241:update:author').first().toJSON())
  
 
+    @httpretty.activate
+    def test_update_author_unchanged(self):
+        """When the profiles didn't change, the author is not harvested again"""
+        orcidid = '0000-0003-2686-9241'
+        self.app._config['AUTHOR_INFO_FRESHNESS'] = 0
+        app.clear_caches()
+        for url in (self.app.conf['API_ORCID_PROFILE_ENDPOINT'] % orcidid, 
+                    self.app.conf['API_ORCID_EXPORT_PROFILE'] % orcidid):
+            httpretty.register_uri(httpretty.GET, url, responses=[
+                httpretty.Response(body='{"foo": "bar"}', status=200, adding_headers={'ETag': '"v1"'}),
+                httpretty.Response(body='', status=304),
+                httpretty.Response(body='{"foo": "baz"}', status=200, adding_headers={'ETag': '"v2"'}),
+                ])
+        with self.app.session_scope() as session:
+            session.add(AuthorInfo(orcidid=orcidid, name=u'Stern, D K', facts=json.dumps({'name': u'Stern, D K'}),
+                                   updated=utils.get_date('2017-01-01T00:00:00Z')))
+            session.commit()
+        
+        def update_author():
+            with self.app.session_scope() as session:
+                author = session.query(AuthorInfo).filter_by(orcidid=orcidid).first()
+                return self.app.update_author(author)
+        
+        with patch.object(self.app, 'harvest_author_info', return_value={'name': u'Sternx, D K'}) as harvest:
+            self.assertEqual(update_author()['name'], u'Sternx, D K')
+            self.assertEqual(harvest.call_count, 1)
+            # built from the responses we got (not from the cached profiles)
+            self.assertEqual(harvest.call_args[1]['profiles'], [{'foo': 'bar'}, {'foo': 'bar'}])
+            
+            # not modified (we asked only for a newer version)
+            out = update_author()
+            self.assertEqual(harvest.call_count, 1)
+            self.assertEqual(httpretty.last_request().headers.get('If-None-Match'), '"v1"')
+            self.assertTrue(out['updated'] > '2017-01-01')
+            
+            # changed
+            update_author()
+            self.assertEqual(harvest.call_count, 2)
+            self.assertEqual(harvest.call_args[1]['profiles'], [{'foo': 'baz'}, {'foo': 'baz'}])
+    
+    
+    def test_stale_author(self):
+        """Stale author info is served from the db and refreshed in the background"""
+        self.app._config['AUTHOR_INFO_FRESHNESS'] = 3600
+        p = patch.object(self.app, '_get_author_profiles', return_value=[])
+        p.start()
+        self.addCleanup(p.stop)
+        with self.app.session_scope() as session:
+            session.add(AuthorInfo(orcidid='0000-0003-2686-9241', name=u'Stern, D K',
+                                   facts=json.dumps({'name': u'Stern, D K'}),
+                                   updated=utils.get_date('2017-01-01T00:00:00Z')))
+            session.add(AuthorInfo(orcidid='0000-0003-3041-2092', name=u'Fresh, D K',
+                                   facts=json.dumps({'name': u'Fresh, D K'})))
+            session.commit()
+        
+        app.clear_caches()
+        with mock.patch.object(self.app, 'harvest_author_info') as harvest, \
+            mock.patch.object(self.app, 'send_task') as send_task:
+            self.assertEqual(self.app.retrieve_orcid('0000-0003-3041-2092')['name'], u'Fresh, D K')
+            self.assertEqual(send_task.call_count, 0)
+            
+            self.assertEqual(self.app.retrieve_orcid('0000-0003-2686-9241')['name'], u'Stern, D K')
+            send_task.assert_called_once_with('ADSOrcid.tasks.task_refresh_author', 
+                                              args=('0000-0003-2686-9241',), queue='refresh-author')
+            self.assertFalse(harvest.called)
+            
+            # the refresh is scheduled only once (while the lease is held)
+            self.assertFalse(self.app.request_author_refresh('0000-0003-2686-9241'))
+            self.assertEqual(send_task.call_count, 1)
+        
+        with mock.patch.object(self.app, 'harvest_author_info', return_value={'name': u'Sternx, D K'}):
+            self.assertEqual(self.app.refresh_author('0000-0003-2686-9241')['name'], u'Sternx, D K')
+        
+        # the lease was released, cached value removed and the info is fresh now
+        self.assertTrue(self.app.acquire_lease('refresh-author:0000-0003-2686-9241', 10))
+        with mock.patch.object(self.app, 'send_task') as send_task:
+            self.assertEqual(self.app.retrieve_orcid('0000-0003-2686-9241')['name'], u'Sternx, D K')
+            self.assertFalse(send_task.called)
+    
+    
+    def test_client_threads(self):
+        """Threads asking for the client at the same time get the same one"""
+        self.app._client = None
+        real_client = app.HttpClient
+        def slow_client(*args, **kwargs):
+            time.sleep(0.05)
+            return real_client(*args, **kwargs)
+        with mock.patch.object(app, 'HttpClient', side_effect=slow_client) as client:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(5)
+            clients = pool.map(lambda x: self.app.client, range(5))
+            pool.close()
+            pool.join()
+            self.assertEqual(client.call_count, 1)
+            self.assertEqual(len(set([id(x) for x in clients])), 1)
+    
+    
+    def test_lease(self):
+        self.assertTrue(self.app.acquire_lease('foo', 10, owner='a'))
+        self.assertFalse(self.app.acquire_lease('foo', 10, owner='b'))
+        self.assertTrue(self.app.acquire_lease('foo', 10, owner='a')) # renewal
+        self.app.release_lease('foo', owner='b')
+        self.assertFalse(self.app.acquire_lease('foo', 10, owner='b'))
+        self.app.release_lease('foo', owner='a')
+        self.assertTrue(self.app.acquire_lease('foo', 10, owner='b'))
+        
+        # expired lease can be taken
+        self.assertTrue(self.app.acquire_lease('bar', -1, owner='a'))
+        self.assertTrue(self.app.acquire_lease('bar', 10, owner='b'))
+        
+        # the lease is renewed while the work runs
+        with mock.patch.object(self.app, 'acquire_lease') as acquire_lease:
+            acquire_lease.return_value = True
+            with self.app.keep_lease('bar', 0.03, 'b'):
+                time.sleep(0.1)
+            self.assertTrue(acquire_lease.call_count >= 2)
+            self.assertEqual(acquire_lease.call_args, mock.call('bar', 0.03, owner='b'))
+            n = acquire_lease.call_count
+            time.sleep(0.05)
+            self.assertEqual(acquire_lease.call_count, n)
+    
+    
+    def test_recheck_interval(self):
+        """The profiles that change get checked more often"""
+        now = utils.get_date()
+        day = 3600 * 24
+        with self.app.session_scope() as session:
+            # checked every 10 days, changed 4 times
+            for i in range(10):
+                created = now - timedelta(days=100 - i * 10)
+                session.add(ClaimsLog(orcidid='active', status='#full-import', created=created))
+                if i in (0, 3, 4, 8):
+                    session.add(ClaimsLog(orcidid='active', bibcode='b%s' % i, status='claimed', created=created))
+                session.add(ClaimsLog(orcidid='active', bibcode='b1', status='unchanged', created=created))
+            # claimed once (long ago), never changed since
+            for i in range(10):
+                created = now - timedelta(days=200 - i * 20)
+                session.add(ClaimsLog(orcidid='dormant', status='#full-import', created=created))
+                session.add(ClaimsLog(orcidid='dormant', bibcode='b1', status=i and 'unchanged' or 'claimed', 
+                                      created=created))
+            session.commit()
+        
+        self.assertAlmostEqual(self.app.estimate_recheck_interval('active') / day, 20.0, places=3)
+        self.assertAlmostEqual(self.app.estimate_recheck_interval('dormant') / day, 100.0, places=3)
+        self.assertEqual(self.app.estimate_recheck_interval('new'), day)
+        
+        # the first interval is estimated (within the limits)
+        self.assertEqual(self.app.get_recheck_interval('active', True), 20 * day)
+        self.assertEqual(self.app.get_recheck_interval('dormant', False), 30 * day)
+        
+        # then it adapts
+        self.app.schedule_recheck('active', 0, interval=day)
+        self.assertEqual(self.app.get_recheck_interval('active', True), day / 2)
+        self.assertEqual(self.app.get_recheck_interval('active', False), day * 1.5)
+        self.app.schedule_recheck('active', 0, interval=3600 * 8)
+        self.assertEqual(self.app.get_recheck_interval('active', True), 3600 * 6)
+    
+    
+    def test_save_author_infos(self):
+        """Harvested info is saved in batches (new authors are created)"""
+        with self.app.session_scope() as session:
+            session.add(AuthorInfo(orcidid='0000-0003-2686-9241', name=u'Stern, D K',
+                                   facts=json.dumps({'name': u'Stern, D K'})))
+            session.add(AuthorInfo(orcidid='0000-0003-3041-2092', name=u'Stern, D K',
+                                   facts=json.dumps({'name': u'Stern, D K'})))
+            session.commit()
+        
+        app.cache.set(app.make_key('0000-0003-2686-9241'), {'name': 'stale'})
+        out = self.app.save_author_infos({
+            '0000-0003-2686-9241': {'name': u'Sternx, D K', 'authorized': True},
+            '0000-0003-3041-2092': {'name': u'Stern, D K'},
+            '0000-0001-0000-0001': {'name': u'Foo, Bar', 'author': [u'Foo, B']},
+            '0000-0001-0000-0002': {'author': []},
+            }, batch_size=2)
+        self.assertEqual(out, {'created': 1, 'updated': 1, 'unchanged': 1, 'failed': 1})
+        self.assertFalse(app.make_key('0000-0003-2686-9241') in app.cache)
+        
+        with self.app.session_scope() as session:
+            a = session.query(AuthorInfo).filter_by(orcidid='0000-0003-2686-9241').first().toJSON()
+            self.assertEqual(a['name'], u'Sternx, D K')
+            self.assertEqual(a['account_id'], 1)
+            self.assertEqual(session.query(ChangeLog).filter_by(key='0000-0003-2686-9241:update:name').count(), 1)
+            a = session.query(AuthorInfo).filter_by(orcidid='0000-0001-0000-0001').first().toJSON()
+            self.assertEqual(a['name'], u'Foo, Bar')
+            self.assertEqual(a['facts'], {'name': u'Foo, Bar', 'author': [u'Foo, B']})
+            self.assertEqual(session.query(AuthorInfo).filter_by(orcidid='0000-0001-0000-0002').count(), 0)
+
+
+    def test_iter_records(self):
+        """Records are read in batches ordered by (updated, id)"""
+        with self.app.session_scope() as session:
+            for i, d in enumerate(['2017-01-02', '2017-01-01', '2017-01-02', '2017-01-02', '2017-01-03']):
+                session.add(Records(bibcode='bibcode%d' % i, authors=json.dumps(['Foo, B']), 
+                                    claims=json.dumps({'verified': ['-']}), 
+                                    updated=utils.get_date(d + 'T00:00:00Z')))
+            session.commit()
+        
+        batches = list(self.app.iter_records('2017-01-02T00:00:00Z', batch_size=2))
+        self.assertEqual([[x['bibcode'] for x in b] for b in batches], 
+                         [['bibcode0', 'bibcode2'], ['bibcode3', 'bibcode4']])
+        self.assertEqual(batches[0][0], {'id': 1, 'bibcode': 'bibcode0', 'authors': ['Foo, B'], 
+                                         'claims': {'verified': ['-']}, 'updated': '2017-01-02T00:00:00+00:00'})
+        
+        # continue after the record (that had the same timestamp as others)
+        batches = list(self.app.iter_records(batches[0][0]['updated'], batch_size=10, last_id=1))
+        self.assertEqual([[x['bibcode'] for x in b] for b in batches], 
+                         [['bibcode2', 'bibcode3', 'bibcode4']])
+        self.assertEqual(list(self.app.iter_records('2017-01-04T00:00:00Z')), [])
+
+
+    @httpretty.activate
+    def test_resolve_identifiers(self):
+        """Identifiers are resolved in batches (one query per batch)"""
+        
+        def request_callback(request, uri, headers):
+            q = request.querystring['q'][0]
+            docs = []
+            if '"2015arXiv150305881C"' in q or '"arXiv:1503.05881"' in q:
+                docs.append({'bibcode': '2015arXiv150305881C', 'identifier': ['2015arXiv150305881C', 'arXiv:1503.05881']})
+            if '"10.1093/mnras/stv1234"' in q:
+                docs.append({'bibcode': '2015MNRAS.451.1234X', 'identifier': ['2015MNRAS.451.1234X', '10.1093/MNRAS/STV1234']})
+            return (200, headers, json.dumps({'response': {'numFound': len(docs), 'docs': docs}}))
+        
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'],
+            content_type='application/json',
+            body=request_callback)
+        
+        res = self.app.resolve_identifiers(['2015arXiv150305881C', 'arXiv:1503.05881', 
+                                            '10.1093/mnras/stv1234', 'foo'], batch_size=2)
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), 2)
+        self.assertEqual(res['2015arXiv150305881C']['bibcode'], '2015arXiv150305881C')
+        self.assertEqual(res['arXiv:1503.05881']['bibcode'], '2015arXiv150305881C')
+        self.assertEqual(res['10.1093/mnras/stv1234']['bibcode'], '2015MNRAS.451.1234X')
+        self.assertFalse('foo' in res)
+    
+    
+    @httpretty.activate
+    def test_resolve_identifiers_errors(self):
+        """Ambiguous results are refused, failures are never hidden"""
+        
+        def request_callback(request, uri, headers):
+            q = request.querystring['q'][0]
+            docs = []
+            if '"10.1/a"' in q: # exact match wins
+                docs.append({'bibcode': 'A1', 'identifier': ['A1', 'doi:10.1/a']})
+                docs.append({'bibcode': 'A2', 'identifier': ['A2', '10.1/A']})
+            if '"10.1/b"' in q: # ambiguous
+                docs.append({'bibcode': 'B1', 'identifier': ['B1', 'doi:10.1/b']})
+                docs.append({'bibcode': 'B2', 'identifier': ['B2', 'DOI:10.1/B']})
+            found = len(docs)
+            if '"10.1/c"' in q and '"10.1/a"' in q: # too many docs, we get only some
+                found += 5
+            return (200, headers, json.dumps({'response': {'numFound': found, 'docs': docs}}))
+        
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'],
+            content_type='application/json',
+            body=request_callback)
+        
+        res = self.app.resolve_identifiers(['10.1/a', '10.1/b', '10.1/c'], batch_size=3)
+        self.assertEqual(res, {'10.1/a': {'bibcode': 'A2', 'identifier': ['A2', '10.1/A']}})
+        # the truncated batch was split
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), 3)
+        
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'],
+            status=503, body='unavailable')
+        self.app.client.max_retries = 0
+        self.assertRaises(Exception, self.app.resolve_identifiers, ['10.1/a'])
+
+
     def test_create_orcid(self):
         """Has to create AuthorInfo and populate it, but not add to database"""
         with mock.patch.object(self.app, 'harvest_author_info', return_value= {'orcid_name': [u'Stern, Daniel'],
@@ -293,18 +648,37 @@ class TestAdsOrcidCelery(unittest.TestCase):
             
             
 
+    def test_retrieve_record(self):
+        """Authors are compared by their hash (and saved only when changed)"""
+        authors = ['Foo, B', 'Bar, F']
+        with mock.patch.object(self.app, 'retrieve_metadata', return_value={'author': authors}):
+            r = self.app.retrieve_record('bibcode')
+            self.assertEquals(r['authors'], authors)
+            self.assertEquals(r['claims'], {})
+            
+            with mock.patch('ADSOrcid.models.decompress_authors') as decompress:
+                self.assertEquals(self.app.retrieve_record('bibcode')['authors'], authors)
+                self.assertFalse(decompress.called)
+        
+        with mock.patch.object(self.app, 'retrieve_metadata', return_value={'author': ['Foo, B']}):
+            self.assertEquals(self.app.retrieve_record('bibcode')['authors'], ['Foo, B'])
+        with self.app.session_scope() as session:
+            self.assertEquals(session.query(Records).filter_by(bibcode='bibcode').first().authors, ['Foo, B'])
+            
+            
+
     def test_get_claims(self):
         """Check the correct logic for discovering difference in the orcid profile."""
         
         orcidid = '0000-0003-3041-2092'
-        def side_effect(x, search_identifiers=False):
-            return {'bibcode': x}
+        def side_effect(identifiers):
+            return dict([(x, {'bibcode': x}) for x in identifiers])
         with mock.patch.object(self.app, 'retrieve_orcid', 
                 return_value={'status': None, 'updated': None, 'name': None, 'created': '2009-09-03T20:56:35.450686+00:00', 
                               'facts': {}, 'orcidid': orcidid, 'id': 1, 'account_id': None} ) as harvest_author_info, \
             mock.patch.object(self.app, '_get_ads_orcid_profile',
                 return_value=json.loads(open(os.path.join(self.app.conf['TEST_DIR'], 'stub_data', orcidid + '.ads.json')).read())) as _, \
-            mock.patch.object(self.app, 'retrieve_metadata', side_effect=side_effect) as retrieve_metadata:
+            mock.patch.object(self.app, 'resolve_identifiers', side_effect=side_effect) as resolve_identifiers:
             
             
             orcid_present, updated, removed = self.app.get_claims(orcidid,
@@ -315,6 +689,9 @@ class TestAdsOrcidCelery(unittest.TestCase):
                          )
             assert len(orcid_present) == 7 and len(updated) == 0 and len(removed) == 0
             
+            # all identifiers were resolved with one call
+            self.assertEqual(resolve_identifiers.call_count, 1)
+            
             # pretend that we have already ran the import
             cdate = utils.get_date('2015-11-05 16:37:33.381000+00:00') # this is the latest moddate from the orcid profile
             self.app.insert_claims([self.app.create_claim(bibcode='', 
@@ -344,5 +721,70 @@ class TestAdsOrcidCelery(unittest.TestCase):
             assert len(orcid_present) == 7 and len(updated) == 0 and len(removed) == 0
         
     
+    @httpretty.activate
+    def test_get_claims_unchanged(self):
+        """Profile that was already imported (and did not change) is skipped"""
+        orcidid = '0000-0003-3041-2092'
+        app.clear_caches()
+        body = open(os.path.join(self.app.conf['TEST_DIR'], 'stub_data', orcidid + '.ads.json')).read()
+        httpretty.register_uri(httpretty.GET, self.app.conf['API_ORCID_EXPORT_PROFILE'] % orcidid, responses=[
+            httpretty.Response(body=body, status=200, adding_headers={'ETag': '"v1"'}),
+            httpretty.Response(body='', status=304),
+            httpretty.Response(body='', status=304),
+            ])
+        
+        def get_claims(force=False):
+            return self.app.get_claims(orcidid, self.app.conf.get('API_TOKEN'), 
+                         self.app.conf.get('API_ORCID_EXPORT_PROFILE') % orcidid, force=force,
+                         orcid_identifiers_order=self.app.conf.get('ORCID_IDENTIFIERS_ORDER', {'bibcode': 9, '*': -1}))
+        
+        with mock.patch.object(self.app, 'retrieve_orcid', return_value={'facts': {}}), \
+            mock.patch.object(self.app, 'resolve_identifiers', 
+                              side_effect=lambda ids: dict([(x, {'bibcode': x}) for x in ids])):
+            self.assertEqual(len(get_claims()[0]), 7)
+            self.app.acknowledge('claims', orcidid)
+            
+            self.assertEqual(get_claims(), ({}, {}, {}))
+            self.assertEqual(len(get_claims(force=True)[0]), 7)
+    
+    
+    @httpretty.activate
+    def test_get_claims_incomplete(self):
+        """Profile that was not resolved completely is never skipped"""
+        orcidid = '0000-0003-3041-2092'
+        app.clear_caches()
+        body = open(os.path.join(self.app.conf['TEST_DIR'], 'stub_data', orcidid + '.ads.json')).read()
+        httpretty.register_uri(httpretty.GET, self.app.conf['API_ORCID_EXPORT_PROFILE'] % orcidid, responses=[
+            httpretty.Response(body=body, status=200, adding_headers={'ETag': '"v1"'}),
+            httpretty.Response(body='', status=304),
+            httpretty.Response(body='', status=304),
+            httpretty.Response(body='', status=304),
+            ])
+        
+        def get_claims():
+            return self.app.get_claims(orcidid, self.app.conf.get('API_TOKEN'), 
+                         self.app.conf.get('API_ORCID_EXPORT_PROFILE') % orcidid,
+                         orcid_identifiers_order=self.app.conf.get('ORCID_IDENTIFIERS_ORDER', {'bibcode': 9, '*': -1}))
+        
+        def resolve(ids):
+            out = dict([(x, {'bibcode': x}) for x in ids])
+            out.pop('2014AAS...22325503A') # nothing found
+            return out
+        
+        with mock.patch.object(self.app, 'retrieve_orcid', return_value={'facts': {}}), \
+            mock.patch.object(self.app, 'resolve_identifiers', side_effect=resolve) as resolve_identifiers:
+            # one work is missing
+            self.assertEqual(len(get_claims()[0]), 6)
+            self.app.acknowledge('claims', orcidid)
+            self.assertEqual(len(get_claims()[0]), 6)
+            
+            # the api failed
+            resolve_identifiers.side_effect = Exception('solr is down')
+            self.assertRaises(Exception, get_claims)
+            self.app.acknowledge('claims', orcidid)
+            resolve_identifiers.side_effect = lambda ids: dict([(x, {'bibcode': x}) for x in ids])
+            self.assertEqual(len(get_claims()[0]), 7)
+        
+        
 if __name__ == '__main__':
     unittest.main()
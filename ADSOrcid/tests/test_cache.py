@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from mock import patch
+from ADSOrcid import cache
+
+
+class FakeRedis(object):
+    """Local stand-in for the redis client"""
+    def __init__(self):
+        self.data = {}
+    def get(self, k):
+        v = self.data.get(k, None)
+        if v and v[1] > time.time():
+            return v[0]
+    def setex(self, k, ttl, v):
+        self.data[k] = (v, time.time() + ttl)
+    def delete(self, *keys):
+        for k in keys:
+            self.data.pop(k, None)
+    def scan_iter(self, match='*'):
+        return [k for k in self.data.keys() if fnmatch.fnmatch(k, match)]
+
+
+
+test_cache = cache.Cache('test_cache')
+
+def tearDownModule():
+    test_cache.unregister()
+
+class Foo(object):
+    def __init__(self):
+        self.calls = 0
+    @cache.cached(test_cache)
+    def bar(self, x, y=None):
+        self.calls += 1
+        return {'x': x, 'y': y}
+
+
+
+class TestCache(unittest.TestCase):
+    
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+    
+    
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        test_cache.configure('memory')
+        shutil.rmtree(self.tmpdir)
+    
+    
+    def _check_backend(self, c, check_expiry=True):
+        c.set('foo', {'bar': [1, 2]})
+        self.assertEqual(c.get('foo'), {'bar': [1, 2]})
+        self.assertTrue('foo' in c)
+        self.assertEqual(c.get('baz', 'default'), 'default')
+        c.delete('foo')
+        self.assertFalse('foo' in c)
+        c.set('foo', 1)
+        c.clear()
+        self.assertFalse('foo' in c)
+        
+        # entries expire
+        if not check_expiry:
+            return
+        c.set('foo', 1)
+        with patch.object(cache.time, 'time', return_value=time.time() + c.ttl + 1):
+            self.assertFalse('foo' in c)
+    
+    
+    def test_backends(self):
+        c = cache.Cache('test_backends', maxsize=10, ttl=60, register=False)
+        self._check_backend(c, check_expiry=False)
+        c.configure('sqlite', path=os.path.join(self.tmpdir, 'cache.sqlite'))
+        self._check_backend(c)
+        c.configure('redis', client=FakeRedis())
+        c.set('foo', 1)
+        self.assertEqual(c.get('foo'), 1)
+        c.clear()
+        self.assertEqual(c.get('foo'), None)
+        
+        with self.assertRaises(Exception):
+            c.configure('foo')
+        
+        # redis backend without the redis package
+        with patch.dict('sys.modules', {'redis': None}):
+            with self.assertRaisesRegexp(Exception, 'needs the redis package'):
+                c.configure('redis', url='redis://localhost:6379/0')
+    
+    
+    def test_sqlite_shared(self):
+        """Two caches using the same file see the same values; the size is bounded"""
+        path = os.path.join(self.tmpdir, 'cache.sqlite')
+        c1 = cache.SqliteBackend(namespace='x', maxsize=5, ttl=60, path=path, purge_every=1)
+        c2 = cache.SqliteBackend(namespace='x', maxsize=5, ttl=60, path=path)
+        c3 = cache.SqliteBackend(namespace='y', maxsize=5, ttl=60, path=path)
+        c1.set('foo', 'bar')
+        self.assertEqual(c2.get('foo'), 'bar')
+        self.assertEqual(c3.get('foo'), None)
+        
+        for i in range(20):
+            c1.set(str(i), i)
+        self.assertEqual(c1._get_conn().execute('SELECT count(*) FROM cache WHERE namespace=?', ('x',)).fetchone()[0], 5)
+    
+    
+    def test_cached(self):
+        cache.configure_caches({'CACHE_BACKEND': 'sqlite', 
+                                'CACHE_SQLITE_PATH': os.path.join(self.tmpdir, 'cache.sqlite'),
+                                'CACHE_SETTINGS': {'test_cache': {'ttl': 10}}})
+        c = test_cache
+        self.assertTrue(isinstance(c.backend, cache.SqliteBackend))
+        self.assertEqual(c.backend.ttl, 10)
+        
+        foo = Foo()
+        self.assertEqual(foo.bar('a', y=u'b'), {'x': 'a', 'y': 'b'})
+        self.assertEqual(foo.bar(u'a', y='b'), {'x': 'a', 'y': 'b'})
+        self.assertEqual(foo.calls, 1)
+        foo.bar('a')
+        self.assertEqual(foo.calls, 2)
+        
+        cache.clear_all()
+        foo.bar('a')
+        self.assertEqual(foo.calls, 3)
+    
+    
+    def test_stats(self):
+        for backend, kwargs in (('memory', {}), ('sqlite', {'path': os.path.join(self.tmpdir, 'c.sqlite'), 
+                                                           'purge_every': 1})):
+            c = cache.Cache('stats_' + backend, maxsize=3)
+            self.addCleanup(c.unregister)
+            c.configure(backend, **kwargs)
+            self.assertEqual(c.get('foo'), None)
+            c.set('foo', 1)
+            self.assertEqual(c.get('foo'), 1)
+            for i in range(5):
+                c.set(str(i), i)
+            self.assertEqual(c.stats(), {'hits': 1, 'misses': 1, 'evictions': 3})
+            self.assertEqual(cache.all_stats()['stats_' + backend], c.stats())
+        
+        # unregistered caches are left alone
+        c.unregister()
+        self.assertFalse('stats_sqlite' in cache.all_stats())
+        cache.configure_caches({})
+        self.assertTrue(isinstance(c.backend, cache.SqliteBackend))
+        
+        
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import httpretty
+import mock
+import threading
+import time
+from ADSOrcid import cache, client
+
+
+class TestHttpClient(unittest.TestCase):
+    
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.client = client.HttpClient(max_retries=2, backoff_factor=0.01)
+    
+    
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.client.close()
+    
+    
+    @httpretty.activate
+    def test_retries(self):
+        """Failed requests are retried; stats are collected per endpoint"""
+        httpretty.register_uri(
+            httpretty.GET, 'http://example.com/foo',
+            responses=[
+                httpretty.Response(body='busy', status=503, adding_headers={'Retry-After': '0'}),
+                httpretty.Response(body='busy', status=500),
+                httpretty.Response(body='{"foo": "bar"}', status=200),
+            ])
+        
+        with mock.patch.object(client.time, 'sleep') as sleep:
+            r = self.client.get('http://example.com/foo', endpoint='foo')
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.json(), {'foo': 'bar'})
+            self.assertEqual([x[0][0] for x in sleep.call_args_list], [0.0, 0.02])
+        
+        stats = self.client.stats()
+        self.assertEqual(stats['foo']['calls'], 3)
+        self.assertEqual(stats['foo']['retries'], 2)
+        self.assertEqual(stats['foo']['status'], {503: 1, 500: 1, 200: 1})
+        
+        # when retries are exhausted, we get the last response
+        httpretty.register_uri(
+            httpretty.GET, 'http://example.com/bar',
+            body='error', status=502)
+        with mock.patch.object(client.time, 'sleep') as sleep:
+            r = self.client.get('http://example.com/bar')
+            self.assertEqual(r.status_code, 502)
+        self.assertEqual(self.client.stats()['example.com']['calls'], 3)
+        
+        # errors which are not worth retrying are returned immediately
+        httpretty.register_uri(
+            httpretty.GET, 'http://example.com/baz',
+            body='missing', status=404)
+        self.client.reset_stats()
+        r = self.client.get('http://example.com/baz', endpoint='baz')
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(self.client.stats()['baz']['calls'], 1)
+    
+    
+    def test_concurrency(self):
+        """Number of requests in flight is limited per endpoint"""
+        c = client.HttpClient(concurrency={'foo': 2, '*': 3})
+        state = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+        
+        def request(method, url, **kwargs):
+            with lock:
+                state['now'] += 1
+                state['max'] = max(state['max'], state['now'])
+            time.sleep(0.02)
+            with lock:
+                state['now'] -= 1
+            return mock.Mock(status_code=200)
+        
+        for endpoint, limit in (('foo', 2), ('bar', 3)):
+            state['max'] = 0
+            with mock.patch.object(c._get_session(endpoint), 'request', side_effect=request):
+                threads = [threading.Thread(target=c.get, args=('http://example.com/',), 
+                                            kwargs={'endpoint': endpoint}) for _ in range(8)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            self.assertEqual(state['max'], limit)
+            self.assertEqual(c.stats()[endpoint]['calls'], 8)
+        
+        # no limit
+        self.assertEqual(client.HttpClient()._get_semaphore('foo'), None)
+    
+    
+    @httpretty.activate
+    def test_conditional_get(self):
+        """Responses are cached and only newer versions downloaded"""
+        c = client.HttpClient(response_cache=cache.Cache('test_responses', register=False))
+        httpretty.register_uri(
+            httpretty.GET, 'http://example.com/foo',
+            responses=[
+                httpretty.Response(body='{"foo": "bar"}', status=200, 
+                                   adding_headers={'ETag': '"v1"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+                httpretty.Response(body='', status=304),
+                httpretty.Response(body='{"foo": "bar"}', status=200),
+                httpretty.Response(body='{"foo": "baz"}', status=200),
+            ])
+        
+        r = c.get('http://example.com/foo', conditional=True, params={'a': 1})
+        self.assertEqual((r.json(), r.from_cache), ({'foo': 'bar'}, False))
+        self.assertTrue(c.is_changed(r, 'x'))
+        c.acknowledge(r, 'x')
+        self.assertFalse(c.is_changed(r, 'x'))
+        
+        r = c.get('http://example.com/foo', conditional=True, params={'a': 1})
+        self.assertEqual(httpretty.last_request().headers.get('If-None-Match'), '"v1"')
+        self.assertEqual(httpretty.last_request().headers.get('If-Modified-Since'), 'Wed, 21 Oct 2015 07:28:00 GMT')
+        self.assertEqual((r.status_code, r.json(), r.from_cache), (200, {'foo': 'bar'}, True))
+        self.assertFalse(c.is_changed(r, 'x'))
+        self.assertTrue(c.is_changed(r, 'y'))
+        
+        # server doesn't support conditional requests, but the content is the same
+        r = c.get('http://example.com/foo', conditional=True, params={'a': 1})
+        self.assertEqual(r.from_cache, False)
+        self.assertFalse(c.is_changed(r, 'x'))
+        
+        r = c.get('http://example.com/foo', conditional=True, params={'a': 1})
+        self.assertTrue(c.is_changed(r, 'x'))
+        
+        # responses of unconditional requests are always 'changed'
+        self.assertTrue(c.is_changed(c.get('http://example.com/foo'), 'x'))
+    
+    
+    def test_parse_retry_after(self):
+        self.assertEqual(client.parse_retry_after('120'), 120.0)
+        self.assertEqual(client.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+        self.assertEqual(client.parse_retry_after('foo'), None)
+        
+        
+if __name__ == '__main__':
+    unittest.main()
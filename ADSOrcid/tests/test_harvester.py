@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import mock
+from ADSOrcid import app
+from ADSOrcid.harvester import Harvester
+from ADSOrcid.models import AuthorInfo, Base
+
+
+class TestHarvester(unittest.TestCase):
+    
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.app = app.ADSOrcidCelery('test', local_config={
+            'SQLALCHEMY_URL': 'sqlite:///',
+            'SQLALCHEMY_ECHO': False,
+            'HTTP_RATE_LIMIT_BACKEND': 'memory'
+            })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+    
+    
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+    
+    
+    def test_harvest(self):
+        """Authors are harvested in parallel and saved in batches"""
+        def harvest_author_info(orcidid, name=None, facts=None):
+            if orcidid.endswith('9'):
+                raise Exception('API error')
+            return {'name': u'Author, {0}'.format(orcidid[-1])}
+        
+        batches = []
+        save_author_infos = self.app.save_author_infos
+        def save(infos, batch_size=None):
+            batches.append(len(infos))
+            return save_author_infos(infos, batch_size=batch_size)
+        
+        orcidids = ['0000-0001-0000-000%d' % i for i in range(10)]
+        with mock.patch.object(self.app, 'harvest_author_info', side_effect=harvest_author_info), \
+            mock.patch.object(self.app, 'save_author_infos', side_effect=save):
+            stats = Harvester(self.app, threads=4, batch_size=4).harvest(iter(orcidids))
+        self.assertEqual(batches, [4, 4, 1])
+        
+        self.assertEqual(stats, {'harvested': 9, 'errors': 1, 'created': 9, 'updated': 0,
+                                 'unchanged': 0, 'failed': 0})
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(AuthorInfo).count(), 9)
+            self.assertEqual(session.query(AuthorInfo).filter_by(orcidid='0000-0001-0000-0003').first().name,
+                             u'Author, 3')
+        
+        # errors are reported (not raised) by fetch
+        with mock.patch.object(self.app, 'harvest_author_info', side_effect=harvest_author_info):
+            out = dict([(x[0], x) for x in Harvester(self.app, threads=2).fetch(orcidids[8:])])
+        self.assertEqual(out['0000-0001-0000-0008'][1], {'name': u'Author, 8'})
+        self.assertEqual(str(out['0000-0001-0000-0009'][2]), 'API error')
+        
+        
+if __name__ == '__main__':
+    unittest.main()
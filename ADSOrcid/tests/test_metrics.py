@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+import httpretty
+from ADSOrcid import app, metrics, tasks
+from ADSOrcid.exceptions import IgnorableException
+from ADSOrcid.models import Base
+
+
+class TestMetrics(unittest.TestCase):
+    
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+    
+    
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+    
+    
+    def test_metrics(self):
+        m = metrics.Metrics(namespace='test', const_labels={'host': 'a'})
+        m.describe('duration', 'histogram', 'Duration', buckets=(1, 0.1))
+        m.inc('calls', endpoint='x')
+        m.inc('calls', 2, endpoint='x')
+        m.set('size', 5)
+        m.observe('duration', 0.05, task='t')
+        m.observe('duration', 0.5, task='t')
+        m.observe('duration', 5, task='t')
+        m.register_collector(lambda: [('hits_total', 'counter', 'Hits', [({'cache': 'c"1'}, 7)])])
+        
+        self.assertEqual(m.get('calls', endpoint='x'), 3)
+        self.assertEqual(m.get('calls', endpoint='y'), None)
+        self.assertEqual(m.get('duration', task='t'), [1, 2, 5.55, 3])
+        
+        self.assertEqual(m.render().splitlines(), [
+            '# HELP test_calls calls',
+            '# TYPE test_calls counter',
+            'test_calls{host="a",endpoint="x"} 3.0',
+            '# HELP test_duration Duration',
+            '# TYPE test_duration histogram',
+            'test_duration_bucket{host="a",task="t",le="0.1"} 1.0',
+            'test_duration_bucket{host="a",task="t",le="1.0"} 2.0',
+            'test_duration_bucket{host="a",task="t",le="+Inf"} 3.0',
+            'test_duration_sum{host="a",task="t"} 5.55',
+            'test_duration_count{host="a",task="t"} 3.0',
+            '# HELP test_size size',
+            '# TYPE test_size gauge',
+            'test_size{host="a"} 5.0',
+            '# HELP test_hits_total Hits',
+            '# TYPE test_hits_total counter',
+            'test_hits_total{host="a",cache="c\\"1"} 7.0'])
+        
+        path = m.write_textfile(os.path.join(self.tmpdir, 'prom'))
+        self.assertEqual(path, os.path.join(self.tmpdir, 'prom', 'test_{0}.prom'.format(os.getpid())))
+        with open(path) as f:
+            self.assertTrue('test_size{host="a",process="%s"} 5.0' % os.getpid() in f.read())
+        self.assertEqual(m.write_textfile(os.path.join(self.tmpdir, 'prom'), interval=60), None)
+        
+        # files of the processes that are gone get removed
+        dead = os.path.join(self.tmpdir, 'prom', 'test_999999999.prom')
+        other = os.path.join(self.tmpdir, 'prom', 'other_999999999.prom')
+        for p in (dead, other):
+            open(p, 'w').close()
+        m2 = metrics.Metrics(namespace='test')
+        m2.write_textfile(os.path.join(self.tmpdir, 'prom'))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, 'prom'))), 
+                         ['other_999999999.prom', 'test_{0}.prom'.format(os.getpid())])
+        
+        m.reset()
+        self.assertEqual(m.get('calls', endpoint='x'), None)
+    
+    
+    @httpretty.activate
+    def test_app_metrics(self):
+        """Tasks, db sessions, http calls and caches are measured"""
+        a = app.ADSOrcidCelery('test', local_config=\
+            {
+            'SQLALCHEMY_URL': 'sqlite:///',
+            'SQLALCHEMY_ECHO': False,
+            'HTTP_MAX_RETRIES': 0,
+            'HTTP_RATE_LIMIT_BACKEND': 'memory',
+            'METRICS_TEXTFILE_DIR': self.tmpdir
+            })
+        Base.metadata.bind = a._session.get_bind()
+        Base.metadata.create_all()
+        try:
+            @a.task()
+            def task_foo(x):
+                if x is None:
+                    raise IgnorableException('nothing to do')
+                with a.session_scope() as session:
+                    pass
+                return a.client.get('http://localhost/foo', endpoint='foo').status_code
+            
+            httpretty.register_uri(httpretty.GET, 'http://localhost/foo', status=200, body='')
+            self.assertEqual(task_foo(1), 200)
+            self.assertRaises(IgnorableException, task_foo, None)
+            
+            m = a.metrics
+            self.assertEqual(m.get('tasks_total', task=task_foo.name, status='success'), 1)
+            self.assertEqual(m.get('tasks_total', task=task_foo.name, status='ignored'), 1)
+            self.assertEqual(m.get('task_duration_seconds', task=task_foo.name)[-1], 2)
+            self.assertEqual(m.get('db_session_seconds')[-1], 1)
+            self.assertEqual(m.get('http_request_duration_seconds', endpoint='foo')[-1], 1)
+            self.assertEqual(m.get('http_requests_total', endpoint='foo', status=200), 1)
+            
+            app.orcid_cache.get('nonexistent')
+            self.assertTrue('adsorcid_cache_misses_total{cache="orcid_cache"}' in m.render())
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'adsorcid_{0}.prom'.format(os.getpid()))))
+        finally:
+            Base.metadata.drop_all()
+            a.close_app()
+
+
+if __name__ == '__main__':
+    unittest.main()
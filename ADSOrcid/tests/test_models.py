@@ -5,8 +5,10 @@
 from datetime import datetime
 import unittest
 import adsputils as utils
-from ADSOrcid.models import ClaimsLog, Records, AuthorInfo, Base
+from ADSOrcid.models import ClaimsLog, Records, AuthorInfo, Base, authors_hash, stream_columns
 from ADSOrcid import app
+import json
+import mock
 
 class Test(unittest.TestCase):
     
@@ -86,6 +88,58 @@ class Test(unittest.TestCase):
             rec.updated = utils.get_date()
             session.commit()
 
+
+    def test_compressed_authors(self):
+        """Authors are stored compressed and decoded only when accessed"""
+        authors = [u'Foo, B\xe1r %d' % i for i in range(3000)]
+        with self.app.session_scope() as session:
+            session.add(Records(bibcode='foo', authors=json.dumps(authors)))
+            session.add(Records(bibcode='bar'))
+            session.commit()
+        
+        with self.app.session_scope() as session:
+            rec = session.query(Records).filter_by(bibcode='foo').first()
+            self.assertTrue(len(rec.authors_z) < len(json.dumps(authors)) / 5)
+            self.assertEquals(rec.authors_hash, authors_hash(authors))
+            
+            with mock.patch('ADSOrcid.models.decompress_authors', return_value=authors) as decompress:
+                self.assertEquals(rec.toJSON(exclude=('authors',)).get('authors'), None)
+                self.assertEquals(decompress.call_count, 0)
+                self.assertEquals(rec.authors, authors)
+                self.assertEquals(rec.toJSON()['authors'], authors)
+                self.assertEquals(decompress.call_count, 1)
+            
+            rec.authors = ['Bar, F']
+            self.assertEquals(rec.authors, ['Bar, F'])
+            self.assertEquals(rec.authors_hash, authors_hash(['Bar, F']))
+            session.commit()
+            
+            rec = session.query(Records).filter_by(bibcode='bar').first()
+            self.assertEquals(rec.authors, [])
+            self.assertEquals(rec.authors_hash, None)
+        
+        with self.app.session_scope() as session:
+            self.assertEquals(session.query(Records).filter_by(bibcode='foo').first().authors, ['Bar, F'])
+
+
+    def test_stream_columns(self):
+        """Projections return plain rows (not tracked by the session)"""
+        with self.app.session_scope() as session:
+            for i in range(5):
+                session.add(ClaimsLog(bibcode='bib%d' % i, orcidid='bar', status='claimed',
+                                      created='2009-09-03T20:56:3%d.450686Z' % i))
+            session.add(ClaimsLog(bibcode='bib9', orcidid='foo', status='removed'))
+            session.commit()
+        
+        with self.app.session_scope() as session:
+            rows = list(stream_columns(session, [ClaimsLog.bibcode, ClaimsLog.status, ClaimsLog.created],
+                                       criterion=[ClaimsLog.orcidid == 'bar'],
+                                       order_by=[ClaimsLog.id.desc()], batch_size=2))
+            self.assertEquals([r.bibcode for r in rows], ['bib4', 'bib3', 'bib2', 'bib1', 'bib0'])
+            self.assertEquals(rows[0], ('bib4', 'claimed', datetime(2009, 9, 3, 20, 56, 34, 450686)))
+            self.assertEquals(utils.get_date(rows[0].created).isoformat(), '2009-09-03T20:56:34.450686+00:00')
+            self.assertEquals(len(session.identity_map), 0)
+
             
 if __name__ == '__main__':
     unittest.main()            
\ No newline at end of file
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import time
+import unittest
+import Levenshtein
+from mock import patch
+import adsputils as utils
+from ADSOrcid import app, tasks
+from ADSOrcid.models import Base
+from ADSOrcid.profiler import Profiler, format_report
+
+
+class TestProfiler(unittest.TestCase):
+    
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self._app = tasks.app
+        self.app = app.ADSOrcidCelery('test', local_config=\
+            {
+            'SQLALCHEMY_URL': 'sqlite:///',
+            'SQLALCHEMY_ECHO': False,
+            'CACHE_SETTINGS': {},
+            'HTTP_RATE_LIMIT_BACKEND': 'memory'
+            })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+    
+    
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+        shutil.rmtree(self.tmpdir)
+    
+    
+    def test_profile(self):
+        loads, ratio, sleep = json.loads, Levenshtein.ratio, time.sleep
+        
+        def get_claims(*args, **kwargs):
+            time.sleep(0.01)
+            return ({'bibcode1': ('Bibcode1', utils.get_date('2017-01-01'), 'provenance'),
+                     'bibcode2': ('Bibcode2', utils.get_date('2017-01-01'), 'provenance')}, {}, {})
+        
+        with patch.object(self.app, 'get_claims', side_effect=get_claims), \
+            patch.object(self.app, 'retrieve_orcid') as retrieve_orcid, \
+            patch.object(self.app, 'retrieve_metadata') as retrieve_metadata:
+            retrieve_orcid.return_value = {'status': None, 'name': u'Stern, D K', 
+                                           'facts': {u'author': [u'Stern, D', u'Stern, D K', u'Stern, Daniel'], 
+                                                     u'orcid_name': [u'Stern, Daniel'], u'author_norm': [u'Stern, D'], 
+                                                     u'name': u'Stern, D K'}, 
+                                           'orcidid': u'0000-0003-3041-2092', 'id': 1, 'account_id': None,
+                                           'updated': utils.get_date('2017-01-01')}
+            retrieve_metadata.return_value = {'author': ['Einstein, A', 'Stern, Dan K.']}
+            
+            profiler = Profiler(self.app, sample_interval=0.001, top=5)
+            report = profiler.profile('0000-0003-3041-2092')
+        
+        self.assertEqual(report['messages'], {'check-orcidid': 1, 'record-claim': 2, 'match-claim': 2, 
+                                              'output-results': 2})
+        self.assertEqual(report['errors'], 0)
+        self.assertTrue(report['db']['calls'] > 0)
+        self.assertTrue(report['levenshtein']['calls'] > 0)
+        self.assertTrue(report['json']['calls'] > 0)
+        self.assertEqual(report['sleep']['calls'], 1)
+        self.assertTrue(report['sleep']['time'] >= 0.01)
+        self.assertEqual(len(report['hotspots']), 5)
+        self.assertTrue('Profile of 0000-0003-3041-2092' in format_report(report))
+        
+        # everything is back in place
+        self.assertTrue(json.loads is loads and Levenshtein.ratio is ratio and time.sleep is sleep)
+        self.assertTrue(tasks.app is self._app)
+        
+        path = os.path.join(self.tmpdir, 'stacks.folded')
+        profiler.write_folded(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(len(lines) > 0)
+        self.assertTrue(all([l.startswith('0000-0003-3041-2092;') for l in lines]))
+        self.assertTrue(any(['get_claims' in l for l in lines]))
+
+
+if __name__ == '__main__':
+    unittest.main()
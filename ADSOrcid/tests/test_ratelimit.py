@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+import httpretty
+import mock
+from ADSOrcid import ratelimit, client
+from ADSOrcid.models import Base
+from sqlalchemy import create_engine
+
+
+class Clock(object):
+    """Fake time; sleeping moves it forward"""
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+    def time(self):
+        return self.now
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+
+
+class TestRateLimiter(unittest.TestCase):
+    
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = Clock()
+        self.patcher = mock.patch.object(ratelimit, 'time', self.clock)
+        self.patcher.start()
+    
+    
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+    
+    
+    def test_token_bucket(self):
+        limiter = ratelimit.RateLimiter({'solr': {'rate': 10, 'burst': 5}})
+        
+        # the burst goes through, then we get 10 req/s
+        for i in range(5):
+            self.assertEqual(limiter.acquire('solr'), 0.0)
+        self.assertAlmostEqual(limiter.acquire('solr'), 0.1)
+        self.assertAlmostEqual(limiter.acquire('solr'), 0.1)
+        
+        # endpoints without a limit are not throttled
+        for i in range(100):
+            self.assertEqual(limiter.acquire('orcid'), 0.0)
+        self.assertEqual(limiter.get_state('orcid'), None)
+        
+        # the bucket is refilled while idle (but only up to the burst)
+        self.clock.now += 100
+        for i in range(5):
+            self.assertEqual(limiter.acquire('solr'), 0.0)
+        self.assertAlmostEqual(limiter.acquire('solr'), 0.1)
+    
+    
+    def test_feedback(self):
+        limiter = ratelimit.RateLimiter({'*': {'rate': 10, 'burst': 1}}, increase=0.25)
+        limiter.acquire('solr')
+        
+        # successful responses don't change anything
+        limiter.feedback('solr', 200)
+        self.assertEqual(limiter.get_state('solr')['factor'], 1.0)
+        
+        # the rate is halved
+        limiter.feedback('solr', 503)
+        self.assertEqual(limiter.get_state('solr')['factor'], 0.5)
+        self.assertAlmostEqual(limiter.acquire('solr'), 0.2)
+        limiter.feedback('solr', 429)
+        self.assertEqual(limiter.get_state('solr')['factor'], 0.25)
+        
+        # retry-after blocks the endpoint (the bucket is refilled meanwhile)
+        limiter.feedback('solr', 429, retry_after=30)
+        self.assertAlmostEqual(limiter.acquire('solr'), 30.0)
+        
+        # and it recovers
+        for i in range(10):
+            limiter.feedback('solr', 200)
+        self.assertEqual(limiter.get_state('solr')['factor'], 1.0)
+        
+        # but never drops under the minimum
+        for i in range(20):
+            limiter.feedback('solr', 500)
+        self.assertEqual(limiter.get_state('solr')['factor'], 0.05)
+    
+    
+    def test_shared(self):
+        """Limiters (e.g. in different processes) share the buckets"""
+        path = os.path.join(self.tmpdir, 'ratelimit.sqlite')
+        l1 = ratelimit.create_limiter({'HTTP_RATE_LIMITS': {'solr': {'rate': 1, 'burst': 2}},
+                                       'HTTP_RATE_LIMIT_BACKEND': 'sqlite', 'CACHE_SQLITE_PATH': path})
+        l2 = ratelimit.create_limiter({'HTTP_RATE_LIMITS': {'solr': {'rate': 1, 'burst': 2}},
+                                       'HTTP_RATE_LIMIT_BACKEND': 'sqlite', 'CACHE_SQLITE_PATH': path})
+        self.assertEqual(l1.acquire('solr'), 0.0)
+        self.assertEqual(l2.acquire('solr'), 0.0)
+        self.assertAlmostEqual(l1.acquire('solr'), 1.0)
+        l2.feedback('solr', 503)
+        self.assertEqual(l1.get_state('solr')['factor'], 0.5)
+        
+        self.assertRaises(Exception, ratelimit.create_limiter, {'HTTP_RATE_LIMIT_BACKEND': 'foo'})
+    
+    
+    def test_db(self):
+        """The buckets can be kept in the database (of the application)"""
+        engine = create_engine('sqlite:///' + os.path.join(self.tmpdir, 'test.db'))
+        Base.metadata.create_all(engine)
+        limits = {'solr': {'rate': 1, 'burst': 2}}
+        l1 = ratelimit.RateLimiter(limits, backend=ratelimit.DatabaseBackend(engine))
+        l2 = ratelimit.RateLimiter(limits, backend=ratelimit.DatabaseBackend(engine))
+        self.assertEqual(l1.acquire('solr'), 0.0)
+        self.assertEqual(l2.acquire('solr'), 0.0)
+        self.assertEqual(l1.acquire('solr'), 1.0)
+        l2.feedback('solr', 503)
+        self.assertEqual(l1.get_state('solr')['factor'], 0.5)
+        
+        # successful responses don't touch the storage unless we are recovering
+        with mock.patch.object(l1.backend, 'update') as update:
+            l1.feedback('solr', 200)
+            self.assertFalse(update.called)
+        with mock.patch.object(l2.backend, 'update') as update:
+            l2.feedback('solr', 200)
+            self.assertTrue(update.called)
+        
+        # sqlite can't lock the rows
+        config = {'HTTP_RATE_LIMITS': limits, 'HTTP_RATE_LIMIT_BACKEND': 'db'}
+        self.assertRaises(Exception, ratelimit.create_limiter, config, engine=engine)
+        
+        # it doesn't work without the database
+        self.assertRaises(Exception, ratelimit.create_limiter, config)
+    
+    
+    @httpretty.activate
+    def test_client(self):
+        """The client asks for a token before every request and reports
+        the responses"""
+        limiter = ratelimit.RateLimiter({'foo': {'rate': 10, 'burst': 1}})
+        c = client.HttpClient(max_retries=1, backoff_factor=0, rate_limiter=limiter)
+        httpretty.register_uri(httpretty.GET, 'http://example.com/foo', 
+                               responses=[httpretty.Response(body='slow down', status=429, 
+                                                             adding_headers={'Retry-After': '5'}),
+                                          httpretty.Response(body='ok', status=200)])
+        with mock.patch.object(client.time, 'sleep'):
+            r = c.get('http://example.com/foo', endpoint='foo')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.clock.slept, [5.0])
+        self.assertAlmostEqual(c.stats()['foo']['throttled'], 5.0)
+        self.assertEqual(limiter.get_state('foo')['factor'], 0.55)
+
+
+if __name__ == '__main__':
+    unittest.main()
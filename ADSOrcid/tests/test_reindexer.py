@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import mock
+import os
+import shutil
+import tempfile
+from ADSOrcid import app, updater
+from ADSOrcid.reindexer import Reindexer
+from ADSOrcid.models import AuthorInfo, Base, KeyValue
+
+
+class TestReindexer(unittest.TestCase):
+    
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmp = tempfile.mkdtemp()
+        self.app = app.ADSOrcidCelery('test', local_config={
+            'SQLALCHEMY_URL': 'sqlite:///' + os.path.join(self.tmp, 'test.db'),
+            'SQLALCHEMY_ECHO': False,
+            'HTTP_RATE_LIMIT_BACKEND': 'memory'
+            })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+        with self.app.session_scope() as session:
+            for i in range(1, 11):
+                session.add(AuthorInfo(id=i, orcidid='0000-0001-0000-%04d' % i, name=u'Author, A'))
+            session.commit()
+    
+    
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+        shutil.rmtree(self.tmp)
+    
+    
+    def test_run_shard(self):
+        """Authors of a shard are read in batches; progress is saved"""
+        seen = []
+        def reindex_all_claims(app, orcidid, since=None, ignore_errors=False):
+            if orcidid.endswith('7'):
+                raise Exception('foo')
+            return orcidid.endswith('5') and ['bibcode'] or []
+        
+        r = Reindexer(self.app, processes=2, batch_size=2, callback=lambda o, c: seen.append(o))
+        with mock.patch.object(updater, 'reindex_all_claims', side_effect=reindex_all_claims):
+            out = r.run_shard(1, 2, '2017-01-01T00:00:00+00:00', '2017-06-01T00:00:00+00:00')
+        
+        self.assertEqual(seen, ['0000-0001-0000-0001', '0000-0001-0000-0003', '0000-0001-0000-0005', 
+                                '0000-0001-0000-0009'])
+        self.assertEqual(out, {'shard': 1, 'authors': 5, 'errors': 1, 'changed': set(['0000-0001-0000-0005'])})
+        self.assertEqual(r.load_checkpoints(), {1: {'shards': 2, 'last_id': 9, 'since': '2017-01-01T00:00:00+00:00',
+                                                    'started': '2017-06-01T00:00:00+00:00'}})
+        
+        r.clear_checkpoints()
+        self.assertEqual(r.load_checkpoints(), {})
+    
+    
+    def test_run(self):
+        """Shards are processed in parallel; interrupted run is resumed"""
+        def reindex_all_claims(app, orcidid, since=None, ignore_errors=False):
+            return orcidid[-1] in '12' and ['bibcode'] or []
+        
+        with mock.patch.object(updater, 'reindex_all_claims', side_effect=reindex_all_claims):
+            out = Reindexer(self.app, processes=3, batch_size=2).run('2017-01-01T00:00:00Z', '2017-06-01T00:00:00Z')
+            self.assertEqual(out['authors'], 10)
+            self.assertEqual(out['changed'], set(['0000-0001-0000-0001', '0000-0001-0000-0002']))
+            self.assertEqual(sorted(Reindexer(self.app).load_checkpoints().keys()), [0, 1, 2])
+        
+            # pretend the run was interrupted: shard 1 (ids 1, 4, 7, 10) stopped after id 4
+            # the number of shards (and dates) is taken from the checkpoints
+            r = Reindexer(self.app, processes=1)
+            r.clear_checkpoints()
+            r.save_checkpoint(1, {'shards': 3, 'last_id': 4, 'since': '2017-02-01T00:00:00+00:00', 
+                                  'started': '2017-06-01T00:00:00Z'})
+            r.save_checkpoint(0, {'shards': 3, 'last_id': 9, 'since': '2017-02-01T00:00:00+00:00', 
+                                  'started': '2017-06-01T00:00:00Z'})
+            out = r.run('2017-01-01T00:00:00Z')
+            self.assertEqual(out['authors'], 2 + 3)
+            self.assertEqual(out['since'], '2017-02-01T00:00:00+00:00')
+            self.assertEqual(out['changed'], set(['0000-0001-0000-0002']))
+        
+        
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import sys
 import os
 import json
+import datetime
 
 from mock import patch, PropertyMock
 import unittest
@@ -8,7 +9,8 @@ import adsputils as utils
 from adsmsg import OrcidClaims
 from ADSOrcid import app
 from ADSOrcid import tasks
-from ADSOrcid.models import Base
+from ADSOrcid.models import Base, RecheckSchedule
+from ADSOrcid.exceptions import IgnorableException
 
 
 class TestWorkers(unittest.TestCase):
@@ -20,7 +22,8 @@ class TestWorkers(unittest.TestCase):
         self.app = app.ADSOrcidCelery('test', local_config=\
             {
             'SQLALCHEMY_URL': 'sqlite:///',
-            'SQLALCHEMY_ECHO': False
+            'SQLALCHEMY_ECHO': False,
+            'HTTP_RATE_LIMIT_BACKEND': 'memory'
             })
         tasks.app = self.app # monkey-path the app object
         Base.metadata.bind = self.app._session.get_bind()
@@ -76,8 +79,83 @@ class TestWorkers(unittest.TestCase):
             self.assertEqual([(x[0][0]['bibcode'], x[0][0]['status']) for x in next_task.call_args_list],
                              [('Bibcode2', u'claimed'), ('Bibcode3', u'claimed'), ('Bibcode4', u'removed'), ('Bibcode1', u'unchanged')]
                              )
+            
+            # the next check is in the schedule (not in the queue)
+            self.assertFalse(task_index_orcid_profile.called)
+            with self.app.session_scope() as session:
+                r = session.query(RecheckSchedule).filter_by(orcidid='0000-0003-3041-2092').first()
+                # (no history, the default interval +- jitter)
+                self.assertEqual(r.check_interval, 3600*24)
+                self.assertTrue(r.next_check_at > utils.get_date() + datetime.timedelta(hours=21))
+                self.assertTrue(r.next_check_at < utils.get_date() + datetime.timedelta(hours=27))
 
 
+    def test_task_index_orcid_profile_single_flight(self):
+        """The same profile is queued/indexed only once at a time"""
+        with patch.object(self.app, 'get_claims') as get_claims, \
+            patch.object(self.app, 'insert_claims') as insert_claims, \
+            patch.object(tasks.task_index_orcid_profile, 'delay') as delay, \
+            patch.object(tasks.task_index_orcid_profile, 'apply_async') as apply_async:
+            get_claims.return_value = ({}, {}, {})
+            insert_claims.return_value = []
+            
+            self.assertTrue(tasks.enqueue_orcid_profile({'orcidid': '0000-0003-3041-2092'}))
+            self.assertEqual(tasks.enqueue_orcid_profile({'orcidid': '0000-0003-3041-2092'}), None)
+            self.assertTrue(tasks.enqueue_orcid_profile({'orcidid': '0000-0003-3041-2093'}))
+            self.assertEqual(delay.call_count, 2)
+            self.assertEqual(self.app.metrics.get('index_suppressed_total', reason='queued'), 1)
+            
+            # forced messages are not dropped
+            self.assertTrue(tasks.enqueue_orcid_profile({'orcidid': '0000-0003-3041-2092', 'force': True}))
+            self.assertEqual(delay.call_count, 3)
+            
+            # once the worker gets the message, it can be queued again
+            tasks.task_index_orcid_profile({'orcidid': '0000-0003-3041-2092'})
+            self.assertEqual(get_claims.call_count, 1)
+            self.assertTrue(tasks.enqueue_orcid_profile({'orcidid': '0000-0003-3041-2092'}))
+            
+            # but it is not indexed by two workers at the same time
+            self.assertTrue(self.app.acquire_lease(tasks.RUNNING_LEASE.format('0000-0003-3041-2093'), 10))
+            tasks.task_index_orcid_profile({'orcidid': '0000-0003-3041-2093'})
+            self.assertEqual(get_claims.call_count, 1)
+            self.assertEqual(self.app.metrics.get('index_suppressed_total', reason='running'), 1)
+            
+            # but the update is not lost: the running worker queues the profile again
+            self.assertTrue(self.app.release_lease(tasks.RUNNING_LEASE.format('0000-0003-3041-2093')))
+            get_claims.side_effect = lambda *args, **kwargs: \
+                tasks.task_index_orcid_profile({'orcidid': '0000-0003-3041-2093'}) or ({}, {}, {})
+            n = delay.call_count
+            tasks.task_index_orcid_profile({'orcidid': '0000-0003-3041-2093'})
+            self.assertEqual(get_claims.call_count, 2)
+            self.assertEqual(delay.call_count, n + 1)
+            self.assertEqual(delay.call_args[0][0], {'orcidid': '0000-0003-3041-2093'})
+            self.assertFalse(self.app.release_lease(tasks.DIRTY_LEASE.format('0000-0003-3041-2093')))
+            get_claims.side_effect = None
+            self.assertTrue(self.app.acquire_lease(tasks.RUNNING_LEASE.format('0000-0003-3041-2093'), 10))
+            tasks.task_index_orcid_profile({'orcidid': '0000-0003-3041-2093', 'force': True})
+            self.assertEqual(get_claims.call_count, 2)
+            self.assertEqual(str(apply_async.call_args), 
+                             "call(args=({'orcidid': '0000-0003-3041-2093', 'force': True},), countdown=60)")
+            
+            # the message that failed to get to the queue can be sent again
+            delay.side_effect = Exception('connection problem')
+            self.assertRaises(Exception, tasks.enqueue_orcid_profile, {'orcidid': '0000-0003-3041-2094'})
+            delay.side_effect = None
+            self.assertTrue(tasks.enqueue_orcid_profile({'orcidid': '0000-0003-3041-2094'}))
+    
+    
+    def test_task_index_orcid_profile_failure(self):
+        """Profiles fetched by the failed task are not kept around"""
+        def get_claims(orcidid, *args, **kwargs):
+            self.app._unacknowledged[('claims', orcidid)] = 'response'
+            raise Exception('solr is down')
+        with patch.object(self.app, 'get_claims') as get_claims_mock:
+            get_claims_mock.side_effect = get_claims
+            self.assertRaises(Exception, tasks.task_index_orcid_profile, {'orcidid': '0000-0003-3041-2092'})
+            self.assertEqual(get_claims_mock.call_count, 1)
+            self.assertEqual(self.app._unacknowledged, {})
+    
+    
     def test_task_ingest_claim(self):
         
         with patch.object(self.app, 'retrieve_orcid') as retrieve_orcid, \
@@ -135,6 +213,13 @@ class TestWorkers(unittest.TestCase):
             
             
             
+    def test_task_refresh_author(self):
+        
+        with patch.object(self.app, 'refresh_author') as refresh_author:
+            tasks.task_refresh_author('0000-0003-3041-2092')
+            refresh_author.assert_called_once_with('0000-0003-3041-2092')
+    
+    
     def test_task_match_claim(self):
         
         with patch.object(self.app, 'retrieve_record') as retrieve_record, \
@@ -168,10 +253,102 @@ class TestWorkers(unittest.TestCase):
                              )
             
 
+    def test_task_match_claim_batched(self):
+        """Claims for the same bibcode are applied together"""
+        
+        self.app.conf['MATCH_CLAIM_BATCH_WINDOW'] = 5
+        self.app.conf['MATCH_CLAIM_BATCH_SIZE'] = 3
+        claim = {'status': u'claimed', 'bibcode': 'BIBCODE22', 
+                 u'name': u'Stern, D K', 
+                 u'author': [u'Stern, D', u'Stern, D K', u'Stern, Daniel'],  
+                 'orcidid': '0000-0003-3041-2092', 
+                 u'author_id': 1, u'account_id': None}
+        claim2 = dict(claim, orcidid='0000-0003-3041-2093', author=[u'Munger, C'])
+        claim3 = dict(claim, orcidid='0000-0003-3041-2094', author=[u'Einstein, A'])
+        
+        with patch.object(self.app, 'retrieve_record') as retrieve_record, \
+            patch.object(self.app, 'record_claims') as record_claims, \
+            patch.object(tasks.task_flush_claims, 'apply_async') as flush_task, \
+            patch.object(tasks.task_output_results, 'delay') as next_task:
+            
+            retrieve_record.return_value = {'bibcode': 'BIBCODE22',
+                                            'authors': ['Einstein, A', 'Socrates', 'Stern, D K', 'Munger, C'],
+                                            'claims': {'verified': ['-', '-', '-', '-'],
+                                                       'unverified': ['-', '-', '-', '-']}}
+            
+            tasks.task_match_claim(claim)
+            tasks.task_match_claim(claim2)
+            
+            # the first claim schedules the flush, nothing is applied yet
+            self.assertEqual(flush_task.call_count, 1)
+            self.assertEqual(str(flush_task.call_args), "call(args=('BIBCODE22',), countdown=5)")
+            self.assertFalse(retrieve_record.called)
+            
+            # the window closes
+            tasks.task_flush_claims('BIBCODE22')
+            self.assertEqual(retrieve_record.call_count, 1)
+            self.assertEqual(record_claims.call_count, 1)
+            self.assertEqual(next_task.call_count, 1)
+            self.assertEqual({'bibcode': 'BIBCODE22',
+                              'authors': ['Einstein, A', 'Socrates', 'Stern, D K', 'Munger, C'],
+                              'verified': ['-', '-', '-', '-'], 
+                              'unverified': ['-', '-', '0000-0003-3041-2092', '0000-0003-3041-2093']}, 
+                             next_task.call_args[0][0].toJSON()
+                             )
+            self.assertEqual(self.app.get_pending_claims('BIBCODE22'), ([], []))
+            
+            # the batch is full
+            tasks.task_match_claim(claim)
+            tasks.task_match_claim(claim2)
+            tasks.task_match_claim(claim3)
+            self.assertEqual(flush_task.call_count, 2)
+            self.assertEqual(retrieve_record.call_count, 2)
+            self.assertEqual(next_task.call_count, 2)
+            self.assertEqual(self.app.get_pending_claims('BIBCODE22'), ([], []))
+            
+            # another worker is applying the claims
+            tasks.task_match_claim(claim)
+            self.assertEqual(flush_task.call_count, 3)
+            self.assertTrue(self.app.acquire_lease(tasks.FLUSH_LEASE.format('BIBCODE22'), 60, owner='other'))
+            tasks.task_flush_claims('BIBCODE22')
+            self.assertEqual(retrieve_record.call_count, 2)
+            self.assertEqual(len(self.app.get_pending_claims('BIBCODE22')[1]), 1)
+            self.app.release_lease(tasks.FLUSH_LEASE.format('BIBCODE22'), owner='other')
+            
+            # a failure keeps the claims and tries again later
+            retrieve_record.side_effect = Exception('solr is down')
+            self.assertRaises(Exception, tasks.task_flush_claims, 'BIBCODE22')
+            self.assertEqual(flush_task.call_count, 4)
+            self.assertEqual(str(flush_task.call_args), "call(args=('BIBCODE22', 1), countdown=5)")
+            self.assertEqual(len(self.app.get_pending_claims('BIBCODE22')[1]), 1)
+            
+            # but not for ever
+            self.app.conf['MATCH_CLAIM_MAX_ATTEMPTS'] = 3
+            self.assertRaises(Exception, tasks.task_flush_claims, 'BIBCODE22', 1)
+            self.assertEqual(str(flush_task.call_args), "call(args=('BIBCODE22', 2), countdown=5)")
+            self.assertRaises(Exception, tasks.task_flush_claims, 'BIBCODE22', 2)
+            self.assertEqual(flush_task.call_count, 5)
+            self.assertEqual(self.app.get_pending_claims('BIBCODE22'), ([], []))
+            tasks.task_match_claim(claim)
+            self.assertEqual(flush_task.call_count, 6)
+            
+            # claims that can't ever be applied are discarded
+            retrieve_record.side_effect = IgnorableException('no such record')
+            self.assertRaises(IgnorableException, tasks.task_flush_claims, 'BIBCODE22')
+            self.assertEqual(flush_task.call_count, 6)
+            self.assertEqual(self.app.get_pending_claims('BIBCODE22'), ([], []))
+            
+            # and they don't block the next claims
+            retrieve_record.side_effect = None
+            tasks.task_match_claim(claim2)
+            self.assertEqual(flush_task.call_count, 7)
+            
+    
     def test_task_check_orcid_updates(self):
         
-        with patch.object(tasks.requests, 'get') as get, \
+        with patch.object(self.app.client, 'get') as get, \
             patch.object(tasks.task_index_orcid_profile, 'delay') as next_task, \
+            patch.object(tasks.task_sweep_rechecks, 'delay') as sweep_task, \
             patch.object(tasks.task_check_orcid_updates, 'apply_async') as recheck_task:
             
             #data = open(os.path.join(self.proj_home, 'ADSOrcid/tests/stub_data', '0000-0003-3041-2092.orcid-updates.json'), 'r').read()
@@ -187,7 +364,132 @@ class TestWorkers(unittest.TestCase):
             
             self.assertEqual(next_task.call_args_list[0][0][0]['orcidid'], '0000-0003-3041-2092')
             self.assertEqual(next_task.call_args_list[1][0][0]['orcidid'], '0000-0003-3041-2093')
-            self.assertEqual(str(recheck_task.call_args_list[0]), "call(args=({u'errcount': 0},), countdown=300)")
+            self.assertEqual(sweep_task.call_count, 1)
+            msg = recheck_task.call_args_list[0][1]['args'][0]
+            self.assertEqual(msg['errcount'], 0)
+            self.assertEqual(recheck_task.call_args_list[0][1]['countdown'], 300)
+            
+            # the chain holds the lease, others can't take it
+            self.assertTrue(msg['poller'])
+            self.assertFalse(self.app.acquire_lease(tasks.POLLER_LEASE, 10, owner='other'))
+    
+    
+    def test_task_check_orcid_updates_leader(self):
+        """Only one chain of pollers survives"""
+        with patch.object(self.app.client, 'get') as get, \
+            patch.object(tasks.task_index_orcid_profile, 'delay') as next_task, \
+            patch.object(tasks.task_sweep_rechecks, 'delay') as sweep_task, \
+            patch.object(tasks.task_check_orcid_updates, 'apply_async') as recheck_task:
+            
+            r = PropertyMock()
+            r.text = ''
+            r.status_code = 200
+            get.return_value = r
+            
+            tasks.task_check_orcid_updates({'poller': 'leader'})
+            self.assertEqual(get.call_count, 1)
+            self.assertEqual(recheck_task.call_args[1]['args'][0]['poller'], 'leader')
+            
+            # a stray chain (or manual trigger) dies out
+            tasks.task_check_orcid_updates({'poller': 'stray'})
+            tasks.task_check_orcid_updates({})
+            self.assertEqual(get.call_count, 1)
+            self.assertEqual(recheck_task.call_count, 1)
+            
+            # the leader continues (it only waits for its time)
+            tasks.task_check_orcid_updates({'poller': 'leader'})
+            self.assertEqual(recheck_task.call_count, 2)
+            self.assertTrue(recheck_task.call_args[1]['countdown'] > 290)
+            
+            # when the lease of the (crashed) leader expires, somebody else takes over
+            self.app.release_lease(tasks.POLLER_LEASE)
+            tasks.task_check_orcid_updates({'poller': 'stray'})
+            self.assertEqual(recheck_task.call_count, 3)
+            self.assertEqual(recheck_task.call_args[1]['args'][0]['poller'], 'stray')
+            tasks.task_check_orcid_updates({'poller': 'leader'})
+            self.assertEqual(recheck_task.call_count, 3)
+            self.assertFalse(next_task.called)
+            
+            # the periodic message takes over when the lease expires
+            beat = self.app.conf['CELERYBEAT_SCHEDULE']['check-orcid-updates']
+            self.assertEqual(beat['task'], tasks.task_check_orcid_updates.name)
+            self.assertEqual(beat['schedule'], self.app.conf['ORCID_CHECK_FOR_CHANGES'])
+            tasks.task_check_orcid_updates(*beat['args'])
+            self.assertEqual(recheck_task.call_count, 3)
+            self.assertTrue(self.app.acquire_lease(tasks.POLLER_LEASE, -1, owner='stray'))
+            tasks.task_check_orcid_updates(dict(*beat['args']))
+            self.assertEqual(recheck_task.call_count, 4)
+            self.assertFalse(recheck_task.call_args[1]['args'][0]['poller'] in ('stray', 'leader'))
+    
+    
+    def test_task_sweep_rechecks(self):
+        self.app.schedule_recheck('0000-0003-3041-2092', -100)
+        self.app.schedule_recheck('0000-0003-3041-2093', -200)
+        self.app.schedule_recheck('0000-0003-3041-2094', -300)
+        self.app.schedule_recheck('0000-0003-3041-2095', 100) # not yet
+        self.app.conf['ORCID_RECHECK_BATCH_SIZE'] = 2
+        
+        with patch.object(tasks.task_index_orcid_profile, 'delay') as next_task:
+            tasks.task_sweep_rechecks({})
+            self.assertEqual([x[0][0] for x in next_task.call_args_list],
+                             [{'orcidid': '0000-0003-3041-2094'}, {'orcidid': '0000-0003-3041-2093'},
+                              {'orcidid': '0000-0003-3041-2092'}])
+            
+            # they are not sent again (unless they fail to re-schedule themselves)
+            tasks.task_sweep_rechecks({})
+            self.assertEqual(next_task.call_count, 3)
+            
+            # only one sweep at a time
+            self.assertTrue(self.app.acquire_lease(tasks.SWEEPER_LEASE, 10))
+            self.app.schedule_recheck('0000-0003-3041-2095', -1)
+            tasks.task_sweep_rechecks({})
+            self.assertEqual(next_task.call_count, 3)
+    
+    
+    def test_task_check_orcid_updates_pages(self):
+        """All the pages of updates are read in one go"""
+        pages = [[{'orcid_id': '0000-0003-3041-2092', 'updated': '2017-01-01T00:00:00Z'},
+                  {'orcid_id': '0000-0003-3041-2093', 'updated': '2017-01-02T00:00:00Z'}],
+                 [{'orcid_id': '0000-0003-3041-2094', 'updated': '2017-01-03T00:00:00Z'}],
+                 [{'orcid_id': '0000-0003-3041-2095', 'updated': '2017-01-04T00:00:00Z'}],
+                 []]
+        def get_page(url, **kwargs):
+            data = pages.pop(0)
+            r = PropertyMock()
+            r.text = json.dumps(data)
+            r.json = lambda: data
+            r.status_code = 200
+            return r
+        
+        self.app.conf['ORCID_CHECK_MAX_PAGES'] = 2
+        with patch.object(self.app.client, 'get') as get, \
+            patch.object(tasks.task_index_orcid_profile, 'delay') as next_task, \
+            patch.object(tasks.task_sweep_rechecks, 'delay') as sweep_task, \
+            patch.object(tasks.task_check_orcid_updates, 'apply_async') as recheck_task:
+            get.side_effect = get_page
+            
+            tasks.task_check_orcid_updates({})
+            self.assertEqual(get.call_count, 2)
+            self.assertEqual([x[0][0]['orcidid'] for x in next_task.call_args_list],
+                             ['0000-0003-3041-2092', '0000-0003-3041-2093', '0000-0003-3041-2094'])
+            # the second page started from the checkpoint of the first one
+            self.assertTrue('2017-01-02T00:00:00.000001' in get.call_args_list[1][0][0])
+            self.assertEqual(next_task.call_args_list[2][0][0]['start'], '2017-01-02T00:00:00.000001+00:00')
+            
+            # we hit the limit, the rest is read immediately
+            msg = recheck_task.call_args[1]['args'][0]
+            self.assertEqual(recheck_task.call_args[1]['countdown'], 1)
+            self.assertTrue(msg['catchup'])
+            
+            tasks.task_check_orcid_updates(msg)
+            self.assertEqual(get.call_count, 4)
+            self.assertEqual(next_task.call_count, 4)
+            self.assertEqual(recheck_task.call_args[1]['countdown'], 300)
+            self.assertFalse('catchup' in recheck_task.call_args[1]['args'][0])
+        
+        with self.app.session_scope() as session:
+            kv = session.query(tasks.KeyValue).filter_by(key='last.check').first()
+            self.assertEqual(kv.value, '2017-01-04T00:00:00+00:00')
             
             
 
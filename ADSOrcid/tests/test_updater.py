@@ -3,7 +3,10 @@
 
 
 import unittest
-from ADSOrcid import updater
+import json
+from mock import patch
+from ADSOrcid import app, updater
+from ADSOrcid.models import Base, ClaimsLog, Records
 
 class Test(unittest.TestCase):
     
@@ -140,6 +143,60 @@ class Test(unittest.TestCase):
               ["Frey, Katie"]);
         self.assertEqual(res, 2)
 
+
+    def test_author_index(self):
+        """The index finds exact matches without fuzzy matching and
+        it is reused for the same record"""
+        authors = ["Erdmann, Christopher", "Cote, Ann", "Frey, Katie", "Cote, Ann"]
+        
+        idx = updater.get_author_index(authors, bibcode='2015ApJ...799..123B')
+        self.assertTrue(idx is updater.get_author_index(list(authors), bibcode='2015ApJ...799..123B'))
+        self.assertFalse(idx is updater.get_author_index(authors + ['Foo, Bar'], bibcode='2015ApJ...799..123B'))
+        self.assertFalse(idx is updater.get_author_index(authors))
+        
+        with patch.object(updater.Levenshtein, 'ratio') as ratio:
+            self.assertEqual(idx.find(['Cote, A', 'Cote, Ann']), 1)
+            self.assertFalse(ratio.called)
+        
+        self.assertEqual(idx.find(['Frey, K']), 2)
+        self.assertEqual(idx.find(['Erdmann, C'], min_levenshtein=0.69), 0)
+        self.assertEqual(idx.find(['Accomazzi, Alberto']), -1)
+        self.assertEqual(updater.AuthorIndex([]).find(['Frey, K']), -1)
+        
+        
+    def test_reindex_all_claims(self):
+        """Claims of an author are re-played against the records (in chunks)"""
+        a = app.ADSOrcidCelery('test', local_config={'SQLALCHEMY_URL': 'sqlite:///', 'SQLALCHEMY_ECHO': False})
+        Base.metadata.bind = a._session.get_bind()
+        Base.metadata.create_all()
+        try:
+            orcidid = '0000-0003-2686-9241'
+            with a.session_scope() as session:
+                session.add(Records(bibcode='bibcode1', authors=json.dumps(['Foo, B', 'Stern, Daniel']), claims='{}'))
+                session.add(Records(bibcode='bibcode2', authors=json.dumps(['Stern, D', 'Foo, B']),
+                                    claims=json.dumps({'unverified': [orcidid, '-']})))
+                session.add(Records(bibcode='bibcode3', authors=json.dumps(['Bar, B']), claims='{}'))
+                session.add(Records(bibcode='bibcode4', authors=json.dumps(['Stern, Daniel']), claims='{}'))
+                for bibcode, status in (('bibcode1', 'claimed'), ('bibcode2', 'removed'), 
+                                        ('bibcode3', 'claimed'), ('bibcode5', 'claimed')):
+                    session.add(ClaimsLog(bibcode=bibcode, orcidid=orcidid, status=status))
+                session.commit()
+            
+            with patch.object(a, 'retrieve_orcid', return_value={'facts': {'author': ['Stern, Daniel']}}):
+                r = updater.reindex_all_claims(a, orcidid, chunk_size=2)
+            self.assertEqual(sorted(r), ['bibcode1', 'bibcode2'])
+            
+            with a.session_scope() as session:
+                recs = dict([(x.bibcode, x.toJSON()) for x in session.query(Records).all()])
+            self.assertEqual(recs['bibcode1']['claims'], {'unverified': ['-', orcidid]})
+            self.assertEqual(recs['bibcode2']['claims'], {'unverified': ['-', '-']})
+            self.assertEqual(recs['bibcode3']['claims'], {})
+            self.assertEqual(recs['bibcode4']['claims'], {})
+            self.assertTrue(recs['bibcode1']['updated'] > recs['bibcode4']['updated'])
+        finally:
+            Base.metadata.drop_all()
+            a.close_app()
+            
             
 if __name__ == '__main__':
     unittest.main()            
\ No newline at end of file
@@ -4,19 +4,24 @@ Library for updating papers (db claims/records).
 """
 
 from ADSOrcid import names
-from ADSOrcid.models import ClaimsLog, Records
+from ADSOrcid.models import ClaimsLog, Records, decompress_authors, stream_columns
 from adsputils import get_date, setup_logging
 from datetime import timedelta
-from sqlalchemy.sql.expression import and_
 import Levenshtein
+import cachetools
 import json
-import requests
+import threading
 
 
 logger = setup_logging('updater')     
 
+# author indexes of recently seen records (they are reused when
+# several claims for the same record arrive)
+_index_cache = cachetools.LRUCache(maxsize=256)
+_index_lock = threading.Lock()
 
-def update_record(rec, claim, min_levenshtein):
+
+def update_record(rec, claim, min_levenshtein=0.9):
     """
     update the ADS Record; we'll add ORCID information into it 
     (at the correct position)
@@ -72,7 +77,8 @@ def update_record(rec, claim, min_levenshtein):
         if fx in claim and claim[fx]:
             
             assert(isinstance(claim[fx], list))
-            idx = find_orcid_position(rec['authors'], claim[fx], min_levenshtein=min_levenshtein)
+            idx = find_orcid_position(rec['authors'], claim[fx], min_levenshtein=min_levenshtein,
+                                      bibcode=rec.get('bibcode', None))
             if idx > -1:              
                 if idx >= num_authors:
                     logger.error(u'Index is beyond list boundary: \n' + 
@@ -90,54 +96,106 @@ def update_record(rec, claim, min_levenshtein):
         return ('removed', -1)
 
 def find_orcid_position(authors_list, name_variants,
-                        min_levenshtein=0.9):
+                        min_levenshtein=0.9, bibcode=None):
     """
     Find the position of ORCID in the list of other strings
     
     :param authors_list - array of names that will be searched
     :param name_variants - array of names of a single author
+    :param bibcode - if given, the index of the names will be
+        cached (and reused by the following calls)
     
     :return list of positions that match
     """
-    al = [names.cleanup_name(x).lower().encode('utf8') for x in authors_list]
-    nv = [names.cleanup_name(x).lower().encode('utf8') for x in name_variants]
-    
-    # compute similarity between all authors (and the supplied variants)
-    # this is not very efficient, however the lists should be small
-    # and short, so 3000 operations take less than 1s)
-    res = []
-    aidx = vidx = 0
-    for variant in nv:
-        aidx = 0
-        for author in al:
-            res.append((Levenshtein.ratio(author, variant), aidx, vidx))
-            aidx += 1
-        vidx += 1
-        
-    # sort results from the highest match
-    res = sorted(res, key=lambda x: x[0], reverse=True)
+    return get_author_index(authors_list, bibcode=bibcode) \
+        .find(name_variants, min_levenshtein=min_levenshtein)
+
+
+
+class AuthorIndex(object):
+    """
+    Normalized names of the authors of one record; exact matches
+    are found by a lookup, the (expensive) fuzzy matching is done
+    only when there is no exact match.
+    """
     
-    if len(res) == 0:
-        return -1
+    def __init__(self, authors_list):
+        self.names = [names.cleanup_name(x).lower().encode('utf8') for x in authors_list]
+        self.positions = {}
+        for i, n in enumerate(self.names):
+            self.positions.setdefault(n, i)
     
-    if res[0][0] < min_levenshtein:
-        # test submatch (0.6470588235294118, 19, 0) (required:0.69) closest: vernetto, s, variant: vernetto, silvia teresa
-        author_name = al[res[0][1]]
-        variant_name = nv[res[0][2]]
-        if author_name in variant_name or variant_name in author_name:
-            logger.debug(u'Using submatch for: %s (required:%s) closest: %s, variant: %s' \
-                        % (res[0], min_levenshtein, 
-                           unicode(author_name, 'utf-8'), 
-                           unicode(variant_name, 'utf-8')))
-            return res[0][1]
-            
-        logger.debug(u'No match found: the closest is: %s (required:%s) closest: %s, variant: %s' \
-                        % (res[0], min_levenshtein, 
-                           unicode(author_name, 'utf-8'), 
-                           unicode(variant_name, 'utf-8')))
-        return -1
     
-    return res[0][1]
+    def find(self, name_variants, min_levenshtein=0.9):
+        """
+        Find the position of the author (in the list of names)
+        
+        :param name_variants - array of names of a single author
+        :return position of the best match, or -1
+        """
+        nv = [names.cleanup_name(x).lower().encode('utf8') for x in name_variants]
+        
+        # the variants are in the order of preference
+        for variant in nv:
+            if variant in self.positions:
+                return self.positions[variant]
+        
+        # compute similarity between all authors (and the supplied variants)
+        # but keep only the best match (the first one, if there are more);
+        # the ratio can't be bigger than 2*min(len)/sum(len) so we'll skip 
+        # names that can't beat the best match
+        best = None
+        for vidx, variant in enumerate(nv):
+            lv = len(variant)
+            for aidx, author in enumerate(self.names):
+                if best is not None:
+                    la = len(author)
+                    if la + lv == 0 or 2.0 * min(la, lv) / (la + lv) <= best[0]:
+                        continue
+                r = Levenshtein.ratio(author, variant)
+                if best is None or r > best[0]:
+                    best = (r, aidx, vidx)
+        
+        if best is None:
+            return -1
+        
+        if best[0] < min_levenshtein:
+            # test submatch (0.6470588235294118, 19, 0) (required:0.69) closest: vernetto, s, variant: vernetto, silvia teresa
+            author_name = self.names[best[1]]
+            variant_name = nv[best[2]]
+            if author_name in variant_name or variant_name in author_name:
+                logger.debug(u'Using submatch for: %s (required:%s) closest: %s, variant: %s' \
+                            % (best, min_levenshtein, 
+                               unicode(author_name, 'utf-8'), 
+                               unicode(variant_name, 'utf-8')))
+                return best[1]
+                
+            logger.debug(u'No match found: the closest is: %s (required:%s) closest: %s, variant: %s' \
+                            % (best, min_levenshtein, 
+                               unicode(author_name, 'utf-8'), 
+                               unicode(variant_name, 'utf-8')))
+            return -1
+        
+        return best[1]
+
+
+
+def get_author_index(authors_list, bibcode=None):
+    """
+    Returns AuthorIndex for the list of authors; when bibcode is
+    known, the index is cached (keyed by the bibcode and by the
+    author list - so that a changed record gets a new index)
+    """
+    if bibcode is None:
+        return AuthorIndex(authors_list)
+    key = (bibcode, hash(tuple(authors_list)))
+    with _index_lock:
+        idx = _index_cache.get(key, None)
+    if idx is None:
+        idx = AuthorIndex(authors_list)
+        with _index_lock:
+            _index_cache[key] = idx
+    return idx
 
 
 def _remove_orcid(rec, orcidid):
@@ -153,62 +211,85 @@ def _remove_orcid(rec, orcidid):
             modified = True
     return modified
 
-def reindex_all_claims(app, orcidid, since=None, ignore_errors=False):
+def reindex_all_claims(app, orcidid, since=None, ignore_errors=False, chunk_size=None):
     """
     Procedure that will re-play all claims
     that were modified since a given starting point.
+    
+    The affected records are loaded in chunks (one query per chunk
+    of bibcodes), updated in memory and written back in bulk.
+    
+    :param: chunk_size - int, number of records loaded/saved at once
+            (default: REINDEX_CHUNK_SIZE)
+    :return: list of bibcodes that were modified
     """
     
     last_check = get_date(since or '1974-11-09T22:56:52.518001Z')
+    chunk_size = chunk_size or app.conf.get('REINDEX_CHUNK_SIZE', 500)
+    min_levenshtein = app.conf.get('MIN_LEVENSHTEIN_RATIO', 0.9)
     recs_modified = set()
     
+    author = app.retrieve_orcid(orcidid)
+    claimed = set()
+    removed = set()
     with app.session_scope() as session:
-        author = app.retrieve_orcid(orcidid)
-        claimed = set()
-        removed = set()
-        for claim in session.query(ClaimsLog).filter(
-                        and_(ClaimsLog.orcidid == orcidid, ClaimsLog.created > last_check)
-                        ).all():
+        for claim in stream_columns(session, [ClaimsLog.bibcode, ClaimsLog.status],
+                        criterion=[ClaimsLog.orcidid == orcidid, ClaimsLog.created > last_check]):
             if claim.status in ('claimed', 'updated', 'forced'):
                 claimed.add(claim.bibcode)
             elif claim.status == 'removed':
                 removed.add(claim.bibcode)
-
-        with app.session_scope() as session:    
-            for bibcode in removed:
-                r = session.query(Records).filter_by(bibcode=bibcode).first()
-                if r is None:
+    
+    bibcodes = sorted(claimed.union(removed))
+    
+    with app.session_scope() as session:
+        for i in range(0, len(bibcodes), chunk_size):
+            chunk = bibcodes[i:i+chunk_size]
+            
+            # if there are several records with the same bibcode, the first one wins
+            recs = {}
+            for r in session.query(Records.id, Records.bibcode, Records.authors_z, Records.claims) \
+                    .filter(Records.bibcode.in_(chunk)).order_by(Records.id.asc()).all():
+                if r.bibcode not in recs:
+                    recs[r.bibcode] = {'id': r.id, 'bibcode': r.bibcode,
+                                       'authors_z': r.authors_z,
+                                       'claims': r.claims and json.loads(r.claims) or {}}
+            
+            updates = []
+            now = get_date()
+            for bibcode in chunk:
+                rec = recs.get(bibcode, None)
+                if rec is None:
                     continue
-                rec = r.toJSON()
-                if _remove_orcid(rec, orcidid):
-                    r.claims = json.dumps(rec.get('claims'))
-                    r.updated = get_date()
+                
+                modified = False
+                if bibcode in removed and _remove_orcid(rec, orcidid):
+                    modified = True
+                
+                if bibcode in claimed:
+                    # authors are needed (and decoded) only for the claims
+                    rec['authors'] = decompress_authors(rec.pop('authors_z'))
+                    claim = {'bibcode': bibcode, 'orcidid': orcidid}
+                    claim.update(author.get('facts', {}))
+                    try:
+                        if update_record(rec, claim, min_levenshtein):
+                            modified = True
+                    except Exception, e:
+                        if ignore_errors:
+                            app.logger.error(u'Error processing {0} {1}'.format(bibcode, orcidid))
+                        else:
+                            raise e
+                
+                if modified:
+                    updates.append({'id': rec['id'], 'claims': json.dumps(rec.get('claims', {})), 'updated': now})
                     recs_modified.add(bibcode)
-        
-            for bibcode in claimed:
-                r = session.query(Records).filter_by(bibcode=bibcode).first()
-                if r is None:
-                    continue
-                rec = r.toJSON()
-
-                claim = {'bibcode': bibcode, 'orcidid': orcidid}
-                claim.update(author.get('facts', {}))
-                try:
-                    _claims = update_record(rec, claim)
-                    if _claims:
-                        r.claims = json.dumps(rec.get('claims', {}))
-                        r.updated = get_date()
-                        recs_modified.add(bibcode)
-                except Exception, e:
-                    if ignore_errors:
-                        app.logger.error(u'Error processing {0} {1}'.format(bibcode, orcidid))
-                    else:
-                        raise e
-                    
+            
+            if updates:
+                session.bulk_update_mappings(Records, updates)
                     
-            session.commit()
+        session.commit()
         
-        return list(recs_modified)
+    return list(recs_modified)
 
 
 def get_all_touched_profiles(app, since='1974-11-09T22:56:52.518001Z', max_failures=5, max_cons_failures=2):
@@ -216,13 +297,28 @@ def get_all_touched_profiles(app, since='1974-11-09T22:56:52.518001Z', max_failu
     orcid profiles"""
     
     orcid_ids = set()
+    for page in iter_touched_profiles(app, since, max_failures=max_failures, max_cons_failures=max_cons_failures):
+        orcid_ids.update(page)
+    return list(orcid_ids)
+
+
+
+def iter_touched_profiles(app, since='1974-11-09T22:56:52.518001Z', max_failures=5, max_cons_failures=2):
+    """Queries the orcid-service for all new/updated orcid
+    profiles; yields them page by page (as soon as they arrive)
+    
+    :return: generator of lists of orcid ids (the same orcidid can
+        appear in several pages)
+    """
+    
     latest_point = get_date(since) # RFC 3339 format
     failures = cons_failures = 0
     
     while True:
         # increase the timestamp by one microsec and get new updates
         latest_point = latest_point + timedelta(microseconds=1)
-        r = requests.get(app.conf.get('API_ORCID_UPDATES_ENDPOINT') % latest_point.isoformat(),
+        r = app.client.get(app.conf.get('API_ORCID_UPDATES_ENDPOINT') % latest_point.isoformat(),
+                    endpoint='orcid-updates',
                     params={'fields': ['orcid_id', 'updated', 'created']},
                     headers = {'Authorization': 'Bearer {0}'.format(app.conf.get('API_TOKEN'))})
     
@@ -252,8 +348,5 @@ def get_all_touched_profiles(app, since='1974-11-09T22:56:52.518001Z', max_failu
         dates = [get_date(x['updated']) for x in data]
         dates = sorted(dates, reverse=True)
         latest_point = dates[0]
-        for rec in data:
-            orcid_ids.add(rec['orcid_id'])
-        
-    return list(orcid_ids)
+        yield [rec['orcid_id'] for rec in data]
             
\ No newline at end of file
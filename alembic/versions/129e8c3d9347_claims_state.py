@@ -0,0 +1,38 @@
+"""Current state of claims (latest claim per orcidid/bibcode)
+
+Revision ID: 129e8c3d9347
+Revises: 3e6c364177ce
+Create Date: 2026-10-18 10:02:17.552310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '129e8c3d9347'
+down_revision = '3e6c364177ce'
+
+from alembic import op
+import sqlalchemy as sa
+import datetime
+                               
+
+
+def upgrade():
+    op.create_table('claims_state',
+        sa.Column('orcidid', sa.String(19), primary_key=True),
+        sa.Column('bibcode', sa.String(19), primary_key=True),
+        sa.Column('status', sa.String(255)),
+        sa.Column('provenance', sa.String(255)),
+        sa.Column('created', sa.TIMESTAMP),
+        sa.Column('updated', sa.TIMESTAMP, default=datetime.datetime.utcnow)
+    )
+    
+    # the latest log entry of every (orcidid, bibcode) pair is its current
+    # state (the same as: python run.py --backfill_state)
+    op.execute('INSERT INTO claims_state (orcidid, bibcode, status, provenance, created, updated) '
+               'SELECT orcidid, bibcode, status, provenance, created, created FROM claims '
+               'WHERE id IN (SELECT max(id) FROM claims WHERE bibcode IS NOT NULL AND bibcode != \'\' '
+               'GROUP BY orcidid, bibcode)')
+
+
+def downgrade():
+    op.drop_table('claims_state')
@@ -0,0 +1,30 @@
+"""Pending claims (buffer of the match-claim stage)
+
+Revision ID: 3e6c364177ce
+Revises: 322f6182f133
+Create Date: 2026-10-18 09:12:40.118512
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e6c364177ce'
+down_revision = '322f6182f133'
+
+from alembic import op
+import sqlalchemy as sa
+import datetime
+                               
+
+
+def upgrade():
+    op.create_table('pending_claims',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('bibcode', sa.String(19), nullable=False),
+        sa.Column('payload', sa.Text),
+        sa.Column('created', sa.TIMESTAMP, default=datetime.datetime.utcnow),
+        sa.Index('ix_pending_claims_bibcode', 'bibcode')
+    )
+
+
+def downgrade():
+    op.drop_table('pending_claims')
@@ -0,0 +1,27 @@
+"""Leases (named locks with expiration)
+
+Revision ID: 5a1c0e7d2b4f
+Revises: 129e8c3d9347
+Create Date: 2026-10-18 14:21:40.117385
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a1c0e7d2b4f'
+down_revision = '129e8c3d9347'
+
+from alembic import op
+import sqlalchemy as sa
+                               
+
+
+def upgrade():
+    op.create_table('leases',
+        sa.Column('name', sa.String(255), primary_key=True),
+        sa.Column('owner', sa.String(255)),
+        sa.Column('expires', sa.TIMESTAMP)
+    )
+
+
+def downgrade():
+    op.drop_table('leases')
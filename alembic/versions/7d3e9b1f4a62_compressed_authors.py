@@ -0,0 +1,60 @@
+"""Compressed authors of records (plus their hash)
+
+Revision ID: 7d3e9b1f4a62
+Revises: 5a1c0e7d2b4f
+Create Date: 2026-10-18 16:02:11.530214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d3e9b1f4a62'
+down_revision = '5a1c0e7d2b4f'
+
+from alembic import op
+import sqlalchemy as sa
+import hashlib
+import zlib
+                               
+BATCH_SIZE = 1000
+
+
+def _convert(select_sql, update_sql, convert):
+    """Converts the rows in batches (ordered by id)"""
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(sa.text(select_sql), last_id=last_id, limit=BATCH_SIZE).fetchall()
+        if not rows:
+            break
+        for id, value in rows:
+            if value is not None:
+                conn.execute(sa.text(update_sql), id=id, **convert(value))
+        last_id = rows[-1][0]
+
+
+def _compress(authors):
+    if isinstance(authors, unicode):
+        authors = authors.encode('utf8')
+    return {'authors_z': zlib.compress(authors), 'authors_hash': hashlib.sha1(authors).hexdigest()}
+
+
+def _decompress(authors_z):
+    return {'authors': zlib.decompress(authors_z).decode('utf8')}
+
+
+def upgrade():
+    op.add_column('records', sa.Column('authors_z', sa.LargeBinary))
+    op.add_column('records', sa.Column('authors_hash', sa.String(40)))
+    _convert('SELECT id, authors FROM records WHERE id > :last_id ORDER BY id LIMIT :limit',
+             'UPDATE records SET authors_z = :authors_z, authors_hash = :authors_hash WHERE id = :id',
+             _compress)
+    op.drop_column('records', 'authors')
+
+
+def downgrade():
+    op.add_column('records', sa.Column('authors', sa.Text))
+    _convert('SELECT id, authors_z FROM records WHERE id > :last_id ORDER BY id LIMIT :limit',
+             'UPDATE records SET authors = :authors WHERE id = :id',
+             _decompress)
+    op.drop_column('records', 'authors_hash')
+    op.drop_column('records', 'authors_z')
@@ -0,0 +1,38 @@
+"""Composite indexes for the access paths of claims and records
+
+Revision ID: b84f2a6c1d05
+Revises: 7d3e9b1f4a62
+Create Date: 2026-10-18 17:45:03.220816
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b84f2a6c1d05'
+down_revision = '7d3e9b1f4a62'
+
+from alembic import op
+import sqlalchemy as sa
+                               
+
+
+def upgrade():
+    # get_claims (latest #full-import), find_removed.py, reindex_all_claims
+    op.create_index('ix_claims_orcidid_status_id', 'claims', ['orcidid', 'status', 'id'])
+    op.create_index('ix_claims_orcidid_id', 'claims', ['orcidid', 'id'])
+    op.create_index('ix_claims_orcidid_created', 'claims', ['orcidid', 'created'])
+    # covered by ix_claims_orcidid_id
+    op.drop_index('ix_orcidid', 'claims')
+    
+    # iter_records (keyset pagination)
+    op.create_index('ix_recs_updated_id', 'records', ['updated', 'id'])
+    op.drop_index('ix_recs_updated', 'records')
+
+
+def downgrade():
+    op.create_index('ix_recs_updated', 'records', ['updated'])
+    op.drop_index('ix_recs_updated_id', 'records')
+    
+    op.create_index('ix_orcidid', 'claims', ['orcidid'])
+    op.drop_index('ix_claims_orcidid_created', 'claims')
+    op.drop_index('ix_claims_orcidid_id', 'claims')
+    op.drop_index('ix_claims_orcidid_status_id', 'claims')
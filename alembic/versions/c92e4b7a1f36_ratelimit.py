@@ -0,0 +1,26 @@
+"""Buckets of the rate limiter (shared by all workers)
+
+Revision ID: c92e4b7a1f36
+Revises: f51c8d3e7a20
+Create Date: 2026-10-18 23:05:42.118305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c92e4b7a1f36'
+down_revision = 'f51c8d3e7a20'
+
+from alembic import op
+import sqlalchemy as sa
+                               
+
+
+def upgrade():
+    op.create_table('ratelimit',
+        sa.Column('key', sa.String(255), primary_key=True),
+        sa.Column('value', sa.Text)
+    )
+
+
+def downgrade():
+    op.drop_table('ratelimit')
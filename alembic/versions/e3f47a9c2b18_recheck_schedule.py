@@ -0,0 +1,38 @@
+"""Schedule of the orcid profile re-checks
+
+Revision ID: e3f47a9c2b18
+Revises: b84f2a6c1d05
+Create Date: 2026-10-18 21:12:37.604218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e3f47a9c2b18'
+down_revision = 'b84f2a6c1d05'
+
+from alembic import op
+import sqlalchemy as sa
+import datetime
+                               
+
+
+def upgrade():
+    op.create_table('recheck_schedule',
+        sa.Column('orcidid', sa.String(19), primary_key=True),
+        sa.Column('next_check_at', sa.TIMESTAMP),
+        sa.Column('updated', sa.TIMESTAMP)
+    )
+    op.create_index('ix_next_check_at', 'recheck_schedule', ['next_check_at'])
+    
+    # every known author gets checked within a day (that is when the
+    # re-checks queued in the broker would fire; when they do, they move
+    # the time of the next check)
+    now = datetime.datetime.utcnow()
+    op.execute(sa.text('INSERT INTO recheck_schedule (orcidid, next_check_at, updated) '
+                       'SELECT orcidid, :next_check_at, :updated FROM authors WHERE orcidid IS NOT NULL')
+               .bindparams(next_check_at=now + datetime.timedelta(days=1), updated=now))
+
+
+def downgrade():
+    op.drop_index('ix_next_check_at', 'recheck_schedule')
+    op.drop_table('recheck_schedule')
@@ -0,0 +1,24 @@
+"""Adaptive interval of the orcid profile re-checks
+
+Revision ID: f51c8d3e7a20
+Revises: e3f47a9c2b18
+Create Date: 2026-10-18 22:40:11.381907
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f51c8d3e7a20'
+down_revision = 'e3f47a9c2b18'
+
+from alembic import op
+import sqlalchemy as sa
+                               
+
+
+def upgrade():
+    # empty means that the interval is estimated (at the next check)
+    op.add_column('recheck_schedule', sa.Column('check_interval', sa.Integer))
+
+
+def downgrade():
+    op.drop_column('recheck_schedule', 'check_interval')
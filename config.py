@@ -50,6 +50,10 @@ API_ENDPOINT = 'https://api.adsabs.harvard.edu'
 API_SOLR_QUERY_ENDPOINT = API_ENDPOINT + '/v1/search/query/'
 API_ORCID_EXPORT_PROFILE = API_ENDPOINT + '/v1/orcid/get-profile/%s'
 API_ORCID_UPDATES_ENDPOINT = API_ENDPOINT + '/v1/orcid/export/%s'
+# if True, the orcid-service is asked to reload the profile from ORCID; the
+# response is then never 304 (not modified), but profiles with the same
+# content are still skipped
+API_ORCID_EXPORT_RELOAD = True
 API_TOKEN = 'fixme'
 
 # The ORCID API public endpoint
@@ -68,4 +72,188 @@ MIN_LEVENSHTEIN_RATIO = 0.69
 # to retrieve a canonical bibcode; first match will stop the process. Higher number
 # means 'higher priority'
 # the '*' will be used for no-match, if this number is <0, the identifier will be skipped
-ORCID_IDENTIFIERS_ORDER = {'bibcode': 9, 'doi': 8, 'arxiv': 7, '*': 0}
\ No newline at end of file
+ORCID_IDENTIFIERS_ORDER = {'bibcode': 9, 'doi': 8, 'arxiv': 7, '*': 0}
+
+
+
+# when resolving identifiers of orcid works, we'll send them to the API
+# in batches (one query per batch); rows should be bigger than the batch
+# size because some identifiers match several documents
+ORCID_IDENTIFIERS_BATCH_SIZE = 100
+ORCID_IDENTIFIERS_BATCH_ROWS = 2000
+
+
+
+# settings of the http client (used for all calls to the external API's);
+# timeouts are in seconds, the n-th retry will wait HTTP_BACKOFF_FACTOR * 2**n
+# seconds (or as long as the server asks in 'Retry-After')
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_READ_TIMEOUT = 30.0
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_MAX_BACKOFF = 60.0
+HTTP_POOL_SIZE = 10
+
+# max number of requests in flight (per endpoint) when the client is used
+# from many threads; '*' is for endpoints that are not listed
+HTTP_CONCURRENCY = {'orcid-public': 8, 'orcid-service': 8, 'solr': 8, '*': 4}
+
+
+
+# caches (of author info, orcid profiles and resolved bibcodes); the backend
+# can be 'memory' (every worker has its own), 'sqlite' (shared by workers
+# on the same machine, stored in CACHE_SQLITE_PATH) or 'redis' (shared by
+# all workers, CACHE_REDIS_URL). Settings for individual caches can be
+# overriden in CACHE_SETTINGS (backend, maxsize, ttl)
+CACHE_BACKEND = 'memory'
+CACHE_SQLITE_PATH = None # default: PROJ_HOME/cache.sqlite
+CACHE_REDIS_URL = 'redis://localhost:6379/0'
+CACHE_SETTINGS = {
+    'cache': {'maxsize': 1024, 'ttl': 3600},
+    'orcid_cache': {'maxsize': 1024, 'ttl': 3600},
+    'ads_cache': {'maxsize': 1024, 'ttl': 3600},
+    'bibcode_cache': {'maxsize': 2048, 'ttl': 3600},
+    # responses of the orcid API's (used for conditional requests); they
+    # hold whole profiles, so mind the size when moving it to a shared
+    # backend (e.g. sqlite)
+    'response_cache': {'maxsize': 2048, 'ttl': 3600*24},
+}
+
+
+
+# claims for the same bibcode can be applied in batches (the record is then
+# loaded/saved only once and one message is sent out); claims wait at most
+# MATCH_CLAIM_BATCH_WINDOW seconds or until there is MATCH_CLAIM_BATCH_SIZE
+# of them; 0 means that every claim is applied immediately
+MATCH_CLAIM_BATCH_WINDOW = 0
+MATCH_CLAIM_BATCH_SIZE = 50
+# only one worker applies the claims of a bibcode at a time (the lease
+# expires after this many seconds, e.g. when the worker dies)
+MATCH_CLAIM_FLUSH_LEASE = 600
+# claims that failed to be applied this many times are discarded (logged)
+MATCH_CLAIM_MAX_ATTEMPTS = 3
+
+
+
+# number of claims inserted (and sent to the queue) at once when importing
+# claims from a file; with PostgreSQL we use COPY (unless disabled)
+IMPORT_BATCH_SIZE = 1000
+IMPORT_USE_COPY = True
+
+
+
+# bulk harvesting of author info (run.py --harvest_authors); number of
+# parallel workers and number of authors saved in one transaction
+HARVEST_THREADS = 16
+HARVEST_BATCH_SIZE = 500
+
+
+
+# number of records read from the database (and sent to the queue) at once
+# when re-pushing records (run.py --repush_claims)
+REPUSH_BATCH_SIZE = 1000
+
+
+
+# number of records loaded (and saved) at once when claims of an author
+# are re-played (run.py --reindex_claims); the authors are split between
+# REINDEX_PROCESSES processes, each reading REINDEX_BATCH_SIZE of them at once
+REINDEX_CHUNK_SIZE = 500
+REINDEX_PROCESSES = 4
+REINDEX_BATCH_SIZE = 1000
+
+
+
+# author info (harvested from the API's) is considered fresh for this many
+# seconds; stale info is still used, but the author gets refreshed in the
+# background (queue 'refresh-author'); 0 means that the info is harvested
+# every time it is needed (and not found in the cache). The lease prevents
+# scheduling the same refresh several times (seconds)
+AUTHOR_INFO_FRESHNESS = 3600 * 24 * 7
+AUTHOR_REFRESH_LEASE = 600
+
+
+
+# metrics (durations of tasks, http calls, db sessions; stats of caches) in
+# the Prometheus format; if METRICS_TEXTFILE_DIR is set, every process writes
+# its metrics there (for the textfile collector of the node exporter), at
+# most every METRICS_WRITE_INTERVAL seconds
+METRICS_NAMESPACE = 'adsorcid'
+METRICS_TEXTFILE_DIR = None
+METRICS_WRITE_INTERVAL = 15
+
+
+
+# rate limits of the external API's (per endpoint: requests per second and
+# max number of requests sent at once); endpoints that are not listed (and
+# have no '*') are not limited. The limits are shared by all workers through
+# HTTP_RATE_LIMIT_BACKEND: 'memory' (per worker), 'db' (everywhere, needs
+# PostgreSQL in SQLALCHEMY_URL), 'sqlite' (all workers on the host,
+# CACHE_SQLITE_PATH) or 'redis' (everywhere, CACHE_REDIS_URL).
+# The rate is halved whenever the API answers 429/5xx and recovers gradually
+HTTP_RATE_LIMITS = {
+    'solr': {'rate': 10, 'burst': 20},
+    'orcid-service': {'rate': 10, 'burst': 20},
+    'orcid-public': {'rate': 20, 'burst': 40},
+}
+HTTP_RATE_LIMIT_BACKEND = 'memory'
+
+
+
+# the orcid-service is polled for updated profiles every ORCID_CHECK_FOR_CHANGES
+# seconds (by one worker only: the poller holds a lease which expires
+# ORCID_CHECK_LEASE_GRACE seconds after the time of its next execution)
+ORCID_CHECK_FOR_CHANGES = 60 * 5
+ORCID_CHECK_LEASE_GRACE = 60
+# every check reads all the available pages of updates (but at most
+# ORCID_CHECK_MAX_PAGES, the rest is read right after); the updated profiles
+# are sent to the queue at ORCID_CHECK_ENQUEUE_RATE messages per second
+ORCID_CHECK_MAX_PAGES = 50
+ORCID_CHECK_ENQUEUE_RATE = 100
+# celery beat sends a fresh poller message every ORCID_CHECK_FOR_CHANGES
+# seconds (run: celery beat -A ADSOrcid.tasks); while the leader is alive,
+# the message dies out, when the leader is gone it takes over its lease
+CELERYBEAT_SCHEDULE = {
+    'check-orcid-updates': {
+        'task': 'ADSOrcid.tasks.task_check_orcid_updates',
+        'schedule': ORCID_CHECK_FOR_CHANGES,
+        'args': ({},),
+    },
+}
+
+
+
+# every orcid profile is checked again after its last check; the time of the
+# next check is kept in the database and the profiles that are due are sent
+# to the queue by the sweeper (with every check for updates) in batches of
+# ORCID_RECHECK_BATCH_SIZE, at most ORCID_RECHECK_MAX_BATCHES per sweep. If 
+# the check doesn't happen, the profile is sent again after ORCID_RECHECK_RETRY
+# seconds
+ORCID_PROFILE_RECHECK_WINDOW = 3600 * 24
+ORCID_RECHECK_BATCH_SIZE = 1000
+ORCID_RECHECK_MAX_BATCHES = 10
+ORCID_RECHECK_RETRY = 3600 * 6
+
+# the interval between checks adapts to every profile: it is multiplied by
+# ORCID_RECHECK_SHRINK when the profile changed, by ORCID_RECHECK_GROW when
+# it didn't (and randomized by +-ORCID_RECHECK_JITTER); the first interval is
+# estimated from the history of the profile (ORCID_RECHECK_HISTORY seconds;
+# ORCID_PROFILE_RECHECK_WINDOW is the initial guess)
+ORCID_RECHECK_MIN_INTERVAL = 3600 * 6
+ORCID_RECHECK_MAX_INTERVAL = 3600 * 24 * 30
+ORCID_RECHECK_SHRINK = 0.5
+ORCID_RECHECK_GROW = 1.5
+ORCID_RECHECK_JITTER = 0.1
+ORCID_RECHECK_HISTORY = 3600 * 24 * 365
+
+
+
+# the same orcid profile is never queued (check-orcidid) nor indexed twice at
+# the same time (the duplicates are dropped); the guards expire after this
+# many seconds (e.g. when a message got lost or a worker died); the worker
+# keeps renewing its guard while it indexes the profile
+ORCID_INDEX_QUEUED_LEASE = 3600
+ORCID_INDEX_RUNNING_LEASE = 600
+# forced messages are not dropped; when the profile is being indexed, they
+# are tried again after this many seconds
+ORCID_INDEX_FORCED_RETRY = 60
@@ -11,6 +11,7 @@ __status__ = 'Production'
 __credit__ = ['J. Elliott']
 __license__ = 'MIT'
 
+import json
 import sys
 import time
 import argparse
@@ -23,6 +24,9 @@ warnings.simplefilter('ignore', exceptions.InsecurePlatformWarning)
 
 from adsputils import setup_logging, get_date
 from ADSOrcid import updater, tasks
+from ADSOrcid.harvester import Harvester
+from ADSOrcid.profiler import Profiler, format_report
+from ADSOrcid.reindexer import Reindexer
 from ADSOrcid.models import ClaimsLog, KeyValue, Records, AuthorInfo
 
 app = tasks.app
@@ -30,48 +34,55 @@ logger = setup_logging('run.py')
 
 
 
-def run_import(claims_file, queue='ads.orcid.claims', **kwargs):
+def run_import(claims_file, queue='ads.orcid.claims', batch_size=None, **kwargs):
     """
     Import claims from a file and inserts them into
     ads.orcid.claims queue
     
-    :param: claims_file - path to the claims
+    :param: claims_file - path to the claims (can be gzipped, 
+            '-' reads standard input)
     :type: str
     :param: queue - where to send the claims
     :type: str (ads.orcid.claims)
+    :param: batch_size - number of claims saved/sent at once
+    :type: int
     
     :return: no return
     """
     logging.captureWarnings(True)
     logger.info('Loading records from: {0}'.format(claims_file))
-    c = []
-    app.import_recs(claims_file, collector=c)
     
-    if len(c):
-        for claim in c:
-            tasks.task_ingest_claim.delay(claim)
-        
-    logger.info('Done processing {0} claims.'.format(len(c)))
+    def publish_claims(claims):
+        # one connection for the whole batch
+        publish(tasks.task_ingest_claim, claims)
+    
+    num = app.import_recs(claims_file, batch_size=batch_size, callback=publish_claims)
+    logger.info('Done processing {0} claims.'.format(num))
 
 
-def reindex_claims(since=None, orcid_ids=None, **kwargs):
+def reindex_claims(since=None, orcid_ids=None, processes=None, batch_size=None, **kwargs):
     """
     Re-runs all claims, both from the pipeline and
     from the orcid-service storage.
     
     :param: since - RFC889 formatted string
     :type: str
+    :param: processes - number of parallel processes
+    :type: int
+    :param: batch_size - number of authors read at once
+    :type: int
     
     :return: no return
     """
     if orcid_ids:
         for oid in orcid_ids:
-            tasks.task_index_orcid_profile.delay({'orcidid': oid, 'force': True})
+            tasks.enqueue_orcid_profile({'orcidid': oid, 'force': True})
         if not since:
             print 'Done (just the supplied orcidids)'
             return
         
     logging.captureWarnings(True)
+    reindexer = Reindexer(app, processes=processes, batch_size=batch_size, callback=_submit_reindexed)
     if not since or isinstance(since, basestring) and since.strip() == "":
         with app.session_scope() as session:
             kv = session.query(KeyValue).filter_by(key='last.reindex').first()
@@ -79,45 +90,41 @@ def reindex_claims(since=None, orcid_ids=None, **kwargs):
                 since = kv.value
             else:
                 since = '1974-11-09T22:56:52.518001Z' 
+    else:
+        # explicit starting point, we'll not continue the interrupted run
+        reindexer.clear_checkpoints()
     
     from_date = get_date(since)
-    orcidids = set()
-    
     
     logger.info('Loading records since: {0}'.format(from_date.isoformat()))
     
-    # first re-check our own database (replay the logs)
-    with app.session_scope() as session:
-        for author in session.query(AuthorInfo.orcidid.distinct().label('orcidid')).all():
-            orcidid = author.orcidid
-            if orcidid and orcidid.strip() != "":
-                try:
-                    changed = updater.reindex_all_claims(app, orcidid, since=from_date.isoformat(), ignore_errors=True)
-                    if len(changed):
-                        orcidids.add(orcidid)
-                    tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True})
-                except:
-                    print 'Error processing: {0}'.format(orcidid)
-                    traceback.print_exc()
-                    continue
-                if len(orcidids) % 100 == 0:
-                    print 'Done replaying {0} profiles'.format(len(orcidids))
+    # first re-check our own database (replay the logs); the authors
+    # are processed in parallel (an interrupted run will be resumed)
+    out = reindexer.run(from_date.isoformat())
+    orcidids = out['changed']
+    from_date = get_date(out['since'])
+    print 'Done replaying {0} profiles ({1} errors)'.format(out['authors'], out['errors'])
     
     print 'Now harvesting orcid profiles...'
     
-    # then get all new/old orcidids from orcid-service
-    all_orcids = set(updater.get_all_touched_profiles(app, from_date.isoformat()))
-    orcidids = all_orcids.difference(orcidids)
-    from_date = get_date()
-    
-      
-    for orcidid in orcidids:
-        try:
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True})
-        except: # potential backpressure (we are too fast)
-            time.sleep(2)
-            print 'Conn problem, retrying...', orcidid
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True})
+    # then get all new/old orcidids from orcid-service (and submit them
+    # as they arrive)
+    since = from_date.isoformat()
+    from_date = get_date(out['started'])
+    num = 0
+    
+    for page in updater.iter_touched_profiles(app, since):
+        for orcidid in page:
+            if orcidid in orcidids:
+                continue
+            orcidids.add(orcidid)
+            num += 1
+            try:
+                tasks.enqueue_orcid_profile({'orcidid': orcidid, 'force': True})
+            except: # potential backpressure (we are too fast)
+                time.sleep(2)
+                print 'Conn problem, retrying...', orcidid
+                tasks.enqueue_orcid_profile({'orcidid': orcidid, 'force': True})
         
     with app.session_scope() as session:
         kv = session.query(KeyValue).filter_by(key='last.reindex').first()
@@ -127,29 +134,46 @@ def reindex_claims(since=None, orcid_ids=None, **kwargs):
         else:
             kv.value = from_date.isoformat()
         session.commit()
+    reindexer.clear_checkpoints()
 
     print 'Done'
-    logger.info('Done submitting {0} orcid ids.'.format(len(orcidids)))
+    logger.info('Done submitting {0} orcid ids.'.format(num))
+
+
+def _submit_reindexed(orcidid, changed):
+    """Called (from the reindexing processes) for every author; the
+    messages are forced, so they are sent even if the profile is already
+    queued (see tasks.enqueue_orcid_profile)."""
+    app.acquire_lease(tasks.QUEUED_LEASE.format(orcidid), app.conf.get('ORCID_INDEX_QUEUED_LEASE', 3600))
+    publish(tasks.task_index_orcid_profile, [{'orcidid': orcidid, 'force': True}])
 
 
-def repush_claims(since=None, orcid_ids=None, **kwargs):
+def repush_claims(since=None, orcid_ids=None, batch_size=None, **kwargs):
     """
     Re-pushes all recs that were added since date 'X'
     to the output (i.e. forwards them onto the Solr queue)
     
+    The records are read (and sent) in batches; after every batch
+    we save a checkpoint, so that an interrupted run continues
+    where it stopped (unless `since` is given explicitly)
+    
     :param: since - RFC889 formatted string
     :type: str
+    :param: batch_size - number of records read/sent at once
+    :type: int
     
     :return: no return
     """
     if orcid_ids:
         for oid in orcid_ids:
-            tasks.task_index_orcid_profile.delay({'orcidid': oid, 'force': False})
+            tasks.enqueue_orcid_profile({'orcidid': oid, 'force': False})
         if not since:
             print 'Done (just the supplied orcidids)'
             return
         
     logging.captureWarnings(True)
+    started = get_date().isoformat()
+    last_id = None
     if not since or isinstance(since, basestring) and since.strip() == "":
         with app.session_scope() as session:
             kv = session.query(KeyValue).filter_by(key='last.repush').first()
@@ -157,39 +181,74 @@ def repush_claims(since=None, orcid_ids=None, **kwargs):
                 since = kv.value
             else:
                 since = '1974-11-09T22:56:52.518001Z' 
+            
+            checkpoint = session.query(KeyValue).filter_by(key='repush.checkpoint').first()
+            if checkpoint is not None:
+                checkpoint = json.loads(checkpoint.value)
+                since, last_id, started = checkpoint['updated'], checkpoint['id'], checkpoint['started']
+                logger.info('Resuming interrupted repush from: {0}'.format(checkpoint))
     
     from_date = get_date(since)
-    orcidids = set()
     
     logger.info('Re-pushing records since: {0}'.format(from_date.isoformat()))
     
-    
     num_bibcodes = 0
+    start = time.time()
+    for batch in app.iter_records(from_date, batch_size=batch_size, last_id=last_id):
+        publish(tasks.task_output_results, 
+                [{'bibcode': data['bibcode'], 'authors': data['authors'], 'claims': data['claims']} for data in batch])
+        num_bibcodes += len(batch)
+        
+        save_kv('repush.checkpoint', json.dumps({'updated': batch[-1]['updated'], 'id': batch[-1]['id'], 
+                                                 'started': started}))
+        logger.info('Re-pushed {0} records ({1:.1f}/sec), last: {2}'.format(num_bibcodes, 
+                        num_bibcodes / max(time.time() - start, 0.001), batch[-1]['updated']))
+    
+    # next time, start from the moment we started (records updated in the meantime
+    # will be sent again)
+    save_kv('last.repush', started)
     with app.session_scope() as session:
-        for rec in session.query(Records) \
-            .filter(Records.updated >= from_date) \
-            .order_by(Records.updated.asc()) \
-            .all():
-            
-            data = rec.toJSON()
-            try:
-                tasks.task_output_results.delay({'bibcode': data['bibcode'], 'authors': data['authors'], 'claims': data['claims']})
-            except: # potential backpressure (we are too fast)
-                time.sleep(2)
-                print 'Conn problem, retrying ', data['bibcode']
-                tasks.task_output_results.delay({'bibcode': data['bibcode'], 'authors': data['authors'], 'claims': data['claims']})
-            num_bibcodes += 1
-    
+        session.query(KeyValue).filter_by(key='repush.checkpoint').delete()
+        session.commit()
+        
+    logger.info('Done processing {0} records.'.format(num_bibcodes))
+
+
+
+def publish(task, messages, max_retries=3):
+    """Sends the messages to the queue (using one connection); if 
+    the broker is not accepting them (backpressure or connection 
+    problem), we'll back off and continue with the unsent messages.
+    """
+    i = 0
+    attempt = 0
+    while True:
+        try:
+            with app.producer_or_acquire() as producer:
+                while i < len(messages):
+                    task.apply_async(args=(messages[i],), producer=producer)
+                    i += 1
+            return
+        except Exception, e:
+            if attempt >= max_retries:
+                raise
+            wait = 2 ** attempt
+            logger.warning('Conn problem ({0}), retrying in {1}s'.format(e, wait))
+            time.sleep(wait)
+            attempt += 1
+
+
+
+def save_kv(key, value):
+    """Saves the value into the KeyValue storage."""
     with app.session_scope() as session:
-        kv = session.query(KeyValue).filter_by(key='last.repush').first()
+        kv = session.query(KeyValue).filter_by(key=key).first()
         if kv is None:
-            kv = KeyValue(key='last.repush', value=get_date())
+            kv = KeyValue(key=key, value=value)
             session.add(kv)
         else:
-            kv.value = get_date()
+            kv.value = value
         session.commit()
-        
-    logger.info('Done processing {0} orcid ids.'.format(num_bibcodes))
 
 
 
@@ -223,18 +282,23 @@ def refetch_orcidids(since=None, orcid_ids=None, **kwargs):
     logger.info('Re-fetching orcidids updated since: {0}'.format(from_date.isoformat()))
     
         
-    # then get all new/old orcidids from orcid-service
-    orcidids = set(updater.get_all_touched_profiles(app, from_date.isoformat()))
+    # then get all new/old orcidids from orcid-service (and submit them
+    # as they arrive)
+    since = from_date.isoformat()
     from_date = get_date()
+    orcidids = set()
     
-      
-    for orcidid in orcidids:
-        try:
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': False})
-        except: # potential backpressure (we are too fast)
-            time.sleep(2)
-            print 'Conn problem, retrying...', orcidid
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': False})
+    for page in updater.iter_touched_profiles(app, since):
+        for orcidid in page:
+            if orcidid in orcidids:
+                continue
+            orcidids.add(orcidid)
+            try:
+                tasks.enqueue_orcid_profile({'orcidid': orcidid, 'force': False})
+            except: # potential backpressure (we are too fast)
+                time.sleep(2)
+                print 'Conn problem, retrying...', orcidid
+                tasks.enqueue_orcid_profile({'orcidid': orcidid, 'force': False})
         
     with app.session_scope() as session:
         kv = session.query(KeyValue).filter_by(key='last.refetch').first()
@@ -251,6 +315,64 @@ def refetch_orcidids(since=None, orcid_ids=None, **kwargs):
 
 
 
+def harvest_authors(since=None, orcid_ids=None, threads=None, **kwargs):
+    """
+    Harvests (in parallel) info about authors and saves it into 
+    the database.
+    
+    :param: since - RFC889 formatted string; if present, we'll harvest
+            authors whose profiles were updated since then (as discovered
+            from the ads api)
+    :type: str
+    :param: orcid_ids - list of orcidids to harvest; if neither since
+            nor orcid_ids is present, all authors from our database
+            are refreshed
+    :param: threads - int, number of parallel workers
+    
+    :return: no return
+    """
+    logging.captureWarnings(True)
+    
+    def touched():
+        seen = set()
+        for page in updater.iter_touched_profiles(app, get_date(since).isoformat()):
+            for orcidid in page:
+                if orcidid not in seen:
+                    seen.add(orcidid)
+                    yield orcidid
+    
+    def known():
+        with app.session_scope() as session:
+            for author in session.query(AuthorInfo.orcidid).order_by(AuthorInfo.id.asc()).yield_per(1000):
+                if author.orcidid and author.orcidid.strip():
+                    yield author.orcidid
+    
+    if orcid_ids:
+        source = orcid_ids
+    elif since:
+        source = touched()
+    else:
+        # read the ids first, the session is needed for saving
+        source = list(known())
+    
+    logger.info('Harvesting author info')
+    start = time.time()
+    stats = Harvester(app, threads=threads).harvest(source)
+    print 'Done; {0} in {1:.1f}s'.format(stats, time.time() - start)
+    logger.info('Done harvesting authors: {0}'.format(stats))
+
+
+
+def backfill_claims_state():
+    """Rebuilds the table with the current state of claims (from
+    the log of claims)."""
+    logger.info('Rebuilding current state of claims')
+    start = time.time()
+    num = app.backfill_claims_state()
+    print 'Done; {0} (orcidid, bibcode) pairs in {1:.1f}s'.format(num, time.time() - start)
+    logger.info('Done rebuilding state of {0} claims'.format(num))
+
+
 def print_kvs():    
     """Prints the values stored in the KeyValue table."""
     print 'Key, Value from the storage:'
@@ -271,11 +393,15 @@ def show_api_diagnostics(orcid_ids=None, bibcodes=None, ):
     
     
     if orcid_ids:
+        # get info about all the authors at once
+        infos = {}
+        for o, info, error in Harvester(app).fetch(orcid_ids):
+            infos[o] = error is None and info or error
         for o in orcid_ids:
             print o
             print 'DB Model', app.retrieve_orcid(o)
             print '=' * 80 + '\n'
-            print 'Author info', app.harvest_author_info(o)
+            print 'Author info', infos.get(o)
             print '=' * 80 + '\n'
             print 'Public orcid profile', app.get_public_orcid_profile(o)
             print '=' * 80 + '\n'
@@ -307,7 +433,7 @@ def show_api_diagnostics(orcid_ids=None, bibcodes=None, ):
         print 'Now submitting ORCiD for processing'
         for o in orcid_ids:
             m = {'orcidid': o}
-            print 'message=%s, taskid=%s' % (m, tasks.task_index_orcid_profile.delay(m))
+            print 'message=%s, taskid=%s' % (m, tasks.enqueue_orcid_profile(m))
 
     if orcid_ids and bibcodes:
         print '=' * 80 + '\n'
@@ -319,6 +445,26 @@ def show_api_diagnostics(orcid_ids=None, bibcodes=None, ):
                 print 'message=%s, taskid=%s' % (m, tasks.task_ingest_claim.delay(m)) 
 
 
+def profile_pipeline(orcid_ids, flamegraph=None, profile_output=None, top=25):
+    """
+    Pushes the orcid profiles through the pipeline (in this process) and
+    prints where the time was spent.
+    
+    :param: flamegraph - str, path; the sampled stacks (folded format) 
+            are saved there
+    :param: profile_output - str, path; raw cProfile stats are saved
+            there (one file per orcid: <path>.<orcidid>)
+    """
+    profiler = Profiler(app, top=top)
+    for o in orcid_ids:
+        report = profiler.profile(o, profile_output=profile_output and '{0}.{1}'.format(profile_output, o))
+        print format_report(report)
+        print '=' * 80 + '\n'
+    if flamegraph:
+        profiler.write_folded(flamegraph)
+        print 'Folded stacks saved into', flamegraph
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Process user input.')
@@ -329,9 +475,16 @@ if __name__ == '__main__':
                         dest='import_claims',
                         action='store',
                         type=str,
-                        help='Path to the claims file to import')
+                        help='Path to the claims file to import (*.gz files are ok, \'-\' reads stdin)')
     
     
+    parser.add_argument('--batch_size',
+                        dest='batch_size',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Number of claims/records processed in one batch')
+    
     parser.add_argument('-r',
                         '--reindex_claims',
                         dest='reindex_claims',
@@ -350,6 +503,25 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Gets all orcidids changed since X (as discovered from ads api) and sends them to the queue.')
     
+    parser.add_argument('--harvest_authors',
+                        dest='harvest_authors',
+                        action='store_true',
+                        help='Harvests info about authors (all, the ones changed since X or given by --oid) and saves it')
+    
+    parser.add_argument('--threads',
+                        dest='threads',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Number of parallel workers (for harvesting)')
+    
+    parser.add_argument('--processes',
+                        dest='processes',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Number of parallel processes (for reindexing)')
+    
     parser.add_argument('-s', 
                         '--since', 
                         dest='since_date', 
@@ -385,6 +557,30 @@ if __name__ == '__main__':
                         default=False,
                         help='Show me what you would do with ORCiDs/bibcodes')
     
+    parser.add_argument('--profile', 
+                        dest='profile', 
+                        action='store_true',
+                        default=False,
+                        help='With --diagnose: process the ORCiDs (in this process) and show where the time goes')
+    
+    parser.add_argument('--flamegraph', 
+                        dest='flamegraph', 
+                        action='store',
+                        default=None,
+                        help='With --profile: save sampled stacks (folded format, for flamegraph.pl) into this file')
+    
+    parser.add_argument('--profile_output', 
+                        dest='profile_output', 
+                        action='store',
+                        default=None,
+                        help='With --profile: save raw cProfile stats into this file (suffixed by orcidid)')
+    
+    parser.add_argument('--backfill_state', 
+                        dest='backfill_state', 
+                        action='store_true',
+                        default=False,
+                        help='Rebuild the current state of claims from the claims log')
+    
     args = parser.parse_args()
     if args.orcid_ids:
         args.orcid_ids = [x.strip() for x in args.orcid_ids.split(',')]
@@ -394,18 +590,26 @@ if __name__ == '__main__':
     
     if args.kv:
         print_kvs()
+    
+    if args.backfill_state:
+        backfill_claims_state()
         
-    if args.diagnose:
+    if args.diagnose and args.profile:
+        profile_pipeline(args.orcid_ids or ['0000-0003-3041-2092'], flamegraph=args.flamegraph,
+                         profile_output=args.profile_output)
+    elif args.diagnose:
         show_api_diagnostics(args.orcid_ids or ['0000-0003-3041-2092'], args.bibcodes or ['2015arXiv150305881C'])
 
     if args.import_claims:
         # Send the files to be put on the queue
-        run_import(args.import_claims)
+        run_import(args.import_claims, batch_size=args.batch_size)
     
     if args.reindex_claims:
-        reindex_claims(args.since_date, args.orcid_ids)
+        reindex_claims(args.since_date, args.orcid_ids, processes=args.processes, batch_size=args.batch_size)
     elif args.repush_claims:
-        repush_claims(args.since_date, args.orcid_ids)
+        repush_claims(args.since_date, args.orcid_ids, batch_size=args.batch_size)
     elif args.refetch_orcidids:
         refetch_orcidids(args.since_date, args.orcid_ids)
+    elif args.harvest_authors:
+        harvest_authors(args.since_date, args.orcid_ids, threads=args.threads)
     
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+"""
+End-to-end throughput benchmark of the pipeline.
+
+The stages (check-updates -> sweep-rechecks -> index-orcid-profile ->
+ingest-claim -> match-claim -> output-results) are executed in-process, one after
+another; the messages that the tasks would send to RabbitMQ are captured
+and fed into the next stage instead. The external APIs (orcid-service,
+public ORCID API, SOLR) are replaced by a local http server that serves
+synthetic profiles and documents; the database is sqlite (in memory) or
+whatever is passed in --db (tables will be created - use a scratch db!).
+
+The results are printed as JSON, e.g.
+
+    python scripts/benchmark.py --profiles 200 --works 20 > bench.json
+    python scripts/benchmark.py --baseline bench.json --tolerance 0.2
+
+(the second run exits with an error if claims/sec dropped by more than 20%)
+"""
+
+import os
+import sys
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_HOME)
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import json
+import mock
+import random
+import re
+import string
+import threading
+import time
+import urlparse
+
+from sqlalchemy import event
+from ADSOrcid import app as app_module
+from ADSOrcid import tasks
+from ADSOrcid.models import Base
+
+
+# order in which the stages are drained (every stage can enqueue work
+# for the stages that follow)
+STAGES = (
+    ('check-updates', tasks.task_check_orcid_updates),
+    ('sweep-rechecks', tasks.task_sweep_rechecks),
+    ('index-orcid-profile', tasks.task_index_orcid_profile),
+    ('ingest-claim', tasks.task_ingest_claim),
+    ('match-claim', tasks.task_match_claim),
+    ('flush-claims', tasks.task_flush_claims),
+    ('output-results', tasks.task_output_results),
+)
+
+# tasks that re-schedule themselves (in the future); in the benchmark,
+# these messages are dropped
+PERIODIC = ('check-updates',)
+
+
+
+class SyntheticData(object):
+    """Deterministic set of authors (orcid profiles) and papers; every
+    paper is claimed by `claimants` authors."""
+
+    def __init__(self, profiles=100, works=20, authors=10, claimants=2, seed=42):
+        rnd = random.Random(seed)
+        claimants = max(1, min(claimants, profiles, authors))
+
+        self.profiles = {}
+        self.docs = {}
+        self.by_identifier = {}
+
+        for i in range(profiles):
+            orcidid = '0000-0001-%04d-%04d' % (i / 10000, i % 10000)
+            surname, given = self._name(rnd), self._name(rnd)
+            self.profiles[orcidid] = {'surname': surname, 'given': given, 'works': []}
+        orcidids = sorted(self.profiles.keys())
+
+        # consecutive authors (at the same work position) share a paper
+        papers = {}
+        for w in range(works):
+            for i, orcidid in enumerate(orcidids):
+                papers.setdefault((w * profiles + i) / claimants, []).append(orcidid)
+
+        for k, owners in sorted(papers.items()):
+            bibcode = '2017BENCH%09dA' % k
+            doi = '10.5555/bench.%d' % k
+            names = [(self._name(rnd), self._name(rnd), '-') for _ in range(authors - len(owners))]
+            for orcidid in owners:
+                p = self.profiles[orcidid]
+                names.insert(rnd.randint(0, len(names)), (p['surname'], p['given'], orcidid))
+                p['works'].append((bibcode, doi, 1500000000000 + k))
+            doc = {'bibcode': bibcode,
+                   'identifier': [bibcode, doi],
+                   'author': ['%s, %s' % (s, g) for s, g, _ in names],
+                   'author_norm': ['%s, %s' % (s, g[0]) for s, g, _ in names],
+                   'orcid_pub': [o for _, _, o in names]}
+            self.docs[bibcode] = doc
+            self.by_identifier[bibcode.lower()] = doc
+            self.by_identifier[doi.lower()] = doc
+
+    def _name(self, rnd):
+        return rnd.choice(string.ascii_uppercase) + ''.join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(5, 9)))
+
+    def num_claims(self):
+        return sum([len(p['works']) for p in self.profiles.values()])
+
+    def updates(self):
+        return [{'orcid_id': o, 'created': '2017-01-01T00:00:00Z', 'updated': '2017-06-01T00:00:%02d.%06dZ' % (i / 1000000 % 60, i % 1000000)}
+                for i, o in enumerate(sorted(self.profiles.keys()))]
+
+    def public_profile(self, orcidid):
+        p = self.profiles[orcidid]
+        return {'orcid-profile': {'orcid-bio': {'personal-details': {
+                    'family-name': {'value': p['surname']},
+                    'given-names': {'value': p['given']}}}}}
+
+    def ads_profile(self, orcidid):
+        p = self.profiles[orcidid]
+        works = []
+        for i, (bibcode, doi, ts) in enumerate(p['works']):
+            # half of the works is identified by doi only
+            xid = i % 2 and ('doi', doi) or ('bibcode', bibcode)
+            works.append({'work-external-identifiers': {'work-external-identifier': [
+                            {'work-external-identifier-type': xid[0],
+                             'work-external-identifier-id': {'value': xid[1]}}]},
+                          'last-modified-date': {'value': ts},
+                          'source': {'source-name': {'value': 'NASA ADS'}}})
+        return {'info': {'authorizedUser': True,
+                         'currentAffiliation': 'Benchmark Institute',
+                         'nameVariations': ['%s, %s' % (p['surname'], p['given'][0])]},
+                'profile': {'orcid-profile': {
+                    'orcid-history': {'last-modified-date': {'value': 1500000000000}},
+                    'orcid-activities': {'orcid-works': {'orcid-work': works}}}}}
+
+    def search(self, q):
+        if q.startswith('orcid_pub:'):
+            o = q.split(':', 1)[1].strip()
+            docs = [d for d in self.docs.values() if o in [x.replace('-', '').lower() for x in d['orcid_pub']]]
+            docs = docs[0:100]
+        else:
+            docs = []
+            for x in re.findall(r'"((?:[^"\\]|\\.)*)"', q):
+                d = self.by_identifier.get(x.replace('\\"', '"').lower())
+                if d is not None and d not in docs:
+                    docs.append(d)
+        return {'responseHeader': {'status': 0}, 'response': {'numFound': len(docs), 'docs': docs}}
+
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        data = self.server.data
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        try:
+            if url.path.startswith('/v1/search/query'):
+                out = data.search(params.get('q', [''])[0])
+            elif url.path.startswith('/v1/orcid/export/'):
+                out = data.updates()
+            elif url.path.startswith('/v1/orcid/get-profile/'):
+                out = data.ads_profile(parts[-1])
+            elif url.path.startswith('/v1.2/'):
+                out = data.public_profile(parts[1])
+            else:
+                return self._send(404, {'error': 'not found'})
+        except KeyError:
+            return self._send(404, {'error': 'not found'})
+        self._send(200, out)
+
+    def _send(self, code, out):
+        body = json.dumps(out)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of (already sorted) values."""
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+
+def run(profiles=100, works=20, authors=10, claimants=2, latency=0.0,
+        db='sqlite:///', batch_window=0, seed=42):
+    """Executes the pipeline against synthetic data.
+
+    :return: dict with the results
+    """
+    data = SyntheticData(profiles=profiles, works=works, authors=authors,
+                         claimants=claimants, seed=seed)
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.data = data
+    server.latency = latency
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    base = 'http://127.0.0.1:%s' % server.server_address[1]
+
+    app = app_module.ADSOrcidCelery('orcid-benchmark', local_config={
+        'SQLALCHEMY_URL': db,
+        'SQLALCHEMY_ECHO': False,
+        'CELERY_ALWAYS_EAGER': True,
+        'API_TOKEN': 'benchmark',
+        'API_SOLR_QUERY_ENDPOINT': base + '/v1/search/query/',
+        'API_ORCID_EXPORT_PROFILE': base + '/v1/orcid/get-profile/%s',
+        'API_ORCID_UPDATES_ENDPOINT': base + '/v1/orcid/export/%s',
+        'API_ORCID_PROFILE_ENDPOINT': base + '/v1.2/%s/orcid-bio',
+        'HTTP_MAX_RETRIES': 0,
+        'MATCH_CLAIM_BATCH_WINDOW': batch_window,
+        'CACHE_SETTINGS': {}, # all caches in memory
+        'HTTP_RATE_LIMITS': {}, # the stub server has no quota
+        })
+    app.conf.CELERY_ALWAYS_EAGER = True
+    Base.metadata.bind = app._engine
+    Base.metadata.create_all()
+    dialect = app._engine.dialect.name
+    app_module.clear_caches()
+
+    queries = {'n': 0}
+    def count_query(*args, **kwargs):
+        queries['n'] += 1
+    event.listen(app._engine, 'before_cursor_execute', count_query)
+
+    # messages that would have been sent to rabbitmq
+    queues = dict([(name, []) for name, _ in STAGES])
+    names = dict([(task.name, name) for name, task in STAGES])
+    dropped = {'n': 0}
+    def make_publisher(task):
+        def apply_async(args=None, kwargs=None, countdown=None, **options):
+            name = names[task.name]
+            if name in PERIODIC and countdown is not None:
+                dropped['n'] += 1
+                return
+            queues[name].append((args or (), kwargs or {}))
+        return apply_async
+
+    forwarded = {'n': 0}
+    def forward_message(msg):
+        msg.SerializeToString()
+        forwarded['n'] += 1
+
+    stats = {}
+    old_app = tasks.app
+    tasks.app = app
+    patches = [mock.patch.object(task, 'apply_async', make_publisher(task)) for _, task in STAGES]
+    patches.append(mock.patch.object(app, 'forward_message', forward_message))
+    for p in patches:
+        p.start()
+
+    try:
+        queues['check-updates'].append((({'errcount': 0},), {}))
+        start = time.time()
+        while any(queues.values()):
+            for name, task in STAGES:
+                s = stats.setdefault(name, {'messages': 0, 'errors': 0, 'time': 0.0,
+                                            'latency': [], 'http_calls': 0, 'db_queries': 0})
+                while queues[name]:
+                    args, kwargs = queues[name].pop(0)
+                    http_before = _http_calls(app)
+                    db_before = queries['n']
+                    t0 = time.time()
+                    try:
+                        task(*args, **kwargs)
+                    except Exception, e:
+                        s['errors'] += 1
+                        app.logger.error('{0} failed: {1}'.format(name, e))
+                    elapsed = time.time() - t0
+                    s['messages'] += 1
+                    s['time'] += elapsed
+                    s['latency'].append(elapsed)
+                    s['http_calls'] += _http_calls(app) - http_before
+                    s['db_queries'] += queries['n'] - db_before
+        total_time = time.time() - start
+    finally:
+        for p in patches:
+            p.stop()
+        tasks.app = old_app
+        server.shutdown()
+        server.server_close()
+
+    http_endpoints = app.client.stats()
+    app.close_app()
+
+    claims = stats['match-claim']['messages']
+    num_profiles = stats['index-orcid-profile']['messages']
+    http_calls = sum([s['http_calls'] for s in stats.values()])
+    db_queries = sum([s['db_queries'] for s in stats.values()])
+
+    out = {
+        'params': {'profiles': profiles, 'works': works, 'authors': authors, 'claimants': claimants,
+                   'latency': latency, 'db': dialect, 'batch_window': batch_window,
+                   'seed': seed},
+        'expected_claims': data.num_claims(),
+        'claims': claims,
+        'profiles': num_profiles,
+        'forwarded': forwarded['n'],
+        'dropped_reschedules': dropped['n'],
+        'total_time': total_time,
+        'claims_per_sec': claims / total_time if total_time else None,
+        'profiles_per_sec': num_profiles / total_time if total_time else None,
+        'http_calls': http_calls,
+        'db_queries': db_queries,
+        'http_calls_per_claim': float(http_calls) / claims if claims else None,
+        'db_queries_per_claim': float(db_queries) / claims if claims else None,
+        'http_endpoints': http_endpoints,
+        'stages': {}
+        }
+    for name, s in stats.items():
+        lat = sorted(s.pop('latency'))
+        s['p50'] = percentile(lat, 50)
+        s['p99'] = percentile(lat, 99)
+        s['max'] = lat and lat[-1] or None
+        out['stages'][name] = s
+    return out
+
+
+
+def _http_calls(app):
+    return sum([v['calls'] for v in app.client.stats().values()])
+
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Compares throughput against results of a previous run
+
+    :return: list of (metric, old value, new value) that got worse
+        by more than tolerance
+    """
+    worse = []
+    for k in ('claims_per_sec', 'profiles_per_sec'):
+        old, new = baseline.get(k), results.get(k)
+        if old and new is not None and new < old * (1.0 - tolerance):
+            worse.append((k, old, new))
+    for k in ('http_calls_per_claim', 'db_queries_per_claim'):
+        old, new = baseline.get(k), results.get(k)
+        if old and new is not None and new > old * (1.0 + tolerance):
+            worse.append((k, old, new))
+    return worse
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures throughput of the pipeline (against local API stand-ins)')
+    parser.add_argument('--profiles', type=int, default=100, help='Number of orcid profiles')
+    parser.add_argument('--works', type=int, default=20, help='Number of works (claims) per profile')
+    parser.add_argument('--authors', type=int, default=10, help='Number of authors per paper')
+    parser.add_argument('--claimants', type=int, default=2, help='Number of profiles that claim the same paper')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API response')
+    parser.add_argument('--db', default='sqlite:///', help='SQLALCHEMY_URL (scratch database!)')
+    parser.add_argument('--batch_window', type=int, default=0, help='MATCH_CLAIM_BATCH_WINDOW')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help='Write results into this file (default: stdout)')
+    parser.add_argument('--baseline', default=None, help='Results of a previous run; exit with error on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression (fraction)')
+    args = parser.parse_args()
+
+    results = run(profiles=args.profiles, works=args.works, authors=args.authors,
+                  claimants=args.claimants, latency=args.latency, db=args.db,
+                  batch_window=args.batch_window, seed=args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as fo:
+            json.dump(results, fo, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fi:
+            worse = compare(results, json.load(fi), args.tolerance)
+        for k, old, new in worse:
+            sys.stderr.write('Regression: {0} {1} -> {2}\n'.format(k, old, new))
+        if worse:
+            sys.exit(1)
@@ -1,4 +1,4 @@
-from ADSOrcid.models import ClaimsLog
+from ADSOrcid.models import ClaimsLog, stream_columns
 from ADSOrcid import tasks
 from collections import defaultdict
 
@@ -10,7 +10,8 @@ def run():
     i = 0
     
     with app.session_scope() as session:
-        for r in session.query(ClaimsLog).order_by(ClaimsLog.id.asc()).yield_per(1000):
+        for r in stream_columns(session, [ClaimsLog.orcidid, ClaimsLog.bibcode, ClaimsLog.status],
+                                order_by=[ClaimsLog.id.asc()], batch_size=10000):
             stats[r.status] += 1
             if r.orcidid and r.bibcode:
                 if r.orcidid not in authors:
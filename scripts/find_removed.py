@@ -1,4 +1,4 @@
-from ADSOrcid.models import ClaimsLog
+from ADSOrcid.models import ClaimsLog, stream_columns
 from ADSOrcid import tasks
 from collections import defaultdict
 import sys
@@ -11,7 +11,7 @@ def run():
     
     # go through the rows in order and count those that had all rows removed
     with app.session_scope() as session:
-        for r in session.query(ClaimsLog).distinct(ClaimsLog.orcidid).yield_per(100):
+        for r in session.query(ClaimsLog.orcidid).distinct().yield_per(10000):
             orcidids.add(r.orcidid)
         
         print 'collected', len(orcidids), 'orcidids'
@@ -24,10 +24,11 @@ def run():
             if j % 100 == 0:
                 print 'processing', j, 'authors, found so far', len(offended_authors)
 
-            for r in session.query(ClaimsLog).filter(ClaimsLog.orcidid == orcid).order_by(ClaimsLog.id.desc()).yield_per(1000):
+            for r in stream_columns(session, [ClaimsLog.status], criterion=[ClaimsLog.orcidid == orcid],
+                                    order_by=[ClaimsLog.id.desc()]):
                 if r.status == '#full-import': # that concludes the batch
                     if removed == i and i > 0:
-                        offended_authors.append(r.orcidid)
+                        offended_authors.append(orcid)
                     break
                 
                 if r.status == 'removed':